@@ -3,7 +3,203 @@
 # Automations can be deactivated correctly from the UI!
 # -------------------------------------------------
 from typing import Union
+import array
+import base64
+import bisect
+import collections
 import datetime
+import heapq
+import json
+import logging
+import math
+import time
+
+
+class Log:
+    """
+    Level-gated logging facade. Messages are only built if their level is enabled for the logger of this script, so
+    disabled debug messages cost a single level check. Messages can be passed as callable (e.g. a lambda returning an
+    f-string), which is only called when the message gets logged, and details as keyword fields. Details which are
+    expensive to collect (e.g. history dumps) should be guarded with Log.enabled().
+
+    With structured set, messages are logged as key=value pairs (logfmt), so that decisions can be parsed instead of
+    grepped, e.g.: msg="Switched off appliance." appliance=switch.pool_pump automation=automation.pool priority=2
+    run_minutes=42.5
+    """
+
+    logger = logging.getLogger("custom_components.pyscript.file.pv_excess_control")
+    # log messages as key=value pairs instead of plain text
+    structured = False
+
+    @staticmethod
+    def enabled(level: int = logging.DEBUG) -> bool:
+        """
+        :param level:   Logging level
+        :return:        True if messages of the level get logged
+        """
+        return Log.logger.isEnabledFor(level)
+
+    @staticmethod
+    def debug(msg, inst=None, **fields):
+        if Log.logger.isEnabledFor(logging.DEBUG):
+            log.debug(Log.format(msg, inst, fields))
+
+    @staticmethod
+    def info(msg, inst=None, **fields):
+        if Log.logger.isEnabledFor(logging.INFO):
+            log.info(Log.format(msg, inst, fields))
+
+    @staticmethod
+    def warning(msg, inst=None, **fields):
+        if Log.logger.isEnabledFor(logging.WARNING):
+            log.warning(Log.format(msg, inst, fields))
+
+    @staticmethod
+    def error(msg, inst=None, **fields):
+        if Log.logger.isEnabledFor(logging.ERROR):
+            log.error(Log.format(msg, inst, fields))
+
+    @staticmethod
+    def format(msg, inst, fields: dict) -> str:
+        """
+        Builds the log message.
+
+        :param msg:     Message or callable returning the message
+        :param inst:    Optional PVExcesscontrol Class instance the message refers to
+        :param fields:  Details as key -> value
+        :return:        Formatted message
+        """
+        if not isinstance(msg, str):
+            msg = msg()
+        values = list(fields.items())
+        if Log.structured:
+            pairs = [("msg", msg)]
+            if inst is not None:
+                pairs.extend(
+                    [
+                        ("appliance", inst.config.appliance_switch),
+                        ("automation", inst.config.automation_id),
+                        ("priority", inst.config.appliance_priority),
+                    ]
+                )
+            return " ".join([f"{k}={Log._value(v)}" for k, v in pairs + values])
+        text = msg if inst is None else f"{inst.config.log_prefix} {msg}"
+        if values:
+            text += " (" + ", ".join([f"{k}={v}" for k, v in values]) + ")"
+        return text
+
+    @staticmethod
+    def _value(value) -> str:
+        """
+        :return:    Value formatted for key=value output, quoted if necessary
+        """
+        text = str(round(value, 3)) if isinstance(value, float) else str(value)
+        if not text or " " in text or '"' in text or "=" in text:
+            return json.dumps(text)
+        return text
+
+
+class StateSnapshot:
+    """
+    Frozen view of entity states, captured once at the start of a control tick.
+
+    While a snapshot is active, _get_state() is served from it instead of querying Home Assistant. Entities which
+    were not captured upfront are read once on first access and cached for the rest of the tick. States set by this
+    script during the tick (switching, setting current) are written through, so that later decisions within the same
+    tick see the requested state.
+    """
+
+    # snapshot of the currently running tick (None outside of a tick)
+    active = None
+    # snapshot of the last finished tick, kept for statistics
+    last = None
+
+    def __init__(self):
+        self.states = {}
+        self.overrides = {}
+        self.lookups = 0
+        self.reads = 0
+
+    @staticmethod
+    def begin(entity_ids):
+        """
+        Starts a new tick by reading the state of all passed entities once.
+
+        :param entity_ids:  Entity IDs to capture
+        :return:            The new active snapshot
+        """
+        snapshot = StateSnapshot()
+        for entity_id in entity_ids:
+            snapshot.states[entity_id] = _read_state(entity_id)
+            snapshot.reads += 1
+        StateSnapshot.active = snapshot
+        return snapshot
+
+    @staticmethod
+    def end(snapshot=None):
+        """
+        Ends the current tick. Further state lookups go to Home Assistant directly.
+
+        :param snapshot:    Snapshot returned by begin(), the active one if None. A snapshot which is no longer active
+                            is only kept for statistics.
+        """
+        if snapshot is None:
+            snapshot = StateSnapshot.active
+        if StateSnapshot.active is snapshot:
+            StateSnapshot.active = None
+        if snapshot is None:
+            return
+        StateSnapshot.last = snapshot
+        Log.debug(
+            lambda: (
+                f"State snapshot served {snapshot.lookups} lookups with {snapshot.reads} state reads "
+                f"({snapshot.saved_reads()} reads saved)."
+            )
+        )
+
+    @staticmethod
+    def record(entity_id: str, value: str):
+        """
+        Writes a state requested by this script through to the active snapshot (if any).
+
+        :param entity_id:   ID of the entity
+        :param value:       Resulting state, as returned by _get_state()
+        """
+        if StateSnapshot.active is not None:
+            StateSnapshot.active.overrides[entity_id] = value
+
+    def get(self, entity_id: str) -> Union[str, None]:
+        """
+        Returns the raw state of an entity, reading it from Home Assistant only if it was not captured yet.
+
+        :param entity_id:   ID of the entity
+        :return:            Raw state if available, else None
+        """
+        self.lookups += 1
+        if entity_id not in self.states:
+            self.states[entity_id] = _read_state(entity_id)
+            self.reads += 1
+        return self.states[entity_id]
+
+    def saved_reads(self) -> int:
+        """
+        :return:    Number of state reads avoided by serving lookups from this snapshot
+        """
+        return self.lookups - self.reads
+
+
+def _read_state(entity_id: str) -> Union[str, None]:
+    """
+    Read the raw state of an entity from Home Assistant
+
+    :param entity_id:  Name of the entity
+    :return:            Raw state if entity name is valid, else None
+    """
+    try:
+        return state.get(entity_id)
+    except Exception as e:
+        Log.error(f"Could not get state from entity {entity_id}: {e}")
+        return None
 
 
 def _get_state(entity_id: str) -> Union[str, None]:
@@ -16,10 +212,15 @@ def _get_state(entity_id: str) -> Union[str, None]:
     # get entity domain
     if entity_id is not None:
         domain = entity_id.split(".")[0]
-    try:
-        entity_state = state.get(entity_id)
-    except Exception as e:
-        log.error(f"Could not get state from entity {entity_id}: {e}")
+    snapshot = StateSnapshot.active
+    if snapshot is None:
+        entity_state = _read_state(entity_id)
+    elif entity_id in snapshot.overrides:
+        snapshot.lookups += 1
+        return snapshot.overrides[entity_id]
+    else:
+        entity_state = snapshot.get(entity_id)
+    if entity_state is None:
         return None
 
     # https://github.com/home-assistant/core/blob/20fdec9e9ccb8bc44cde030de6c579df2ee7bed0/homeassistant/components/climate/const.py#L6
@@ -36,7 +237,7 @@ def _get_state(entity_id: str) -> Union[str, None]:
         elif entity_state == "off":
             return entity_state
         else:
-            log.error(
+            Log.error(
                 f"Entity {entity_id} state for climate domain not supported: {entity_state}"
             )
             return None
@@ -45,78 +246,261 @@ def _get_state(entity_id: str) -> Union[str, None]:
         return entity_state
 
 
-def _turn_off(entity_id: str) -> bool:
+class ActionQueue:
+    """
+    Collects the actions (switching, setting current) of a control tick and sends them as one service call per domain,
+    service and value with a list of entity IDs.
+
+    While a queue is active, _turn_on(), _turn_off() and _set_value() only enqueue the action and return True. The
+    per-entity result is passed to the optional on_result callback when the queue is flushed. If an entity gets
+    several actions within one tick, only the last one is sent, the callbacks of the superseded ones get None.
+    """
+
+    # order of the services when flushing: appliances are switched on before their current is set, and their current
+    # is set (e.g. to 0 for deactivating) before they are switched off
+    ORDER = {"turn_on": 0, "set_value": 1, "turn_off": 2}
+
+    # queue of the currently running tick (None outside of a tick)
+    active = None
+    # number of service calls sent by the last flushed queue
+    last_calls = 0
+
+    # error messages per service, as logged when an action fails
+    ERRORS = {
+        "turn_on": "Cannot switch on appliance",
+        "turn_off": "Cannot switch off appliance",
+        "set_value": "Cannot set value",
+    }
+
+    def __init__(self):
+        # entity_id -> [domain, service name, value, on_result callback], in order of the first action per entity
+        self.actions = {}
+
+    @staticmethod
+    def begin():
+        """
+        Starts collecting actions.
+
+        :return:    The new active queue
+        """
+        ActionQueue.active = ActionQueue()
+        return ActionQueue.active
+
+    @staticmethod
+    def flush(queue=None):
+        """
+        Stops collecting actions and sends all collected actions, grouped by domain, service and value. Groups are
+        sent by service (see ORDER), groups of the same service in the order of their first action.
+
+        :param queue:   Queue returned by begin(), the active one if None. A queue which is no longer active is sent
+                        all the same.
+        """
+        if queue is None:
+            queue = ActionQueue.active
+        if ActionQueue.active is queue:
+            ActionQueue.active = None
+        if queue is None:
+            return
+        groups = {}
+        for entity_id, action in queue.actions.items():
+            groups.setdefault((action[0], action[1], action[2]), []).append(entity_id)
+        calls = 0
+        for key in sorted(groups, key=lambda key: ActionQueue.ORDER[key[1]]):
+            entity_ids = groups[key]
+            domain, name, value = key
+            results = ActionQueue.send(domain, name, value, entity_ids)
+            calls += results.pop("calls")
+            for entity_id in entity_ids:
+                on_result = queue.actions[entity_id][3]
+                if on_result is not None:
+                    on_result(results[entity_id])
+        ActionQueue.last_calls = calls
+        if calls:
+            Log.debug(
+                lambda: f"Sent {len(queue.actions)} actions with {calls} service calls."
+            )
+
+    @staticmethod
+    def send(domain: str, name: str, value, entity_ids: list) -> dict:
+        """
+        Calls a service for a list of entities. If the combined call fails, each entity is retried individually to
+        determine the per-entity results.
+
+        :param domain:      Service domain
+        :param name:        Service name
+        :param value:       Value for set_value, None for other services
+        :param entity_ids:  Entity IDs
+        :return:            Dict of entity_id -> success, plus the number of sent service calls as "calls"
+        """
+        kwargs = {} if value is None else {"value": value}
+        error = ActionQueue.ERRORS[name] + (f' "{value}"' if value is not None else "")
+        target = entity_ids if len(entity_ids) > 1 else entity_ids[0]
+        try:
+            service.call(domain, name, entity_id=target, **kwargs)
+        except Exception as e:
+            if len(entity_ids) == 1:
+                Log.error(f"{error}: {e}")
+                return {entity_ids[0]: False, "calls": 1}
+        else:
+            return {**dict.fromkeys(entity_ids, True), "calls": 1}
+        results = {"calls": 1}
+        for entity_id in entity_ids:
+            try:
+                service.call(domain, name, entity_id=entity_id, **kwargs)
+            except Exception as e:
+                Log.error(f"{error}: {e}")
+                results[entity_id] = False
+            else:
+                results[entity_id] = True
+            results["calls"] += 1
+        return results
+
+
+# cache of service.has_service() results per domain and service name
+_service_cache = {}
+
+
+def _has_service(domain: str, name: str) -> bool:
+    """
+    Cached check if a service exists. The cache of a domain is invalidated, when services of that domain are
+    registered or removed.
+
+    :param domain:  Service domain
+    :param name:    Service name
+    :return:        True if the service exists
+    """
+    services = _service_cache.setdefault(domain, {})
+    if name not in services:
+        services[name] = service.has_service(domain, name)
+    return services[name]
+
+
+@event_trigger("service_registered")
+def _service_registered(domain=None, **kwargs):
+    _service_cache.pop(domain, None)
+
+
+@event_trigger("service_removed")
+def _service_removed(domain=None, **kwargs):
+    _service_cache.pop(domain, None)
+
+
+def _call_service(
+    domain: str, name: str, entity_id: str, value=None, on_result=None
+) -> bool:
+    """
+    Calls a service for an entity, or enqueues the call if an action queue is active.
+
+    :param domain:      Service domain
+    :param name:        Service name
+    :param entity_id:   ID of the entity
+    :param value:       Value for set_value, None for other services
+    :param on_result:   Optional callback, called with the result once the action has been sent, or with None if it was
+                        superseded by a later action within the same tick
+    :return:            True if the call succeeded or was enqueued, False otherwise
+    """
+    queue = ActionQueue.active
+    if queue is not None:
+        # drop a previous action of this entity, so that the last one wins
+        previous = queue.actions.pop(entity_id, None)
+        if previous is not None and previous[3] is not None:
+            superseded = previous[3]
+            latest = on_result
+
+            def on_result(success):
+                # the dropped action is never sent, its callback learns that when the queue is flushed
+                superseded(None)
+                if latest is not None:
+                    latest(success)
+
+        queue.actions[entity_id] = [domain, name, value, on_result]
+        return True
+    success = ActionQueue.send(domain, name, value, [entity_id])[entity_id]
+    if on_result is not None:
+        on_result(success)
+    return success
+
+
+def _turn_off(entity_id: str, on_result=None) -> bool:
     """
     Switches an entity off
 
     :param entity_id: ID of the entity
+    :param on_result: Optional callback, called with the result once the action has been sent
     """
     # get entity domain
     domain = entity_id.split(".")[0]
     # check if service exists:
-    if not service.has_service(domain, "turn_off"):
-        log.error(
+    if not _has_service(domain, "turn_off"):
+        Log.error(
             f'Cannot switch off appliance: Service "{domain}.turn_off" does not exist.'
         )
         return False
 
-    try:
-        service.call(domain, "turn_off", entity_id=entity_id)
-    except Exception as e:
-        log.error(f"Cannot switch off appliance: {e}")
-        return False
-    else:
+    if _call_service(domain, "turn_off", entity_id, on_result=on_result):
+        StateSnapshot.record(entity_id, "off")
         return True
+    return False
 
 
-def _turn_on(entity_id: str) -> bool:
+def _turn_on(entity_id: str, on_result=None) -> bool:
     """
     Switches an entity on
 
     :param entity_id: ID of the entity
+    :param on_result: Optional callback, called with the result once the action has been sent
     """
     # get entity domain
     domain = entity_id.split(".")[0]
     # check if service exists:
-    if not service.has_service(domain, "turn_on"):
-        log.error(
+    if not _has_service(domain, "turn_on"):
+        Log.error(
             f'Cannot switch on appliance: Service "{domain}.turn_on" does not exist.'
         )
         return False
 
-    try:
-        service.call(domain, "turn_on", entity_id=entity_id)
-    except Exception as e:
-        log.error(f"Cannot switch on appliance: {e}")
-        return False
-    else:
+    if _call_service(domain, "turn_on", entity_id, on_result=on_result):
+        StateSnapshot.record(entity_id, "on")
         return True
+    return False
 
 
-def _set_value(entity_id: str, value: Union[int, float, str]) -> bool:
+def _set_value(entity_id: str, value: Union[int, float, str], on_result=None) -> bool:
     """
     Sets a number entity to a specific value
 
     :param entity_id: ID of the entity
     :param value: Numerical value
+    :param on_result: Optional callback, called with the result once the action has been sent
     :return:
     """
     # get entity domain
     domain = entity_id.split(".")[0]
     # check if service exists:
-    if not service.has_service(domain, "set_value"):
-        log.error(
+    if not _has_service(domain, "set_value"):
+        Log.error(
             f'Cannot set value "{value}": Service "{domain}.set_value" does not exist.'
         )
         return False
 
-    try:
-        service.call(domain, "set_value", entity_id=entity_id, value=value)
-    except Exception as e:
-        log.error(f'Cannot set value "{value}": {e}')
-        return False
-    else:
+    if _call_service(domain, "set_value", entity_id, value=value, on_result=on_result):
+        StateSnapshot.record(entity_id, str(value))
         return True
+    return False
+
+
+def _get_last_changed(entity_id: str) -> Union[datetime.datetime, None]:
+    """
+    Get the time of the last state change of an entity in Home Assistant
+
+    :param entity_id:  Name of the entity
+    :return:            Aware datetime if available, else None
+    """
+    snapshot = StateSnapshot.active
+    entity_state = (
+        _read_state(entity_id) if snapshot is None else snapshot.get(entity_id)
+    )
+    return getattr(entity_state, "last_changed", None)
 
 
 def _get_num_state(
@@ -135,7 +519,7 @@ def _get_num_state(
             raise ValueError(f"State is invalid: {state_val}")
         return _validate_number(state_val, return_on_error)
     except Exception as e:
-        log.error(f"_get_num_state failed for '{entity_id}': {e}")
+        Log.error(f"_get_num_state failed for '{entity_id}': {e}")
         return return_on_error
 
 
@@ -158,7 +542,7 @@ def _validate_number(
         else:
             raise ValueError(f"Value {num} not in range: [{min_v}, {max_v}]")
     except (TypeError, ValueError) as e:
-        log.error(f"_validate_number failed for value '{value}': {e}")
+        Log.error(f"_validate_number failed for value '{value}': {e}")
         return return_on_error
 
 
@@ -190,68 +574,183 @@ def _get_time_object(input) -> datetime.time:
         try:
             return datetime.datetime.strptime(input, "%H:%M:%S").time()
         except ValueError as e:
-            log.error(
+            Log.error(
                 f"Invalid time format for appliance_runtime_deadline: {input}. Error: {e}"
             )
             return datetime.time(23, 59, 0)  # Fallback
     else:
-        log.error(
+        Log.error(
             f"Unexpected type for get_time_object function: {type(input)}. Using fallback 23:59."
         )
         return datetime.time(23, 59, 0)
 
 
+@time_trigger("period(now, 10s)")
+def on_time():
+    """
+    Scheduler of the control loop: Runs the tick of all control groups exactly once every 10s.
+    """
+    PvExcessControl.tick()
+
+
 @time_trigger("cron(0 0 * * *)")
 def reset_midnight():
-    log.info("Resetting 'switched_on_today' instance variables.")
-    for e in PvExcessControl.instances.copy().values():
-        inst = e["instance"]
-        inst.switched_on_today = False
-        inst.enforce_minimum_run = False
-        inst.daily_run_time = 0
+    Log.info("Resetting 'switched_on_today' instance variables.")
+    for inst in ControlGroup.all_instances():
+        inst.state.switched_on_today = False
+        inst.state.enforce_minimum_run = False
+        inst.state.daily_run_time = 0
+        inst.state.switch_events_today = 0
         # If appliance is on at reset time, also reset switched_on_time
-        if _get_state(inst.appliance_switch) == "on":
-            inst.switched_on_time = datetime.datetime.now()
+        if _get_state(inst.config.appliance_switch) == "on":
+            inst.state.switched_on_time = datetime.datetime.now()
+        # deadlines of the new day
+        RuntimeDeadlines.update(inst)
 
 
-@time_trigger("cron(*/10 * * * *)")
-def enforce_runtime():
+class RuntimeDeadlines:
     """
-    Enforce minimum runtime dynamically for each appliance based on its specific deadline.
-    Runs every 10 minutes throughout the whole day.
+    Enforces the minimum daily runtime of appliances at their latest activation time, i.e. the runtime deadline minus
+    the remaining minimum runtime. From that moment on, the appliance is kept on until its minimum runtime is met.
+
+    The latest activation time only changes with the daily runtime or the configuration. It is therefore computed
+    when an appliance registers, switches off and at midnight, and kept in a min-heap of wake-ups. A single time
+    trigger waits for the earliest wake-up, so that enforcement starts on time without checking all appliances
+    periodically. Outdated heap entries are skipped when they reach the top.
     """
-    log.debug("Checking enforcement of minimum runtime.")
-    now = datetime.datetime.now()
 
-    for e in PvExcessControl.instances.copy().values():
-        inst = e["instance"]
-        run_time_min = inst.daily_run_time / 60
-        remaining_runtime = inst.appliance_minimum_run_time - run_time_min
+    # (latest activation, sequence no., automation ID)
+    heap = []
+    # automation ID -> current heap entry
+    entries = {}
+    sequence = 0
+    # trigger waiting for the earliest wake-up and its time
+    trigger = None
+    trigger_time = None
+
+    @staticmethod
+    def update(inst):
+        """
+        (Re)computes the latest activation time of an appliance. Enforcement starts right away if it has passed.
+
+        :param inst:    PVExcesscontrol Class instance
+        """
+        RuntimeDeadlines.entries.pop(inst.config.automation_id, None)
+        latest_activation = RuntimeDeadlines._latest_activation(inst)
+        if latest_activation is not None:
+            if datetime.datetime.now() >= latest_activation:
+                RuntimeDeadlines._enforce(inst, latest_activation)
+            else:
+                RuntimeDeadlines.sequence += 1
+                entry = (
+                    latest_activation,
+                    RuntimeDeadlines.sequence,
+                    inst.config.automation_id,
+                )
+                RuntimeDeadlines.entries[inst.config.automation_id] = entry
+                heapq.heappush(RuntimeDeadlines.heap, entry)
+        RuntimeDeadlines._schedule()
+
+    @staticmethod
+    def remove(automation_id: str):
+        """
+        Stops the enforcement of a removed appliance.
+
+        :param automation_id:   Automation ID
+        """
+        if RuntimeDeadlines.entries.pop(automation_id, None) is not None:
+            RuntimeDeadlines._schedule()
+
+    @staticmethod
+    def _latest_activation(inst) -> Union[datetime.datetime, None]:
+        """
+        :param inst:    PVExcesscontrol Class instance
+        :return:        Latest activation time (naive local time, rounded up to whole seconds) to meet the minimum
+                        runtime by the deadline of today, None if the appliance ran long enough
+        """
+        run_time_min = inst.state.daily_run_time / 60
+        remaining_runtime = inst.config.appliance_minimum_run_time - run_time_min
+        if remaining_runtime <= 0:
+            Log.debug(
+                lambda: (
+                    f"Ran for {run_time_min:.1f} out of {inst.config.appliance_minimum_run_time:.1f} minutes minimum runtime, appliance ran long enough, no minimum runtime enforcement"
+                ),
+                inst,
+            )
+            return None
         runtime_deadline = datetime.datetime.combine(
-            now.date(), inst.appliance_runtime_deadline
+            datetime.datetime.now().date(), inst.config.appliance_runtime_deadline
         )
         latest_activation = runtime_deadline - datetime.timedelta(
             minutes=remaining_runtime
         )
-
-        log.debug(
-            f"{inst.log_prefix} Ran for {run_time_min:.1f} out of {inst.appliance_minimum_run_time:.1f} minutes minimum runtime, with a deadline scheduled for {inst.appliance_runtime_deadline}. Hence the latest activation time is currently {latest_activation}"
+        if latest_activation.microsecond:
+            latest_activation = latest_activation.replace(
+                microsecond=0
+            ) + datetime.timedelta(seconds=1)
+        Log.debug(
+            lambda: (
+                f"Ran for {run_time_min:.1f} out of {inst.config.appliance_minimum_run_time:.1f} minutes minimum runtime, with a deadline scheduled for {inst.config.appliance_runtime_deadline}. Hence the latest activation time is currently {latest_activation}"
+            ),
+            inst,
         )
+        return latest_activation
 
-        if remaining_runtime > 0:
-            if now >= latest_activation:
-                log.info(
-                    f"{inst.log_prefix} Minimum runtime not met, turning on appliance to reach charging deadline at {runtime_deadline}."
-                )
-                inst.enforce_minimum_run = True
-            else:
-                log.debug(
-                    f"{inst.log_prefix} Still {remaining_runtime:.1f} minutes left to reach required minimum runtime but sufficient time left before forced activation is needed to reach deadline at {runtime_deadline}."
-                )
-        else:
-            log.debug(
-                f"{inst.log_prefix} Ran for {run_time_min:.1f} out of {inst.appliance_minimum_run_time:.1f} minutes minimum runtime, appliance ran long enough, no minimum runtime enforcement"
+    @staticmethod
+    def _enforce(inst, latest_activation: datetime.datetime):
+        """
+        Keeps the appliance on until its minimum runtime is met, see PvExcessControl._control_pass().
+        """
+        if not inst.state.enforce_minimum_run:
+            Log.info(
+                "Minimum runtime not met, turning on appliance to reach runtime deadline.",
+                inst,
+                latest_activation=latest_activation.isoformat(timespec="seconds"),
+                deadline=inst.config.appliance_runtime_deadline,
             )
+        inst.state.enforce_minimum_run = True
+
+    @staticmethod
+    def _schedule():
+        """
+        Drops outdated entries from the top of the heap and (re)creates the trigger for the earliest wake-up.
+        """
+        heap = RuntimeDeadlines.heap
+        while heap and RuntimeDeadlines.entries.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+        if not heap:
+            RuntimeDeadlines.trigger = None
+            RuntimeDeadlines.trigger_time = None
+            return
+        wake_up = heap[0][0]
+        if wake_up == RuntimeDeadlines.trigger_time:
+            return
+
+        @time_trigger(f"once({wake_up:%Y/%m/%d %H:%M:%S})")
+        def on_deadline():
+            RuntimeDeadlines.fire()
+
+        # the trigger stops once it is no longer referenced
+        RuntimeDeadlines.trigger = on_deadline
+        RuntimeDeadlines.trigger_time = wake_up
+
+    @staticmethod
+    def fire():
+        """
+        Starts the enforcement of all appliances whose latest activation time has come.
+        """
+        now = datetime.datetime.now()
+        heap = RuntimeDeadlines.heap
+        RuntimeDeadlines.trigger_time = None
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if RuntimeDeadlines.entries.get(entry[2]) is not entry:
+                continue
+            del RuntimeDeadlines.entries[entry[2]]
+            inst = ControlGroup.find(entry[2])
+            if inst is not None:
+                RuntimeDeadlines._enforce(inst, entry[0])
+        RuntimeDeadlines._schedule()
 
 
 @service
@@ -293,6 +792,10 @@ def pv_excess_control(
     appliance_minimum_run_time,
     appliance_runtime_deadline,
     enabled,
+    allocation_mode="greedy",
+    control_group=None,
+    current_control="step",
+    current_slew_rate=2,
 ):
     automation_id = (
         automation_id[11:] if automation_id[:11] == "automation." else automation_id
@@ -339,944 +842,3644 @@ def pv_excess_control(
         appliance_minimum_run_time,
         appliance_runtime_deadline,
         enabled,
+        allocation_mode,
+        control_group,
+        current_control,
+        current_slew_rate,
     )
 
 
-class PvExcessControl:
-    # TODO:
-    #  - What about other domains than switches? Enable use of other domains (e.g. light, ...)
-    #  - Make min_excess_power configurable via blueprint
-    #  - Implement updating of pv sensors history more often. E.g. every 10secs, and averaging + adding to history every minute.
-    instances = {}
-    export_power = None
-    pv_power = None
-    load_power = None
-    home_battery_level = None
-    grid_voltage = None
-    import_export_power = None
-    home_battery_capacity = None
-    solar_production_forecast = None
-    time_of_sunset = None
-    min_home_battery_level = None
-    # Exported Power history
-    export_history = [0] * 60
-    export_history_buffer = []
-    # PV Excess history (PV power minus load power)
-    pv_history = [0] * 60
-    pv_history_buffer = []
-    # Load history (PV power minus load power)
-    load_history = [0] * 60
-    load_history_buffer = []
-    # Minimum excess power in watts. If the average min_excess_power at the specified appliance switch interval is greater than the actual
-    #  excess power, the appliance with the lowest priority will be shut off.
-    #  NOTE: Should be slightly negative, to compensate for inaccurate power corrections
-    #  WARNING: Do net set this to more than 0, otherwise some devices with dynamic current control will abruptly get switched off in some
-    #  situations.
-    min_excess_power = -10
-    on_time_counter = 0
+class Metrics:
+    """
+    Runtime metrics of the controller, published as Home Assistant sensors once a minute after the control pass, to
+    allow dashboards and alerts when the loop slows down or the history update keeps failing:
 
-    def __init__(
-        self,
-        automation_id,
-        appliance_priority,
-        export_power,
-        pv_power,
-        load_power,
-        home_battery_level,
-        min_home_battery_level,
-        min_home_battery_level_start,
-        zero_feed_in,
-        zero_feed_in_load,
-        zero_feed_in_level,
-        dynamic_current_appliance,
-        round_target_current,
-        deactivating_current,
-        appliance_current_interval,
-        appliance_phases,
-        min_current,
-        max_current,
-        min_solar_percent,
-        appliance_switch,
-        appliance_switch_interval,
-        appliance_switch_off_interval,
-        appliance_current_set_entity,
-        actual_power,
-        defined_current,
-        appliance_on_only,
-        grid_voltage,
-        import_export_power,
-        home_battery_capacity,
-        solar_production_forecast,
-        solar_production_forecast_this_hour,
-        time_of_sunset,
-        appliance_once_only,
-        appliance_maximum_run_time,
-        appliance_minimum_run_time,
-        appliance_runtime_deadline,
-        enabled,
-    ):
-        if automation_id not in PvExcessControl.instances:
-            inst = self
+    - <prefix>history_update_duration / <prefix>control_pass_duration: Duration of the last run in ms
+    - <prefix>state_reads / <prefix>service_calls: Count of the last control tick, the total of the last minute is
+      available as attribute
+    - <prefix>switch_events: Successful switching actions today, per appliance switch as attributes
+    - <prefix>history_fill: Share of the power history filled with measured values in %, the lowest of all control
+      groups, per group as attributes
+    - <prefix>history_age: Seconds since the last successful history update, the oldest of all control groups
+    """
+
+    # publish the metrics as sensors
+    enabled = True
+    prefix = "sensor.pv_excess_control_"
+    history_ms = None
+    control_ms = None
+    tick_reads = 0
+    tick_calls = 0
+    minute_reads = 0
+    minute_calls = 0
+
+    @staticmethod
+    def history_updated(group, success: bool):
+        """
+        :param group:   ControlGroup, whose history was updated
+        :param success: True if the history update succeeded
+        """
+        if success:
+            group.history_updates += 1
+            group.history_failures = 0
+            group.last_history_update = datetime.datetime.now(datetime.timezone.utc)
         else:
-            inst = PvExcessControl.instances[automation_id]["instance"]
-        inst.automation_id = automation_id
-        inst.appliance_priority = int(appliance_priority)
-        PvExcessControl.export_power = export_power
-        PvExcessControl.pv_power = pv_power
-        PvExcessControl.load_power = load_power
-        PvExcessControl.home_battery_level = home_battery_level
-        PvExcessControl.grid_voltage = grid_voltage
-        PvExcessControl.import_export_power = import_export_power
-        PvExcessControl.home_battery_capacity = home_battery_capacity
-        PvExcessControl.solar_production_forecast = solar_production_forecast
-        PvExcessControl.solar_production_forecast_this_hour = (
-            solar_production_forecast_this_hour
+            group.history_failures += 1
+
+    @staticmethod
+    def tick(control_tick: bool):
+        """
+        Collects the state reads and service calls of a finished tick. Publishes the metrics after a control tick.
+
+        :param control_tick:    True if the control pass ran in this tick
+        """
+        snapshot = StateSnapshot.last
+        reads = snapshot.reads if snapshot is not None else 0
+        Metrics.minute_reads += reads
+        Metrics.minute_calls += ActionQueue.last_calls
+        if not control_tick:
+            return
+        Metrics.tick_reads = reads
+        Metrics.tick_calls = ActionQueue.last_calls
+        if Metrics.enabled:
+            Metrics.publish()
+        Metrics.minute_reads = 0
+        Metrics.minute_calls = 0
+
+    @staticmethod
+    def publish():
+        """
+        Writes all metrics to their sensors.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        prefix = Metrics.prefix
+        Metrics._set(
+            f"{prefix}history_update_duration",
+            Metrics.history_ms,
+            unit_of_measurement="ms",
         )
-        PvExcessControl.time_of_sunset = time_of_sunset
-        PvExcessControl.min_home_battery_level = float(min_home_battery_level)
-        PvExcessControl.min_home_battery_level_start = bool(
-            min_home_battery_level_start
+        Metrics._set(
+            f"{prefix}control_pass_duration",
+            Metrics.control_ms,
+            unit_of_measurement="ms",
         )
-        PvExcessControl.zero_feed_in = bool(zero_feed_in)
-        PvExcessControl.zero_feed_in_load = zero_feed_in_load
-        PvExcessControl.zero_feed_in_level = float(zero_feed_in_level)
-
-        inst.dynamic_current_appliance = bool(dynamic_current_appliance)
-        inst.round_target_current = bool(round_target_current)
-        inst.deactivating_current = bool(deactivating_current)
-        inst.appliance_current_interval = int(appliance_current_interval)
-        inst.min_current = float(min_current)
-        inst.max_current = float(max_current)
-        inst.appliance_switch = appliance_switch
-        inst.appliance_switch_interval = int(appliance_switch_interval)
-        inst.appliance_switch_off_interval = int(appliance_switch_off_interval)
-        inst.appliance_current_set_entity = appliance_current_set_entity
-        inst.actual_power = actual_power
-        inst.previous_current_buffer = 0
-        inst.defined_current = float(defined_current)
-        inst.appliance_on_only = bool(appliance_on_only)
-        inst.appliance_once_only = appliance_once_only
-        inst.appliance_maximum_run_time = appliance_maximum_run_time
-        inst.appliance_minimum_run_time = appliance_minimum_run_time
-        inst.appliance_runtime_deadline = _get_time_object(appliance_runtime_deadline)
-        inst.enforce_minimum_run = False
-        inst.min_solar_percent = min_solar_percent / 100
-        inst.enabled = enabled
-        inst.phases = (
-            int(appliance_phases)
-            if appliance_phases and str(appliance_phases).isdigit()
-            else 1
+        Metrics._set(
+            f"{prefix}state_reads", Metrics.tick_reads, last_minute=Metrics.minute_reads
         )
-        inst.log_prefix = f"[{inst.appliance_switch} {inst.automation_id} (Prio {inst.appliance_priority})]"
-        inst.domain = inst.appliance_switch.split(".")[0]
-
+        Metrics._set(
+            f"{prefix}service_calls",
+            Metrics.tick_calls,
+            last_minute=Metrics.minute_calls,
+        )
+        events = {}
+        for inst in ControlGroup.all_instances():
+            events[inst.config.appliance_switch] = inst.state.switch_events_today
+        Metrics._set(f"{prefix}switch_events", sum(events.values()), **events)
+        fill = {}
+        updates = []
+        failures = 0
+        for group in ControlGroup.groups.values():
+            capacity = group.pv_history.capacity
+            fill[group.name] = round(
+                100 * min(group.history_updates, capacity) / capacity
+            )
+            updates.append(group.last_history_update)
+            failures = max(failures, group.history_failures)
+        # unknown as long as any group has not been updated yet
+        oldest = None if not updates or None in updates else min(updates)
+        Metrics._set(
+            f"{prefix}history_fill",
+            min(fill.values()) if fill else None,
+            unit_of_measurement="%",
+            **fill,
+        )
+        Metrics._set(
+            f"{prefix}history_age",
+            None if oldest is None else round((now - oldest).total_seconds()),
+            unit_of_measurement="s",
+            last_update=None if oldest is None else oldest.isoformat(),
+            consecutive_failures=failures,
+        )
+
+    @staticmethod
+    def _set(entity_id: str, value, **attributes):
+        try:
+            state.set(entity_id, "unknown" if value is None else value, **attributes)
+        except Exception as e:
+            Log.error(f"Could not publish metric {entity_id}: {e}")
+
+
+@pyscript_compile
+def _read_file(path: str):
+    """
+    Reads a text file (native Python, run with task.executor).
+
+    :param path:    File path
+    :return:        File content, None if the file does not exist
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+@pyscript_compile
+def _write_file(path: str, text: str):
+    """
+    Replaces a text file atomically (native Python, run with task.executor): The content is written to a temporary
+    file, which then replaces the file. Readers see either the old or the new content, never a partial one.
+
+    :param path:    File path
+    :param text:    New content
+    """
+    import os
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+@pyscript_compile
+def _read_recorder_states(db_path: str, entity_ids: list, start_ts: float):
+    """
+    Reads the recorded states of the given entities since start_ts from the SQLite database of the Home Assistant
+    recorder (native Python, run with task.executor). All entities are read with a single query, which includes the
+    last state of each entity before start_ts. Requires the database schema of Home Assistant 2023.4 or greater.
+
+    :param db_path:     Path of the recorder database
+    :param entity_ids:  Entity IDs to read
+    :param start_ts:    Start time as timestamp in seconds
+    :return:            Dict of entity ID -> list of (timestamp, state), oldest first. None if the database does not
+                        exist.
+    """
+    import contextlib
+    import os
+    import sqlite3
+
+    if not os.path.exists(db_path):
+        return None
+    placeholders = ",".join(["?"] * len(entity_ids))
+    query = (
+        "SELECT m.entity_id, s.last_updated_ts, s.state FROM states s "
+        "JOIN states_meta m ON s.metadata_id = m.metadata_id "
+        f"WHERE m.entity_id IN ({placeholders}) AND (s.last_updated_ts >= ? OR s.state_id IN ("
+        "SELECT MAX(s2.state_id) FROM states s2 JOIN states_meta m2 ON s2.metadata_id = m2.metadata_id "
+        f"WHERE m2.entity_id IN ({placeholders}) AND s2.last_updated_ts < ? GROUP BY s2.metadata_id)) "
+        "ORDER BY s.last_updated_ts"
+    )
+    params = [*entity_ids, start_ts, *entity_ids, start_ts]
+    # read-only, the recorder keeps writing to the database
+    with contextlib.closing(
+        sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=10)
+    ) as connection:
+        rows = connection.execute(query, params).fetchall()
+    points = {}
+    for entity_id, timestamp, state in rows:
+        points.setdefault(entity_id, []).append((timestamp, state))
+    return points
+
+
+class StateStore:
+    """
+    Persists the controller state across restarts of Home Assistant and reloads of pyscript: The power histories and
+    the load and solar profiles per control group and per appliance the daily runtime, switching bookkeeping and
+    interval counters.
+
+    The state is saved as compact JSON (a few KB) after each control pass. It is only written if it changed, and
+    without forcing a sync to disk, so that writing once a minute does not wear SD cards. The snapshot is loaded on the
+    first registration, each control group is restored when it is created and each appliance when it registers. Daily values are
+    only restored on the same day, histories only if the snapshot is younger than the history length.
+    """
+
+    # snapshot file, defaults to pyscript/pv_excess_control_state.json in the Home Assistant config folder
+    path = None
+    enabled = True
+    version = 2
+    loaded = False
+    # saved per appliance state, not yet restored (automation ID -> dict)
+    appliances = {}
+    # saved per group histories, not yet restored (group name -> dict)
+    groups = {}
+    # minutes since the snapshot was saved
+    age = 0
+    last_text = None
+    failed = False
+
+    @staticmethod
+    def file_path() -> str:
+        if StateStore.path is None:
+            try:
+                StateStore.path = hass.config.path(
+                    "pyscript", "pv_excess_control_state.json"
+                )
+            except NameError:
+                # hass is only available with hass_is_global enabled in the pyscript configuration
+                StateStore.path = "/config/pyscript/pv_excess_control_state.json"
+        return StateStore.path
+
+    @staticmethod
+    def load():
+        """
+        Loads the snapshot once. Version 1 snapshots (before control groups) are restored into the default group.
+        """
+        if StateStore.loaded or not StateStore.enabled:
+            return
+        StateStore.loaded = True
+        try:
+            text = task.executor(_read_file, StateStore.file_path())
+            if text is None:
+                return
+            snapshot = json.loads(text)
+            if snapshot.get("version") == 1:
+                snapshot["groups"] = {
+                    ControlGroup.DEFAULT: {
+                        **snapshot["histories"],
+                        "history_updates": snapshot["history_updates"],
+                    }
+                }
+            elif snapshot.get("version") != StateStore.version:
+                raise ValueError(f"Unsupported version {snapshot.get('version')}")
+            saved = datetime.datetime.fromisoformat(snapshot["time"])
+            now = datetime.datetime.now(datetime.timezone.utc)
+            StateStore.age = max(0, int((now - saved).total_seconds() // 60))
+            if snapshot["date"] == datetime.datetime.now().date().isoformat():
+                StateStore.appliances = snapshot["appliances"]
+            StateStore.groups = snapshot["groups"]
+        except Exception as e:
+            Log.error(f"Could not restore state from {StateStore.path}: {e}")
+            return
+        Log.info(
+            "Restored state.",
+            age_minutes=StateStore.age,
+            groups=len(StateStore.groups),
+            appliances=len(StateStore.appliances),
+        )
+
+    @staticmethod
+    def restore_group(group):
+        """
+        Restores the load and solar profiles and the power histories of a newly created control group. The histories are
+        shifted by the minutes passed since the snapshot, the last saved values are assumed for the missed minutes.
+
+        :param group:   ControlGroup
+        """
+        saved = StateStore.groups.pop(group.name, None)
+        if saved is None:
+            return
+        for key, profile in (
+            ("load_profile", group.load_profile),
+            ("solar_profile", group.solar_profile),
+        ):
+            if saved.get(key):
+                try:
+                    profile.restore(saved[key])
+                except Exception as e:
+                    Log.error(f"Could not restore {key}: {e}", group=group.name)
+        missed = StateStore.age
+        try:
+            histories = (
+                (group.export_history, saved["export"]),
+                (group.pv_history, saved["pv"]),
+                (group.load_history, saved["load"]),
+            )
+            for history, values in histories:
+                if missed >= history.capacity or not values:
+                    return
+            for history, values in histories:
+                history.restore(values[missed:] + [values[-1]] * missed)
+            group.history_updates = int(saved["history_updates"])
+        except Exception as e:
+            Log.error(f"Could not restore control group state: {e}", group=group.name)
+            return
+        group.restored_histories = True
+
+    @staticmethod
+    def restore_appliance(inst):
+        """
+        Restores the saved state of a newly registered appliance, if available.
+
+        :param inst:    PVExcesscontrol Class instance
+        """
+        saved = StateStore.appliances.pop(inst.config.automation_id, None)
+        if saved is None:
+            return
+        try:
+            inst.state.daily_run_time = float(saved["daily_run_time"])
+            inst.state.switched_on_today = bool(saved["switched_on_today"])
+            inst.state.switched_on_time = datetime.datetime.fromisoformat(
+                saved["switched_on_time"]
+            )
+            inst.state.switch_events_today = int(saved["switch_events_today"])
+            # the counters count control passes, i.e. minutes
+            inst.state.switch_interval_counter = (
+                int(saved["switch_interval_counter"]) + StateStore.age
+            )
+            inst.state.current_interval_counter = (
+                int(saved["current_interval_counter"]) + StateStore.age
+            )
+        except Exception as e:
+            Log.error(f"Could not restore appliance state: {e}", inst)
+            return
+        Log.info(
+            "Restored appliance state.",
+            inst,
+            run_minutes=round(inst.state.daily_run_time / 60, 1),
+        )
+
+    @staticmethod
+    def save():
+        """
+        Saves the current state, if it changed since the last save.
+        """
+        if not StateStore.enabled:
+            return
+        appliances = {}
+        for inst in ControlGroup.all_instances():
+            appliances[inst.config.automation_id] = {
+                "daily_run_time": round(inst.state.daily_run_time, 1),
+                "switched_on_today": inst.state.switched_on_today,
+                "switched_on_time": inst.state.switched_on_time.isoformat(
+                    timespec="seconds"
+                ),
+                "switch_events_today": inst.state.switch_events_today,
+                "switch_interval_counter": inst.state.switch_interval_counter,
+                "current_interval_counter": inst.state.current_interval_counter,
+            }
+        groups = {}
+        for name, group in ControlGroup.groups.items():
+            groups[name] = {
+                "export": [round(x) for x in group.export_history.values()],
+                "pv": [round(x) for x in group.pv_history.values()],
+                "load": [round(x) for x in group.load_history.values()],
+                "history_updates": min(
+                    group.history_updates, group.pv_history.capacity
+                ),
+                "load_profile": group.load_profile.encode(),
+                "solar_profile": group.solar_profile.encode(),
+            }
+        snapshot = {
+            "version": StateStore.version,
+            "groups": groups,
+            "appliances": appliances,
+        }
+        text = json.dumps(snapshot, separators=(",", ":"))
+        if text == StateStore.last_text:
+            return
+        # the time is only needed if anything else changed
+        now = datetime.datetime.now(datetime.timezone.utc)
+        snapshot["time"] = now.isoformat(timespec="seconds")
+        snapshot["date"] = datetime.datetime.now().date().isoformat()
+        try:
+            task.executor(
+                _write_file,
+                StateStore.file_path(),
+                json.dumps(snapshot, separators=(",", ":")),
+            )
+        except Exception as e:
+            if not StateStore.failed:
+                Log.error(f"Could not save state to {StateStore.path}: {e}")
+            StateStore.failed = True
+            return
+        StateStore.failed = False
+        StateStore.last_text = text
+
+
+@pyscript_compile
+def _history_window_sum(
+    prefix: list, total: float, count: int, pending: list, n: int
+) -> float:
+    """
+    Sums up the most recent n values of a PowerHistory (native Python).
+
+    :param prefix:  Prefix sums of the history (capacity + 1 entries)
+    :param total:   Sum of all appended values
+    :param count:   Total number of appended values
+    :param pending: Pending adjustments as [first value no., offset]
+    :param n:       Window length, at most the capacity
+    :return:        Window sum including the pending adjustments
+    """
+    window_sum = total - prefix[(count - n) % len(prefix)]
+    # add pending offsets by the number of values they share with the window
+    for first, value in pending:
+        shared = count - first
+        window_sum += value * (n if n < shared else shared)
+    return window_sum
+
+
+@pyscript_compile
+def _history_fold(ring: list, count: int, pending: list, floor) -> int:
+    """
+    Folds pending adjustments into the ring buffer of a PowerHistory, in place (native Python).
+
+    :param ring:    Ring buffer
+    :param count:   Total number of appended values
+    :param pending: Pending adjustments as [first value no., offset], in the order they were recorded
+    :param floor:   Lower limit of adjusted values, None for no limit
+    :return:        Value no. of the first changed value
+    """
+    capacity = len(ring)
+    first = min([adj[0] for adj in pending])
+    if floor is None:
+        # difference array: each offset applies from its first value onwards
+        offsets = [0] * (count - first)
+        for adj in pending:
+            offsets[adj[0] - first] += adj[1]
+        offset = 0
+        for k in range(first, count):
+            offset += offsets[k - first]
+            ring[k % capacity] += offset
+    else:
+        for k in range(first, count):
+            i = k % capacity
+            x = ring[i]
+            for adj in pending:
+                if k >= adj[0]:
+                    x = max(floor, x + adj[1])
+            ring[i] = x
+    return first
+
+
+@pyscript_compile
+def _history_prefix(ring: list, prefix: list, count: int, n: int) -> float:
+    """
+    Recalculates the prefix sums of the most recent n values of a PowerHistory, in place (native Python).
+
+    :param ring:    Ring buffer
+    :param prefix:  Prefix sums (capacity + 1 entries)
+    :param count:   Total number of appended values
+    :param n:       Number of most recent values which changed
+    :return:        Sum of all appended values
+    """
+    capacity = len(ring)
+    m = capacity + 1
+    if n >= capacity:
+        # restart summing at the oldest value
+        start = count - capacity
+        prefix[start % m] = 0
+    else:
+        start = count - n
+    total = prefix[start % m]
+    for k in range(start, count):
+        total += ring[k % capacity]
+        prefix[(k + 1) % m] = total
+    return total
+
+
+class PowerHistory:
+    """
+    Fixed-capacity history of one-minute power averages (oldest value first).
+
+    The values are kept in a ring buffer together with running prefix sums, so that the sum or average over the
+    most recent n values costs O(1), independent of the window length.
+
+    Adjustments of the most recent values (see adjust()) are only recorded as pending offsets and applied lazily:
+    Without a lower limit, pending offsets are added to window sums when they are read. With a lower limit, each
+    offset has to be clamped value by value in the order they were recorded, so pending offsets are folded into the
+    buffer once on the next read. The loops over the values run natively, see _history_window_sum(), _history_fold()
+    and _history_prefix().
+    """
+
+    def __init__(self, capacity: int = 60, floor: Union[float, None] = None):
+        self.capacity = capacity
+        # optional lower limit for adjusted values
+        self.floor = floor
+        self.ring = [0] * capacity
+        # prefix[k % (capacity + 1)] holds the sum of all values appended before value no. k. Keeping capacity + 1
+        # prefix sums allows differences over any window of up to capacity values.
+        self.prefix = [0] * (capacity + 1)
+        # total number of appended values, the history starts filled with zeros
+        self.count = capacity
+        self.total = 0
+        # pending adjustments as [first value no., offset], in the order they were recorded. Each one covers all
+        # values from its first value no. up to the most recent value.
+        self.pending = []
+
+    def append(self, value: float):
+        """
+        Appends a value to the history, dropping the oldest one.
+
+        :param value:   Value to append
+        """
+        if self.pending:
+            self._apply_pending()
+        self.ring[self.count % self.capacity] = value
+        self.count += 1
+        if self.count % self.capacity == 0:
+            # rebuild prefix sums once per round to keep floating point errors from accumulating
+            self._rebuild_prefix(self.capacity)
+        else:
+            self.total += value
+            self.prefix[self.count % (self.capacity + 1)] = self.total
+
+    def adjust(self, value: float, n: int):
+        """
+        Adds a value to each of the most recent n history values (limited to the lower limit, if any). The adjustment
+        is recorded in O(1) and applied lazily.
+
+        :param value:   Value to add (can be positive or negative)
+        :param n:       Number of most recent values to adjust
+        """
+        n = max(0, min(n, self.capacity))
+        if n > 0:
+            self.pending.append([self.count - n, value])
+
+    def window_sum(self, n: int) -> float:
+        """
+        :param n:   Number of most recent values (window length in minutes)
+        :return:    Sum of the most recent n values
+        """
+        if self.pending and self.floor is not None:
+            self._apply_pending()
+        return _history_window_sum(
+            self.prefix,
+            self.total,
+            self.count,
+            self.pending,
+            max(0, min(n, self.capacity)),
+        )
+
+    def window_avg(self, n: int) -> int:
+        """
+        :param n:   Number of most recent values (window length in minutes)
+        :return:    Average of the most recent n values, truncated to an integer
+        """
+        return int(self.window_sum(n) / max(1, n))
+
+    def values(self) -> list:
+        """
+        :return:    History values as list, oldest value first
+        """
+        if self.pending:
+            self._apply_pending()
+        start = self.count % self.capacity
+        return self.ring[start:] + self.ring[:start]
+
+    def restore(self, values: list):
+        """
+        Replaces the history, e.g. with saved values.
+
+        :param values:  Values, oldest value first. Missing values are filled with zeros.
+        """
+        values = list(values)[-self.capacity :]
+        self.ring = [0] * (self.capacity - len(values)) + values
+        self.count = self.capacity
+        self.pending = []
+        self._rebuild_prefix(self.capacity)
+
+    def _apply_pending(self):
+        """
+        Folds all pending adjustments into the ring buffer and updates the prefix sums of the affected values.
+        """
+        first = _history_fold(self.ring, self.count, self.pending, self.floor)
+        self.pending = []
+        self._rebuild_prefix(self.count - first)
+
+    def _rebuild_prefix(self, n: int):
+        """
+        Recalculates the prefix sums of the most recent n values.
+
+        :param n:   Number of most recent values which changed
+        """
+        self.total = _history_prefix(self.ring, self.prefix, self.count, n)
+
+
+@pyscript_compile
+def _integrate_power(signal, now: float):
+    """
+    Adds the time since the last update of a PowerIntegrator to its integral (native Python).
+
+    :param signal:  PowerIntegrator
+    :param now:     Timestamp in seconds
+    """
+    if signal.value is not None and signal.since is not None and now > signal.since:
+        area = signal.value * (now - signal.since)
+        signal.area += area
+        signal.duration += now - signal.since
+        signal.total_area += area
+        signal.total_duration += now - signal.since
+    signal.since = now
+
+
+@pyscript_compile
+def _roll_power(signal, now: float):
+    """
+    Closes the current averaging period of a PowerIntegrator and starts a new one (native Python).
+
+    :param signal:  PowerIntegrator
+    :param now:     Timestamp in seconds
+    :return:        Time-weighted average since the previous roll, the current value if no time was covered, or None
+                    if the value is unknown
+    """
+    if signal.value is not None and signal.since is not None and now > signal.since:
+        area = signal.value * (now - signal.since)
+        signal.area += area
+        signal.duration += now - signal.since
+        signal.total_area += area
+        signal.total_duration += now - signal.since
+    signal.since = now
+    avg = signal.area / signal.duration if signal.duration > 0 else signal.value
+    signal.area = 0.0
+    signal.duration = 0.0
+    return avg
+
+
+@pyscript_compile
+def _sample_power(signal, now: float, mark) -> tuple:
+    """
+    Averages a PowerIntegrator since a mark, without closing its averaging period (native Python).
+
+    :param signal:  PowerIntegrator
+    :param now:     Timestamp in seconds
+    :param mark:    Mark returned by the previous sample, None for the first one
+    :return:        Tuple of the time-weighted average since the mark (the current value if no time was covered, None
+                    if the value is unknown) and the new mark
+    """
+    if signal.value is not None and signal.since is not None and now > signal.since:
+        area = signal.value * (now - signal.since)
+        signal.area += area
+        signal.duration += now - signal.since
+        signal.total_area += area
+        signal.total_duration += now - signal.since
+    signal.since = now
+    if mark is not None and signal.total_duration > mark[1]:
+        avg = (signal.total_area - mark[0]) / (signal.total_duration - mark[1])
+    else:
+        avg = signal.value
+    return avg, (signal.total_area, signal.total_duration)
+
+
+class PowerIntegrator:
+    """
+    Time-weighted average of a power signal, which gets updated whenever its source entity changes.
+
+    Between two updates the signal is taken as constant, so each update only adds value * duration to a running
+    integral: Bursts of updates cost O(1) each, without any state reads. While the value is unknown (None), the time
+    is not counted.
+    """
+
+    def __init__(self):
+        self.value = None
+        # timestamp (seconds) of the last update
+        self.since = None
+        self.area = 0.0
+        self.duration = 0.0
+        # integral and covered time since the start, never reset (see sample())
+        self.total_area = 0.0
+        self.total_duration = 0.0
+
+    def update(self, value: Union[float, None], now: float):
+        """
+        :param value:   New value of the signal, None if unknown
+        :param now:     Timestamp of the change in seconds
+        """
+        _integrate_power(self, now)
+        self.value = value
+
+    def roll(self, now: float) -> Union[float, None]:
+        """
+        Closes the current averaging period and starts a new one.
+
+        :param now:     Timestamp in seconds
+        :return:        Time-weighted average since the previous roll, the current value if no time was covered, or
+                        None if the value is unknown
+        """
+        return _roll_power(self, now)
+
+    def sample(self, now: float, mark) -> tuple:
+        """
+        Averages the signal since a previous sample, e.g. over one tick, independently of the averaging period.
+
+        :param now:     Timestamp in seconds
+        :param mark:    Mark returned by the previous sample, None for the first one
+        :return:        Tuple of the time-weighted average since the mark (the current value if no time was covered,
+                        None if the value is unknown) and the new mark
+        """
+        return _sample_power(self, now, mark)
+
+
+def _power_timestamp() -> float:
+    """
+    :return:    Current time in seconds, as used for the power signals
+    """
+    return datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+
+def _minute_averages(points: list, start: float, minutes: int, convert) -> list:
+    """
+    Calculates time-weighted one-minute averages of recorded states.
+
+    :param points:  List of (timestamp, state), oldest first
+    :param start:   Timestamp of the start of the first minute
+    :param minutes: Number of minutes
+    :param convert: Function converting a state to a number, or to None if unknown
+    :return:        List of averages, None for minutes without known value
+    """
+    integrator = PowerIntegrator()
+    averages = []
+    i = 0
+    for m in range(1, minutes + 1):
+        boundary = start + m * 60
+        while i < len(points) and points[i][0] < boundary:
+            integrator.update(convert(points[i][1]), max(points[i][0], start))
+            i += 1
+        averages.append(integrator.roll(boundary))
+    return averages
+
+
+def _recorded_number(value: Union[str, None]) -> Union[float, None]:
+    """
+    :return:    Recorded state as number, None if unknown
+    """
+    if value is None or value in ("unavailable", "unknown", ""):
+        return None
+    return _validate_number(value)
+
+
+@pyscript_compile
+def _profile_energy(
+    values: list, counts: list, slots: int, start: float, periods: list
+) -> list:
+    """
+    Integrates a LoadProfile over consecutive periods (native Python). Buckets which were not learned yet take the
+    average of the same quarter-hour on the learned weekdays.
+
+    :param values:      Average power per bucket in W
+    :param counts:      Learned days per bucket
+    :param slots:       Buckets per day
+    :param start:       Start of the first period in buckets since the start of the profile
+    :param periods:     Lengths of the periods in buckets
+    :return:            Per period, tuple of the energy of the learned buckets in kWh and the hours not learned on any
+                        weekday
+    """
+    result = []
+    position = start
+    for quarters in periods:
+        learned = 0.0
+        unlearned = 0.0
+        end = position + quarters
+        while position < end:
+            step = min(int(position) + 1, end) - position
+            index = int(position) % len(values)
+            if counts[index]:
+                learned += values[index] * step
+            else:
+                total = 0.0
+                days = 0
+                for other in range(index % slots, len(values), slots):
+                    if counts[other]:
+                        total += values[other]
+                        days += 1
+                if days:
+                    learned += total / days * step
+                else:
+                    unlearned += step
+            position += step
+        position = end
+        result.append((learned / 4000, unlearned / 4))
+    return result
+
+
+class LoadProfile:
+    """
+    Learned load of a control group without its controlled appliances, per weekday and quarter-hour, so that the energy
+    used until sunset follows the usual course of the day (e.g. cooking in the evening) instead of the current load.
+
+    Each minute of the load history is added to the bucket of its quarter-hour. When the quarter-hour is over, its
+    average is folded into the bucket as exponentially weighted moving average (EWMA), i.e. the last few weeks count
+    the most. The buckets are kept in arrays, taking a few KB per control group.
+
+    With a single day, the profile learns the course of the solar production instead, see SolarContext.production().
+    """
+
+    # buckets per day
+    slots = 96
+    # weight of a new day in the EWMA, the first days are averaged equally
+    smoothing = 0.3
+    # minimum number of minutes of a quarter-hour to learn from it
+    min_samples = 10
+
+    def __init__(self, days: int = 7):
+        """
+        :param days:    Days of the profile, 7 for one per weekday, 1 for the same course every day
+        """
+        self.days = days
+        # average power in W and learned days (up to 255) per bucket, starting on Monday 00:00
+        self.values = array.array("f", [0.0] * (days * LoadProfile.slots))
+        self.counts = array.array("B", [0] * (days * LoadProfile.slots))
+        # bucket of the running quarter-hour, with the sum and number of its minutes
+        self.bucket = None
+        self.sum = 0.0
+        self.samples = 0
+        # persisted form, see encode()
+        self.encoded = None
+
+    def position(self, moment: datetime.datetime) -> float:
+        """
+        :param moment:  Local time
+        :return:        Buckets since the start of the profile (Monday 00:00 for weekdays)
+        """
+        return (
+            moment.weekday() % self.days * LoadProfile.slots
+            + (moment.hour * 60 + moment.minute + moment.second / 60) / 15
+        )
+
+    def add(self, power: float, moment: datetime.datetime):
+        """
+        Adds a one-minute average of the load.
+
+        :param power:   Load power without the controlled appliances in W
+        :param moment:  Local time of the minute
+        """
+        bucket = int(self.position(moment))
+        if bucket != self.bucket:
+            self._fold()
+            self.bucket = bucket
+        self.sum += max(0, power)
+        self.samples += 1
+
+    def _fold(self):
+        """
+        Folds the average of the running quarter-hour into its bucket.
+        """
+        if self.bucket is not None and self.samples >= LoadProfile.min_samples:
+            i = self.bucket
+            weight = max(LoadProfile.smoothing, 1 / (self.counts[i] + 1))
+            self.values[i] += weight * (self.sum / self.samples - self.values[i])
+            self.counts[i] = min(255, self.counts[i] + 1)
+            self.encoded = None
+        self.sum = 0.0
+        self.samples = 0
+
+    def energy(self, start: datetime.datetime, hours: float) -> tuple:
+        """
+        :param start:   Local start time
+        :param hours:   Length of the period in hours
+        :return:        Tuple of the learned energy in kWh and the hours not learned yet
+        """
+        return self.series(start, [hours])[0]
+
+    def series(self, start: datetime.datetime, steps: list) -> list:
+        """
+        :param start:   Local start time
+        :param steps:   Lengths of consecutive periods in hours
+        :return:        Per period, tuple of the learned energy in kWh and the hours not learned yet
+        """
+        return _profile_energy(
+            self.values,
+            self.counts,
+            LoadProfile.slots,
+            self.position(start),
+            [step * 4 for step in steps],
+        )
+
+    def encode(self) -> str:
+        """
+        :return:    Buckets as base64 text of the rounded powers (2 bytes each) and the learned days (1 byte each),
+                    re-encoded only when a bucket changed
+        """
+        if self.encoded is None:
+            values = array.array(
+                "H", [max(0, min(65535, round(x))) for x in self.values]
+            )
+            self.encoded = base64.b64encode(
+                values.tobytes() + self.counts.tobytes()
+            ).decode("ascii")
+        return self.encoded
+
+    def restore(self, text: str):
+        """
+        :param text:    Buckets as returned by encode()
+        """
+        data = base64.b64decode(text)
+        size = self.days * LoadProfile.slots
+        if len(data) != 3 * size:
+            raise ValueError(f"Invalid profile of {len(data)} bytes")
+        values = array.array("H")
+        values.frombytes(data[: 2 * size])
+        self.values = array.array("f", values)
+        self.counts = array.array("B", data[2 * size :])
+        self.encoded = text
+
+
+class SolarContext:
+    """
+    Solar information of a control group shared by all consumers within a tick: Hours until sunset, the remaining
+    solar production forecasts and the load expected until sunset. It is computed once per tick on first use (see
+    current()). The parsed time of sunset is kept by the group until the state of its sunset entity changes.
+    """
+
+    def __init__(self, group):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.sunset_time = SolarContext._sunset_time(group)
+        if self.sunset_time is None:
+            self.hours_until_sunset = 0
+        else:
+            # zero after dusk, until the sunset entity moves on to the next day
+            self.hours_until_sunset = max(
+                0, (self.sunset_time - now).total_seconds() / (60 * 60)
+            )
+        if group.solar_production_forecast:
+            self.remaining_forecast = _get_num_state(
+                group.solar_production_forecast, return_on_error=0
+            )
+        else:
+            self.remaining_forecast = 0
+        if group.solar_production_forecast_this_hour:
+            self.forecast_this_hour = _get_num_state(
+                group.solar_production_forecast_this_hour, return_on_error=0
+            )
+        else:
+            self.forecast_this_hour = None
+        # learned load until sunset in kWh, and the hours the load profile did not learn yet
+        self.profile_usage, self.unlearned_hours = group.load_profile.energy(
+            datetime.datetime.now(), self.hours_until_sunset
+        )
+
+    def remaining_usage(
+        self, baseline_power: float, appliance_power: float = 0
+    ) -> float:
+        """
+        :param baseline_power:  Load power without the controlled appliances in W, assumed for the hours the load profile
+                                did not learn yet
+        :param appliance_power: Power of the controlled appliances in W, assumed until sunset
+        :return:                Energy used until sunset in kWh
+        """
+        return (
+            self.profile_usage
+            + (
+                self.unlearned_hours * baseline_power
+                + self.hours_until_sunset * appliance_power
+            )
+            / 1000
+        )
+
+    def production(self, group, steps: list, reserve: float = 0) -> list:
+        """
+        Spreads the remaining solar production forecast over consecutive periods from now on. The current hour gets its
+        forecast if configured, the rest follows the course of the day learned by the solar profile of the group (see
+        LoadProfile), or falls as a ramp down to sunset until the profile has learned a full day.
+
+        :param group:   ControlGroup
+        :param steps:   Lengths of the periods in hours
+        :param reserve: Energy in kWh deducted from the remaining forecast
+        :return:        Solar production per period in kWh, zero after sunset
+        """
+        shape = []
+        for learned, unlearned in group.solar_profile.series(
+            datetime.datetime.now(), steps
+        ):
+            if unlearned:
+                shape = None
+                break
+            shape.append(learned)
+        return _spread_forecast(
+            max(0, self.remaining_forecast - reserve),
+            None if self.forecast_this_hour is None else self.forecast_this_hour / 1000,
+            steps,
+            self.hours_until_sunset,
+            shape,
+        )
+
+    @staticmethod
+    def current(group):
+        """
+        :param group:   ControlGroup
+        :return:        Solar context of the running tick of the group, a new one outside of ticks
+        """
+        if StateSnapshot.active is None:
+            return SolarContext(group)
+        if group.solar is None:
+            group.solar = SolarContext(group)
+        return group.solar
+
+    @staticmethod
+    def reset(group):
+        """
+        Discards the context of the last tick of the group.
+
+        :param group:   ControlGroup
+        """
+        group.solar = None
+
+    @staticmethod
+    def _sunset_time(group) -> Union[datetime.datetime, None]:
+        """
+        :param group:   ControlGroup
+        :return:        Time of sunset (aware datetime), None if not configured or invalid
+        """
+        if not group.time_of_sunset:
+            return None
+        sunset_state = _get_state(group.time_of_sunset)
+        if sunset_state != group.sunset_state:
+            group.sunset_state = sunset_state
+            try:
+                sunset_time = datetime.datetime.fromisoformat(sunset_state)
+                if sunset_time.tzinfo is None:
+                    # local time
+                    sunset_time = sunset_time.astimezone(datetime.timezone.utc)
+            except (TypeError, ValueError) as e:
+                Log.error(f"Invalid time of sunset {group.time_of_sunset}: {e}")
+                sunset_time = None
+            group.sunset_time = sunset_time
+        return group.sunset_time
+
+
+class BatteryPlan:
+    """
+    Plans the state of charge of the home battery of a control group hour by hour until sunset, so that it reaches the
+    minimum home battery level by then: The remaining solar production forecast (minus a reserve) is spread over the
+    hours (see SolarContext.production()), and the load is taken from the load profile (see LoadProfile). The plan
+    tells how much appliance power the battery can afford in the current hour, so that only the appliances exceeding it
+    have to be switched off.
+
+    The plan is cached per control group until one of its inputs changes, with the time rounded to quarter-hours.
+    """
+
+    # reserve in kWh, deducted from the remaining solar production forecast
+    reserve = 2
+
+    @staticmethod
+    def affordable_power(group, baseline_power: float) -> float:
+        """
+        :param group:           ControlGroup
+        :param baseline_power:  Load power without the controlled appliances in W, assumed for the hours the load
+                                profile did not learn yet
+        :return:                Power in W the appliances of the group may use in the current hour
+        """
+        solar = SolarContext.current(group)
+        level = _get_num_state(group.home_battery_level, return_on_error=0)
+        capacity = float(group.home_battery_capacity or 0)
+        key = (
+            level,
+            capacity,
+            group.min_home_battery_level,
+            solar.remaining_forecast,
+            solar.forecast_this_hour,
+            int(solar.hours_until_sunset * 4),
+            round(baseline_power, -1),
+        )
+        if group.battery_plan is not None and group.battery_plan[0] == key:
+            return group.battery_plan[1]
+
+        steps = [1] * int(solar.hours_until_sunset)
+        if solar.hours_until_sunset > len(steps):
+            steps.append(solar.hours_until_sunset - len(steps))
+        loads = [
+            learned + unlearned * baseline_power / 1000
+            for learned, unlearned in group.load_profile.series(
+                datetime.datetime.now(), steps
+            )
+        ]
+        affordable, soc_at_sunset = _battery_budget(
+            solar.production(group, steps, BatteryPlan.reserve),
+            steps,
+            loads,
+            capacity * level / 100,
+            capacity,
+            capacity * group.min_home_battery_level / 100,
+        )
+        Log.debug(
+            "Planned home battery charge until sunset.",
+            group=group.name,
+            hours=round(solar.hours_until_sunset, 2),
+            load_kwh=round(sum(loads), 2),
+            soc_at_sunset_kwh=round(soc_at_sunset, 2),
+            affordable_w=round(affordable),
+        )
+        group.battery_plan = (key, affordable)
+        return affordable
+
+
+class RuntimePlanner:
+    """
+    Plans the remaining minimum daily runtimes of the appliances of a control group into the quarter-hours until
+    midnight, so that they run on solar power as much as possible: The solar production forecast (see
+    SolarContext.production()) minus the load profile gives the surplus of each quarter-hour, which the appliances
+    share. Appliances are planned by deadline into the quarter-hours before it covering most of their power, then each
+    one is planned again around the others (see _plan_runtimes()). The control pass switches an appliance on in its
+    planned quarter-hours if there is some excess power (see PvExcessControl._force_minimum_runtime()), RuntimeDeadlines
+    still enforces what is left at the latest activation time.
+
+    The surplus is only recomputed with the next quarter-hour or when the forecasts change, and the plan (one native
+    call for all appliances) only when the surplus changes or a remaining runtime drops to fewer quarter-hours.
+    """
+
+    # length of the planned slots in minutes
+    slot = 15
+    # planning rounds, each following round plans every appliance again around the others
+    rounds = 2
+
+    @staticmethod
+    def update(group, instances: list):
+        """
+        Updates the plan of the control group, called at the start of the control pass.
+
+        :param group:       ControlGroup
+        :param instances:   PVExcesscontrol Class instances with activated automations, highest priority first
+        """
+        now = datetime.datetime.now()
+        demands = []
+        for inst in instances:
+            demand = RuntimePlanner._demand(inst, now)
+            if demand is not None:
+                demands.append(demand)
+        if not demands:
+            group.runtime_plan = None
+            return
+        starts, surplus = RuntimePlanner._surplus(
+            group, now, group.load_history.window_avg(RuntimePlanner.slot)
+        )
+        # the remaining runtime of a running appliance changes every minute, the plan only with each quarter-hour
+        key = (
+            starts[0],
+            surplus,
+            tuple(
+                [
+                    (inst, math.ceil(remaining / RuntimePlanner.slot), power, deadline)
+                    for inst, remaining, power, deadline in demands
+                ]
+            ),
+        )
+        if group.runtime_plan is not None and group.runtime_plan[0] == key:
+            return
+        ends = starts[1:] + [RuntimePlanner._midnight(now)]
+        plans, solar = _plan_runtimes(
+            surplus,
+            [(end - now).total_seconds() / 60 for end in ends],
+            [
+                (remaining, power, (deadline - now).total_seconds() / 60)
+                for inst, remaining, power, deadline in demands
+            ],
+            RuntimePlanner.rounds,
+        )
+        # automation ID -> running quarter-hour planned
+        group.runtime_plan = (
+            key,
+            {
+                demands[i][0].config.automation_id: bool(plans[i]) and plans[i][0] == 0
+                for i in range(len(demands))
+            },
+        )
+        if Log.enabled():
+            for i in range(len(demands)):
+                Log.debug(
+                    "Planned minimum runtime.",
+                    demands[i][0],
+                    remaining_min=demands[i][1],
+                    solar_kwh=round(solar[i], 2),
+                    slots=" ".join([f"{starts[s]:%H:%M}" for s in plans[i]]),
+                )
+
+    @staticmethod
+    def planned(inst) -> bool:
+        """
+        :param inst:    PVExcesscontrol Class instance
+        :return:        True if the running quarter-hour is planned for the minimum runtime of the appliance
+        """
+        plan = inst.group.runtime_plan
+        return plan is not None and plan[1].get(inst.config.automation_id, False)
+
+    @staticmethod
+    def _demand(inst, now: datetime.datetime) -> Union[tuple, None]:
+        """
+        :param inst:    PVExcesscontrol Class instance
+        :param now:     Local time
+        :return:        Tuple of the instance, the remaining minimum runtime in minutes, the power in W and the runtime
+                        deadline, None if nothing is left to plan
+        """
+        if (
+            inst.config.appliance_minimum_run_time == 0
+            or inst.state.enforce_minimum_run
+        ):
+            return None
+        on = _get_state(inst.config.appliance_switch) == "on"
+        if not on and inst.config.appliance_once_only and inst.state.switched_on_today:
+            return None
+        run_time = inst.state.daily_run_time / 60
+        if on:
+            run_time += (now - inst.state.switched_on_time).total_seconds() / 60
+        remaining = math.ceil(inst.config.appliance_minimum_run_time - run_time)
+        deadline = datetime.datetime.combine(
+            now.date(), inst.config.appliance_runtime_deadline
+        )
+        if remaining <= 0 or deadline <= now:
+            return None
+        return inst, remaining, inst.config.defined_power, deadline
+
+    @staticmethod
+    def _midnight(now: datetime.datetime) -> datetime.datetime:
+        return datetime.datetime.combine(
+            now.date() + datetime.timedelta(days=1), datetime.time()
+        )
+
+    @staticmethod
+    def _surplus(group, now: datetime.datetime, baseline_power: float) -> tuple:
+        """
+        :param group:           ControlGroup
+        :param now:             Local time
+        :param baseline_power:  Load power without the controlled appliances in W, assumed for the quarter-hours the
+                                load profile did not learn yet
+        :return:                Tuple of the start times of the quarter-hours until midnight (the running one first)
+                                and the surplus of solar power over the load per quarter-hour in W
+        """
+        solar = SolarContext.current(group)
+        quarter = now.replace(
+            minute=now.minute // RuntimePlanner.slot * RuntimePlanner.slot,
+            second=0,
+            microsecond=0,
+        )
+        key = (
+            quarter,
+            solar.remaining_forecast,
+            solar.forecast_this_hour,
+            solar.sunset_time,
+            round(baseline_power, -2),
+        )
+        if group.runtime_surplus is not None and group.runtime_surplus[0] == key:
+            return group.runtime_surplus[1]
+
+        midnight = RuntimePlanner._midnight(now)
+        starts = [quarter]
+        while starts[-1] + datetime.timedelta(minutes=RuntimePlanner.slot) < midnight:
+            starts.append(starts[-1] + datetime.timedelta(minutes=RuntimePlanner.slot))
+        steps = [
+            (end - max(start, now)).total_seconds() / 3600
+            for start, end in zip(starts, starts[1:] + [midnight])
+        ]
+        production = solar.production(group, steps)
+        loads = group.load_profile.series(now, steps)
+        surplus = tuple(
+            [
+                round(
+                    (production[i] - loads[i][0] - loads[i][1] * baseline_power / 1000)
+                    / steps[i]
+                    * 1000
+                )
+                for i in range(len(steps))
+            ]
+        )
+        group.runtime_surplus = (key, (starts, surplus))
+        return starts, surplus
+
+
+@pyscript_compile
+def _plan_runtimes(surplus: list, ends: list, demands: list, rounds: int) -> tuple:
+    """
+    Plans the remaining runtimes of appliances into slots, so that the solar surplus covers as much of their power as
+    possible (native Python). The appliances are planned in the order of their deadlines, each into the slots before
+    its deadline with the most surplus left for it, the earlier ones on a tie. Every following round plans each
+    appliance again around the others. Appliances running in the same slot share its surplus.
+
+    :param surplus:     Solar surplus per slot in W
+    :param ends:        End of each slot in minutes from now
+    :param demands:     Per appliance, tuple of the remaining runtime in minutes, the power in W and the deadline in
+                        minutes from now
+    :param rounds:      Number of rounds
+    :return:            Tuple of the planned slot indices per appliance (ascending, fewer minutes than its remaining
+                        runtime if the deadline is too close) and the energy covered by the surplus per appliance in kWh
+    """
+    lengths = [ends[i] - (ends[i - 1] if i else 0.0) for i in range(len(ends))]
+    free = [float(x) for x in surplus]
+    order = sorted(range(len(demands)), key=lambda j: demands[j][2])
+    plans = [[] for _ in demands]
+    for _ in range(rounds):
+        for j in order:
+            minutes, power, deadline = demands[j]
+            for i in plans[j]:
+                free[i] += power
+            usable = [i for i in range(len(ends)) if ends[i] <= deadline]
+            usable.sort(key=lambda i: (-min(max(free[i], 0.0), power), i))
+            chosen = []
+            planned = 0.0
+            for i in usable:
+                if planned >= minutes:
+                    break
+                chosen.append(i)
+                planned += lengths[i]
+            chosen.sort()
+            for i in chosen:
+                free[i] -= power
+            plans[j] = chosen
+    free = [float(x) for x in surplus]
+    solar = [0.0] * len(demands)
+    for j in order:
+        power = demands[j][1]
+        for i in plans[j]:
+            solar[j] += min(max(free[i], 0.0), power) * lengths[i] / 60000
+            free[i] -= power
+    return plans, solar
+
+
+@pyscript_compile
+def _solve_allocation(cells: int, items: list) -> list:
+    """
+    Solves the allocation of excess power to appliances (native Python): A knapsack with a capacity of cells, in which
+    each item takes either no cells or kmin to kmax cells. On/off appliances are items with kmin == kmax. The value of
+    an item is value per cell times its cells, plus the bonus if it takes any.
+    Items are added one by one to a table of the best value per used capacity. As the value grows linearly with the
+    cells of an item, the best choice for each capacity is found with a sliding window maximum, so the solution takes
+    O(items * cells) time, independent of the ranges.
+
+    :param cells:   Capacity in cells
+    :param items:   List of (kmin, kmax, value per cell, bonus)
+    :return:        Cells per item, 0 if the item is not taken
+    """
+    import collections
+
+    # best[c]: best value using at most c cells
+    best = [0.0] * (cells + 1)
+    choices = []
+    for kmin, kmax, value, bonus in items:
+        kmin = max(1, kmin)
+        kmax = max(kmin, kmax)
+        new = best[:]
+        choice = [0] * (cells + 1)
+        if kmin == kmax:
+            gain = value * kmin + bonus
+            for c in range(kmin, cells + 1):
+                candidate = best[c - kmin] + gain
+                if candidate > new[c]:
+                    new[c] = candidate
+                    choice[c] = kmin
+            best = new
+            choices.append(choice)
+            continue
+        window = collections.deque()
+        for c in range(kmin, cells + 1):
+            # previous capacities j in [c - kmax, c - kmin], ordered by decreasing best[j] - value * j
+            j = c - kmin
+            key = best[j] - value * j
+            while window and best[window[-1]] - value * window[-1] <= key:
+                window.pop()
+            window.append(j)
+            if window[0] < c - kmax:
+                window.popleft()
+            j = window[0]
+            candidate = best[j] + value * (c - j) + bonus
+            if candidate > new[c]:
+                new[c] = candidate
+                choice[c] = c - j
+        best = new
+        choices.append(choice)
+
+    result = [0] * len(items)
+    c = cells
+    for i in range(len(items) - 1, -1, -1):
+        result[i] = choices[i][c]
+        c -= result[i]
+    return result
+
+
+@pyscript_compile
+def _target_current(
+    power: float,
+    excess_power: float,
+    phase_power: float,
+    min_current: float,
+    max_current: float,
+    round_down: bool,
+) -> tuple:
+    """
+    Calculates the new current of a dynamic current appliance from its power consumption and the excess power
+    (native Python).
+
+    :param power:           Power consumption of the appliance in W
+    :param excess_power:    Average excess power in W, negative to reduce the current
+    :param phase_power:     Power per ampere (grid voltage × phases) in W
+    :param min_current:     Minimum current in A
+    :param max_current:     Maximum current in A
+    :param round_down:      Round the target current down to whole amperes instead of to 0.1 A
+    :return:                Tuple of actual, difference and target current in A
+    """
+    actual_current = round(power / phase_power, 1)
+    diff_current = round(excess_power / phase_power, 1)
+    target_current = max(min_current, min(actual_current + diff_current, max_current))
+    if round_down:
+        target_current = int(target_current)
+    else:
+        target_current = round(target_current, 1)
+    return actual_current, diff_current, target_current
+
+
+@pyscript_compile
+def _pi_current(
+    error: float,
+    integral: float,
+    output: float,
+    proportional_gain: float,
+    integral_step: float,
+    min_current: float,
+    max_current: float,
+    slew_rate: float,
+) -> tuple:
+    """
+    Calculates one step of the PI controller of a dynamic current appliance (native Python). The output is limited to
+    the current range and to the slew rate. While it is limited, the integral follows the limited output (anti-windup).
+
+    :param error:               Excess current above the setpoint in A
+    :param integral:            Integral part of the previous step in A
+    :param output:              Output of the previous step in A
+    :param proportional_gain:   Proportional gain
+    :param integral_step:       Integral gain times the step length in s
+    :param min_current:         Minimum current in A
+    :param max_current:         Maximum current in A
+    :param slew_rate:           Maximum change of the output per step in A
+    :return:                    Tuple of the new output and integral in A
+    """
+    integral += integral_step * error
+    unlimited = integral + proportional_gain * error
+    target = max(min_current, min(unlimited, max_current))
+    target = max(output - slew_rate, min(target, output + slew_rate))
+    if target != unlimited:
+        integral = target - proportional_gain * error
+    return target, integral
+
+
+@pyscript_compile
+def _spread_forecast(
+    remaining_forecast: float,
+    first_forecast: Union[float, None],
+    steps: list,
+    horizon: float,
+    shape: Union[list, None],
+) -> list:
+    """
+    Spreads the remaining solar production forecast over consecutive steps (native Python). The first step gets the
+    forecast of the current hour, if known, the rest is distributed by the shape until the horizon, or as a ramp down to
+    zero at the horizon if there is no shape (or it has no production left).
+
+    :param remaining_forecast:  Remaining solar production in kWh
+    :param first_forecast:      Solar production forecast of the current hour in kWh per hour, None if unknown
+    :param steps:               Lengths of the steps in hours
+    :param horizon:             Hours until the end of the production (sunset)
+    :param shape:               Relative production per step, None if unknown
+    :return:                    Solar production per step in kWh
+    """
+    pv = [0.0] * len(steps)
+    first = 0
+    if steps and first_forecast is not None:
+        pv[0] = min(remaining_forecast, first_forecast * steps[0])
+        remaining_forecast -= pv[0]
+        first = 1
+    weights = [0.0] * len(steps)
+    ramp = [0.0] * len(steps)
+    start = sum(steps[:first])
+    for i in range(first, len(steps)):
+        end = min(start + steps[i], horizon)
+        if end > start:
+            ramp[i] = (horizon - start) ** 2 - (horizon - end) ** 2
+            if shape is not None:
+                weights[i] = shape[i]
+        start += steps[i]
+    if sum(weights) <= 0:
+        weights = ramp
+    total = sum(weights)
+    if total > 0:
+        for i in range(first, len(steps)):
+            pv[i] += remaining_forecast * weights[i] / total
+    return pv
+
+
+@pyscript_compile
+def _battery_budget(
+    pv: list,
+    steps: list,
+    loads: list,
+    level: float,
+    capacity: float,
+    target: float,
+) -> tuple:
+    """
+    Simulates the state of charge of the home battery step by step until sunset and determines the appliance power the
+    battery can afford in the first step without missing the target at sunset (native Python). The battery is charged
+    up to its capacity and discharged down to zero.
+
+    :param pv:                  Solar production per step in kWh
+    :param steps:               Lengths of the steps until sunset in hours
+    :param loads:               Energy used by the load (without appliances) per step in kWh
+    :param level:               State of charge in kWh
+    :param capacity:            Capacity in kWh
+    :param target:              State of charge to reach at sunset in kWh
+    :return:                    Tuple of the affordable appliance power in the first step in W (0 if the target cannot
+                                be reached) and the state of charge at sunset without appliances in kWh
+    """
+    if not steps:
+        return 0.0, level
+    soc = level
+    for i in range(len(steps)):
+        soc = min(capacity, max(0.0, soc + pv[i] - loads[i]))
+    # lowest state of charge at the start of each step, from which the target is still reached
+    required = target
+    for i in range(len(steps) - 1, 0, -1):
+        if required > capacity:
+            return 0.0, soc
+        required = max(0.0, required - pv[i] + loads[i])
+    if required > capacity:
+        return 0.0, soc
+    budget = (level + pv[0] - loads[0] - required) / steps[0] * 1000
+    return max(0.0, budget), soc
+
+
+@pyscript_compile
+def _zero_feed_in_excess(
+    remaining_usage: float, remaining_forecast: float, hours_until_sunset: float
+) -> float:
+    """
+    Estimates the excess power of a zero feed in installation from the remaining solar production forecast, which is
+    assumed to be spread linearly until sunset (native Python).
+
+    :param remaining_usage:     Energy used by the load until sunset in kWh
+    :param remaining_forecast:  Remaining solar production forecast of today in kWh
+    :param hours_until_sunset:  Hours until sunset, greater than 0
+    :return:                    Excess power in W
+    """
+    ## todo create variable for power factor (1.2) to deal with non-linear PV production towards dusk
+    return (remaining_forecast - remaining_usage) / hours_until_sunset * 1000 * 1.2
+
+
+class ApplianceConfig(
+    collections.namedtuple(
+        "ApplianceConfig",
+        [
+            "automation_id",
+            "appliance_priority",
+            "appliance_switch",
+            "domain",
+            "log_prefix",
+            "enabled",
+            "actual_power",
+            "appliance_current_set_entity",
+            "dynamic_current_appliance",
+            "round_target_current",
+            "deactivating_current",
+            "appliance_current_interval",
+            "phases",
+            "min_current",
+            "max_current",
+            "defined_current",
+            "min_solar_fraction",
+            "appliance_switch_interval",
+            "appliance_switch_off_interval",
+            "appliance_on_only",
+            "appliance_once_only",
+            "appliance_maximum_run_time",
+            "appliance_minimum_run_time",
+            "appliance_runtime_deadline",
+            "current_control",
+            "current_slew_rate",
+            # derived: power per ampere (grid voltage × phases) and power at the defined current in W
+            "phase_power",
+            "defined_power",
+        ],
+    )
+):
+    """
+    Configuration of an appliance, compiled once at registration from the parameters of the pv_excess_control service.
+    The configuration is immutable: An update of the automation compiles a new one, which replaces the old one as a
+    whole. Being a tuple, it takes little memory per appliance.
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def compile(
+        automation_id,
+        appliance_priority,
+        appliance_switch,
+        enabled,
+        actual_power,
+        appliance_current_set_entity,
+        dynamic_current_appliance,
+        round_target_current,
+        deactivating_current,
+        appliance_current_interval,
+        appliance_phases,
+        min_current,
+        max_current,
+        defined_current,
+        min_solar_percent,
+        appliance_switch_interval,
+        appliance_switch_off_interval,
+        appliance_on_only,
+        appliance_once_only,
+        appliance_maximum_run_time,
+        appliance_minimum_run_time,
+        appliance_runtime_deadline,
+        grid_voltage,
+        current_control="step",
+        current_slew_rate=2,
+    ):
+        """
+        Converts and validates the service parameters of an appliance.
+
+        :return:            ApplianceConfig
+        :raises ValueError: If a parameter is missing or out of range
+        """
+        if not automation_id:
+            raise ValueError("Automation ID is missing.")
+        if not appliance_switch or "." not in str(appliance_switch):
+            raise ValueError(f'Invalid appliance switch "{appliance_switch}".')
+        priority = int(appliance_priority)
+        dynamic = bool(dynamic_current_appliance)
+        if dynamic and not appliance_current_set_entity:
+            raise ValueError(
+                "Dynamic current appliances require an appliance current set entity."
+            )
+        phases = (
+            int(appliance_phases)
+            if appliance_phases and str(appliance_phases).isdigit()
+            else 1
+        )
+        voltage = float(grid_voltage)
+        if voltage <= 0:
+            raise ValueError(f"Invalid grid voltage {voltage} V.")
+        minimum = float(min_current)
+        maximum = float(max_current)
+        if dynamic and not 0 < minimum <= maximum:
+            raise ValueError(
+                f"Invalid current range {minimum}-{maximum} A of dynamic current appliance."
+            )
+        current = float(defined_current)
+        if current <= 0:
+            raise ValueError(f"Invalid defined current {current} A.")
+        min_solar_percent = float(min_solar_percent)
+        if not 0 <= min_solar_percent <= 100:
+            raise ValueError(f"Invalid minimum solar percentage {min_solar_percent}.")
+        switch_interval = int(appliance_switch_interval)
+        switch_off_interval = int(appliance_switch_off_interval)
+        current_interval = int(appliance_current_interval)
+        if min(switch_interval, switch_off_interval, current_interval) < 1:
+            raise ValueError("Switch and current intervals must be at least 1 minute.")
+        maximum_run_time = float(appliance_maximum_run_time or 0)
+        minimum_run_time = float(appliance_minimum_run_time or 0)
+        if maximum_run_time < 0 or minimum_run_time < 0:
+            raise ValueError("Run times must not be negative.")
+        current_control = current_control or "step"
+        if current_control not in ("step", "pi"):
+            raise ValueError(f'Unknown current control "{current_control}".')
+        slew_rate = float(current_slew_rate)
+        if slew_rate <= 0:
+            raise ValueError(f"Invalid current slew rate {slew_rate} A.")
+        phase_power = voltage * phases
+        return ApplianceConfig(
+            automation_id=automation_id,
+            appliance_priority=priority,
+            appliance_switch=appliance_switch,
+            domain=appliance_switch.split(".")[0],
+            log_prefix=f"[{appliance_switch} {automation_id} (Prio {priority})]",
+            enabled=enabled,
+            actual_power=actual_power,
+            appliance_current_set_entity=appliance_current_set_entity,
+            dynamic_current_appliance=dynamic,
+            round_target_current=bool(round_target_current),
+            deactivating_current=bool(deactivating_current),
+            appliance_current_interval=current_interval,
+            phases=phases,
+            min_current=minimum,
+            max_current=maximum,
+            defined_current=current,
+            min_solar_fraction=min_solar_percent / 100,
+            appliance_switch_interval=switch_interval,
+            appliance_switch_off_interval=switch_off_interval,
+            appliance_on_only=bool(appliance_on_only),
+            appliance_once_only=bool(appliance_once_only),
+            appliance_maximum_run_time=maximum_run_time,
+            appliance_minimum_run_time=minimum_run_time,
+            appliance_runtime_deadline=_get_time_object(appliance_runtime_deadline),
+            current_control=current_control,
+            current_slew_rate=slew_rate,
+            phase_power=phase_power,
+            defined_power=current * phase_power,
+        )
+
+
+class ApplianceState:
+    """
+    Runtime state of an appliance: Daily runtime, switching bookkeeping and interval counters. Kept apart from the
+    configuration, so that it survives updates of the automation.
+    """
+
+    __slots__ = (
+        "switched_on_today",
+        "switched_on_time",
+        "daily_run_time",
+        "switch_events_today",
+        "switch_interval_counter",
+        "current_interval_counter",
+        "enforce_minimum_run",
+        "previous_current_buffer",
+        "settle_pending",
+        "settle_latency",
+        "current_power",
+        "feedback_source",
+        "pi_output",
+        "pi_integral",
+    )
+
+    def __init__(self):
+        self.switched_on_today = False
+        self.switched_on_time = datetime.datetime.now()
+        self.daily_run_time = 0
+        self.switch_events_today = 0
+        self.switch_interval_counter = 0
+        self.current_interval_counter = 0
+        self.enforce_minimum_run = False
+        self.previous_current_buffer = 0
+        # pending switching confirmation (expected state, time sent) and last measured latency in seconds
+        self.settle_pending = None
+        self.settle_latency = None
+        # power the appliance currently contributes to appliance_pwr_load
+        self.current_power = 0
+        # excess power the control pass used for the appliance ("excess" or "export"), and output and integral of the
+        # current controller in A, None while it is not controlling (see CurrentController)
+        self.feedback_source = "excess"
+        self.pi_output = None
+        self.pi_integral = None
+
+
+class PriorityRegistry:
+    """
+    Registry of the appliances, ordered by priority (highest priority first, appliances with equal priority in the
+    order of their registration).
+
+    The ordered list is never changed in place: Adding or removing an appliance replaces it with a new list. Loops over
+    descending (or reversed(descending) for ascending priority) therefore neither copy nor sort, and appliances can be
+    added or removed while a loop is running, which continues with the list it started with. Positions are found by
+    binary search over the sort keys in O(log N), but building the new lists makes adding or removing an appliance
+    O(N) (a copy of N references). Registrations and removals are rare compared to loops, which run every tick.
+    """
+
+    def __init__(self):
+        # automation ID -> PVExcesscontrol Class instance
+        self.by_id = {}
+        # instances by descending priority and their sort keys (-priority, registration no.)
+        self.descending = []
+        self.keys = []
+        self.registrations = 0
+
+    def get(self, automation_id: str):
+        """
+        :return:    Registered instance, None if not registered
+        """
+        return self.by_id.get(automation_id)
+
+    def count(self) -> int:
+        return len(self.by_id)
+
+    def first(self):
+        """
+        :return:    Instance with the highest priority, None if the registry is empty
+        """
+        return self.descending[0] if self.descending else None
+
+    def add(self, inst):
+        """
+        Registers an instance, or moves it to its new position if its priority changed.
+
+        :param inst:    PVExcesscontrol Class instance
+        """
+        registered = self.by_id.get(inst.config.automation_id)
+        if registered is not None:
+            if (
+                registered is inst
+                and inst.registry_key[0] == -inst.config.appliance_priority
+            ):
+                return
+            # keep the registration no., so that equal priorities keep their order
+            number = registered.registry_key[1]
+            self.remove(inst.config.automation_id)
+        else:
+            self.registrations += 1
+            number = self.registrations
+        key = (-inst.config.appliance_priority, number)
+        inst.registry_key = key
+        i = bisect.bisect_left(self.keys, key)
+        self.keys = self.keys[:i] + [key] + self.keys[i:]
+        self.descending = self.descending[:i] + [inst] + self.descending[i:]
+        self.by_id[inst.config.automation_id] = inst
+
+    def remove(self, automation_id: str):
+        """
+        Unregisters an instance.
+
+        :param automation_id:   Automation ID of the instance
+        :return:                The removed instance, None if it was not registered
+        """
+        inst = self.by_id.pop(automation_id, None)
+        if inst is None:
+            return None
+        i = bisect.bisect_left(self.keys, inst.registry_key)
+        self.keys = self.keys[:i] + self.keys[i + 1 :]
+        self.descending = self.descending[:i] + self.descending[i + 1 :]
+        return inst
+
+
+class ControlGroup:
+    """
+    Appliances controlled based on the same inverter and meter. Each group has its own power sensors, battery policy,
+    power histories and control pass, which is run by the appliance with the highest priority of the group, so that
+    e.g. two inverters with separate meters can be controlled independently. Groups are identified by name, appliances
+    without a group name belong to the default group. A group is removed with its last appliance.
+    """
+
+    DEFAULT = "default"
+    # name -> ControlGroup
+    groups = {}
+
+    def __init__(self, name: str):
+        self.name = name
+        self.instances = PriorityRegistry()
+        # sensors and battery policy, shared by all automations of the group
+        self.export_power = None
+        self.pv_power = None
+        self.load_power = None
+        self.home_battery_level = None
+        self.grid_voltage = None
+        self.import_export_power = None
+        self.home_battery_capacity = None
+        self.solar_production_forecast = None
+        self.solar_production_forecast_this_hour = None
+        self.time_of_sunset = None
+        self.min_home_battery_level = None
+        self.min_home_battery_level_start = False
+        self.zero_feed_in = False
+        self.zero_feed_in_load = None
+        self.zero_feed_in_level = None
+        # "greedy": switch on by priority and switch off in reverse order, "optimal": see PvExcessControl._allocate()
+        self.allocation_mode = "greedy"
+        # Exported Power history
+        self.export_history = PowerHistory(60, floor=0)
+        # PV Excess history (PV power minus load power)
+        self.pv_history = PowerHistory(60)
+        # Load history (PV power minus load power)
+        self.load_history = PowerHistory(60)
+        # load per weekday and quarter-hour, learned from the load history
+        self.load_profile = LoadProfile()
+        # solar power per quarter-hour of the day, learned from the PV power
+        self.solar_profile = LoadProfile(days=1)
+        # Time-weighted power signals since the last history update, fed by state triggers on the power sensors and on
+        # the switches / actual power sensors of the appliances. "grid_export" is the export part of the import/export
+        # sensor.
+        self.power_signals = {
+            "pv": PowerIntegrator(),
+            "export": PowerIntegrator(),
+            "load": PowerIntegrator(),
+            "import_export": PowerIntegrator(),
+            "grid_export": PowerIntegrator(),
+            "appliances": PowerIntegrator(),
+        }
+        # power sensor entity ID -> names of the power signals it feeds
+        self.power_sensors = {}
+        self.sensor_trigger = None
+        # current total power of all appliances switched on, in W, and including the switching decisions of the
+        # running control pass (see PvExcessControl._adjust_pwr_history())
+        self.appliance_pwr_load = 0
+        self.planned_pwr_load = 0
+        # cached battery plan, see BatteryPlan
+        self.battery_plan = None
+        # cached solar surplus per quarter-hour and plan of the minimum runtimes, see RuntimePlanner
+        self.runtime_surplus = None
+        self.runtime_plan = None
+        # index of the reducible power by priority, see PvExcessControl._index_pwr_reducible()
+        self.reducible_keys = []
+        self.reducible_sums = [0]
+        self.warm_started = False
+        self.restored_histories = False
+        # successful history updates since start, consecutive failed history updates
+        self.history_updates = 0
+        self.history_failures = 0
+        self.last_history_update = None
+        # solar context of the running tick, last state of the sunset entity and the parsed time of sunset
+        self.solar = None
+        self.sunset_state = None
+        self.sunset_time = None
+        # marks of the power signals sampled by the current controller in the last tick, see CurrentController
+        self.feedback_marks = {}
+
+    @staticmethod
+    def get(name: Union[str, None]):
+        """
+        :param name:    Group name, the default group if empty
+        :return:        ControlGroup of the given name, created if it does not exist yet
+        """
+        name = str(name).strip() if name else ""
+        name = name or ControlGroup.DEFAULT
+        group = ControlGroup.groups.get(name)
+        if group is None:
+            group = ControlGroup(name)
+            ControlGroup.groups[name] = group
+            StateStore.restore_group(group)
+        return group
+
+    @staticmethod
+    def find(automation_id: str):
+        """
+        :param automation_id:   Automation ID
+        :return:                Registered instance of any group, None if not registered
+        """
+        for group in ControlGroup.groups.values():
+            inst = group.instances.get(automation_id)
+            if inst is not None:
+                return inst
+        return None
+
+    @staticmethod
+    def all_instances() -> list:
+        """
+        :return:    Registered instances of all groups, each group by descending priority
+        """
+        instances = []
+        for group in ControlGroup.groups.values():
+            instances.extend(group.instances.descending)
+        return instances
+
+    @staticmethod
+    def unregister(inst):
+        """
+        Removes an instance from its group and the group with its last appliance.
+
+        :param inst:    PVExcesscontrol Class instance
+        """
+        group = inst.group
+        if group.instances.remove(inst.config.automation_id) is None:
+            return
+        PvExcessControl._update_appliance_power(inst, 0)
+        RuntimeDeadlines.remove(inst.config.automation_id)
+        if not group.instances.count() and ControlGroup.groups.get(group.name) is group:
+            # stops the state trigger on the power sensors
+            group.sensor_trigger = None
+            del ControlGroup.groups[group.name]
+            Log.info("Removed control group without appliances.", group=group.name)
+
+
+class CurrentController:
+    """
+    Closed-loop current control of dynamic current appliances with the "pi" current control. Instead of jumping to the
+    current calculated from the averaged excess power once per appliance current interval, the current follows the
+    excess power measured during the last 10s tick, so that it settles within a few ticks. Switching the appliances on
+    and off is still decided by the control pass.
+
+    Each appliance has its own PI controller. Its output is limited to the current range and to the slew rate of the
+    appliance, while it is limited, the integral follows the limited output, so that it does not wind up at the
+    minimum or maximum current. The measured excess is handed from appliance to appliance (by descending priority, by
+    ascending priority if there is too little excess), each one taking the share covered by its change of current, so
+    that several appliances do not react to the same excess at once.
+    """
+
+    # proportional gain in A per A of excess current, integral gain in A per A of excess current and second
+    proportional_gain = 0.2
+    integral_gain = 0.06
+    # length of a controller step (one tick) in seconds
+    step_length = 10
+    # excess power in W the controller settles at, slightly positive to avoid importing from the grid
+    setpoint = 20
+    # smaller changes of the current in A are not sent, to avoid a service call every tick
+    deadband = 0.2
+
+    @staticmethod
+    def tick(group):
+        """
+        Runs one controller step for the appliances of a control group. Runs every tick, after the control pass.
+
+        :param group:   ControlGroup
+        """
+        controlled = []
+        for inst in list(group.instances.descending):
+            if inst.config.current_control != "pi":
+                continue
+            if (
+                inst.state.settle_pending is None
+                and inst.state.current_power > 0
+                and _get_state(inst.config.appliance_switch) == "on"
+                and inst.automation_activated(
+                    inst.config.automation_id, inst.config.enabled
+                )
+            ):
+                controlled.append(inst)
+            else:
+                inst.state.pi_output = None
+                inst.state.pi_integral = None
+        if not controlled:
+            group.feedback_marks = {}
+            return
+        feedback = CurrentController._feedback(group)
+        if feedback is None:
+            Log.debug("Current controller paused, the excess power is unknown.")
+            return
+        export_pwr, excess_pwr = feedback
+        errors = []
+        for inst in controlled:
+            measured = excess_pwr
+            if inst.state.feedback_source == "export":
+                # only exported power is excess, but any import or battery discharge has to be reduced
+                measured = export_pwr if export_pwr > 0 else min(0, excess_pwr)
+            errors.append((inst, measured - CurrentController.setpoint))
+        if errors[0][1] < 0:
+            # reduce the appliances with the lowest priority first
+            errors.reverse()
+        consumed = 0
+        for inst, error in errors:
+            consumed += CurrentController._step(inst, error - consumed)
+
+    @staticmethod
+    def _feedback(group) -> Union[tuple, None]:
+        """
+        :param group:   ControlGroup
+        :return:        Tuple of export and excess power (PV power minus load power) in W, averaged since the previous
+                        tick, None if unknown
+        """
+        now = _power_timestamp()
+        marks = group.feedback_marks
+        if group.import_export_power:
+            names = ("import_export", "grid_export")
+        else:
+            names = ("export", "pv", "load")
+        avg = {}
+        for name in names:
+            avg[name], marks[name] = group.power_signals[name].sample(
+                now, marks.get(name)
+            )
+        if None in avg.values():
+            return None
+        if group.import_export_power:
+            return avg["grid_export"], -avg["import_export"]
+        return avg["export"], avg["pv"] - avg["load"]
+
+    @staticmethod
+    def _step(inst, error_power: float) -> float:
+        """
+        Runs one controller step of an appliance and sets its new current, if it changed.
+
+        :param inst:            PVExcesscontrol Class instance
+        :param error_power:     Excess power above the setpoint in W
+        :return:                Additional power consumption of the appliance in W
+        """
+        config = inst.config
+        prev_set_amps = _get_num_state(
+            config.appliance_current_set_entity, return_on_error=config.min_current
+        )
+        if inst.state.pi_output is None:
+            # bumpless start at the current set value, the appliance has just started drawing power
+            inst.state.pi_output = prev_set_amps
+            inst.state.pi_integral = prev_set_amps
+            return 0
+        inst.state.pi_output, inst.state.pi_integral = _pi_current(
+            error_power / config.phase_power,
+            inst.state.pi_integral,
+            inst.state.pi_output,
+            CurrentController.proportional_gain,
+            CurrentController.integral_gain * CurrentController.step_length,
+            config.min_current,
+            config.max_current,
+            config.current_slew_rate,
+        )
+        if abs(inst.state.pi_output - prev_set_amps) < CurrentController.deadband:
+            return 0
+        if config.round_target_current:
+            target_current = int(inst.state.pi_output)
+        else:
+            target_current = round(inst.state.pi_output, 1)
+        if target_current == prev_set_amps:
+            return 0
+        _set_value(config.appliance_current_set_entity, target_current)
+        Log.debug(
+            lambda: (
+                f"Current controller changed current (per phase) from {prev_set_amps}A to {target_current}A, "
+                f"excess power {error_power:.0f} W above setpoint."
+            ),
+            inst,
+        )
+        return (target_current - prev_set_amps) * config.phase_power
+
+
+class PvExcessControl:
+    # TODO:
+    #  - What about other domains than switches? Enable use of other domains (e.g. light, ...)
+    #  - Make min_excess_power configurable via blueprint
+    # Power resolution of the optimal allocation in W, coarsened to at most allocation_cells steps
+    allocation_resolution = 10
+    allocation_cells = 500
+    # recorder database, defaults to home-assistant_v2.db in the Home Assistant config folder
+    recorder_db = None
+    # Minimum excess power in watts. If the average min_excess_power at the specified appliance switch interval is greater than the actual
+    #  excess power, the appliance with the lowest priority will be shut off.
+    #  NOTE: Should be slightly negative, to compensate for inaccurate power corrections
+    #  WARNING: Do net set this to more than 0, otherwise some devices with dynamic current control will abruptly get switched off in some
+    #  situations.
+    min_excess_power = -10
+    # Maximum time in seconds for an appliance to confirm a switching action
+    settle_timeout = 60
+    # 10s ticks since the last control pass
+    tick_counter = 0
+
+    def __init__(
+        self,
+        automation_id,
+        appliance_priority,
+        export_power,
+        pv_power,
+        load_power,
+        home_battery_level,
+        min_home_battery_level,
+        min_home_battery_level_start,
+        zero_feed_in,
+        zero_feed_in_load,
+        zero_feed_in_level,
+        dynamic_current_appliance,
+        round_target_current,
+        deactivating_current,
+        appliance_current_interval,
+        appliance_phases,
+        min_current,
+        max_current,
+        min_solar_percent,
+        appliance_switch,
+        appliance_switch_interval,
+        appliance_switch_off_interval,
+        appliance_current_set_entity,
+        actual_power,
+        defined_current,
+        appliance_on_only,
+        grid_voltage,
+        import_export_power,
+        home_battery_capacity,
+        solar_production_forecast,
+        solar_production_forecast_this_hour,
+        time_of_sunset,
+        appliance_once_only,
+        appliance_maximum_run_time,
+        appliance_minimum_run_time,
+        appliance_runtime_deadline,
+        enabled,
+        allocation_mode="greedy",
+        control_group=None,
+        current_control="step",
+        current_slew_rate=2,
+    ):
+        try:
+            config = ApplianceConfig.compile(
+                automation_id,
+                appliance_priority,
+                appliance_switch,
+                enabled,
+                actual_power,
+                appliance_current_set_entity,
+                dynamic_current_appliance,
+                round_target_current,
+                deactivating_current,
+                appliance_current_interval,
+                appliance_phases,
+                min_current,
+                max_current,
+                defined_current,
+                min_solar_percent,
+                appliance_switch_interval,
+                appliance_switch_off_interval,
+                appliance_on_only,
+                appliance_once_only,
+                appliance_maximum_run_time,
+                appliance_minimum_run_time,
+                appliance_runtime_deadline,
+                grid_voltage,
+                current_control,
+                current_slew_rate,
+            )
+        except (TypeError, ValueError) as e:
+            # an already registered appliance keeps running with its previous configuration
+            Log.error(
+                f"Invalid configuration, registration ignored: {e}",
+                automation=automation_id,
+            )
+            return
+        # restores the saved histories of the control groups and the saved appliance states
+        StateStore.load()
+        group = ControlGroup.get(control_group)
+        inst = ControlGroup.find(automation_id)
+        registered = inst is not None
+        if inst is None:
+            inst = self
+        elif inst.group is not group:
+            # the appliance moves to another control group
+            ControlGroup.unregister(inst)
+        inst.group = group
+        inst.config = config
+        group.export_power = export_power
+        group.pv_power = pv_power
+        group.load_power = load_power
+        group.home_battery_level = home_battery_level
+        group.grid_voltage = float(grid_voltage)
+        group.import_export_power = import_export_power
+        group.home_battery_capacity = home_battery_capacity
+        group.solar_production_forecast = solar_production_forecast
+        group.solar_production_forecast_this_hour = solar_production_forecast_this_hour
+        group.time_of_sunset = time_of_sunset
+        group.min_home_battery_level = float(min_home_battery_level)
+        group.min_home_battery_level_start = bool(min_home_battery_level_start)
+        group.zero_feed_in = bool(zero_feed_in)
+        group.zero_feed_in_load = zero_feed_in_load
+        group.zero_feed_in_level = float(zero_feed_in_level)
+        if allocation_mode not in ("greedy", "optimal"):
+            Log.warning(
+                f'Unknown allocation mode "{allocation_mode}", using "greedy".', inst
+            )
+            allocation_mode = "greedy"
+        group.allocation_mode = allocation_mode
+
         # start if needed
-        if inst.automation_id not in PvExcessControl.instances:
-            inst.switched_on_today = False
-            inst.switch_interval_counter = 0
-            inst.current_interval_counter = 0
-            inst.switched_on_time = datetime.datetime.now()
-            inst.daily_run_time = 0
-            inst.trigger_factory()
-            PvExcessControl.instances[inst.automation_id] = {
-                "instance": inst,
-                "priority": inst.appliance_priority,
-            }
-            log.info(f"{self.log_prefix} Trigger Method started.")
-        PvExcessControl.instances = dict(
-            sorted(
-                PvExcessControl.instances.items(),
-                key=lambda item: item[1]["priority"],
-                reverse=True,
+        if not registered:
+            inst.state = ApplianceState()
+            inst.power_trigger = None
+            inst.power_trigger_entities = None
+            StateStore.restore_appliance(inst)
+        # adds new instances, moves existing ones if their priority changed
+        group.instances.add(inst)
+        PvExcessControl.sensor_trigger_factory(group)
+        inst.power_trigger_factory()
+        RuntimeDeadlines.update(inst)
+        Log.info("Registered appliance.", inst)
+
+    @staticmethod
+    def tick():
+        """
+        Runs one 10s tick for all control groups. Ticks of all groups share one state snapshot and one action queue.
+        Each group is controlled by its leader, the appliance of the group with the highest priority (the one
+        registered first among equal priorities), so that a new leader takes over in the next tick when the leader is
+        removed.
+
+        The groups are evaluated one after another instead of in concurrent tasks: They share no state besides the
+        snapshot and the queue, and a tick does not wait for anything (actions are only sent when the queue is
+        flushed), so concurrent tasks would run one after another on the event loop as well, with a state read and a
+        service call per group instead of one for all. A failing group is logged and does not stop the others.
+        """
+        PvExcessControl.tick_counter += 1
+        # ensure that history update and control algo only run every minute (= every 6th tick). The power sensors are
+        # sampled by state triggers in between.
+        control_tick = PvExcessControl.tick_counter % 6 == 0
+        if control_tick:
+            PvExcessControl.tick_counter = 0
+        leaders = []
+        entity_ids = []
+        for group in list(ControlGroup.groups.values()):
+            leader = group.instances.first()
+            if leader is None or not PvExcessControl.sanity_check(group):
+                continue
+            leaders.append(leader)
+            entity_ids.extend(PvExcessControl._tracked_entities(group, control_tick))
+        if not leaders:
+            return
+        # read all configured entities once, further state lookups of this tick are served from the snapshot
+        snapshot = StateSnapshot.begin(list(dict.fromkeys(entity_ids)))
+        # collect all actions of this tick and send them batched per domain and service
+        queue = ActionQueue.begin()
+        if control_tick:
+            Metrics.history_ms = 0
+            Metrics.control_ms = 0
+        try:
+            for leader in leaders:
+                try:
+                    PvExcessControl._tick_group(leader, control_tick)
+                except Exception as e:
+                    Log.error(f"Control tick failed: {e}", group=leader.group.name)
+        finally:
+            ActionQueue.flush(queue)
+            StateSnapshot.end(snapshot)
+            Metrics.tick(control_tick)
+            if control_tick:
+                StateStore.save()
+
+    @staticmethod
+    def _tick_group(leader, control_tick: bool):
+        """
+        Runs the tick of the control group of the given leader.
+
+        :param leader:          PVExcesscontrol Class instance with the highest priority of its control group
+        :param control_tick:    True if the history update and control pass run in this tick
+        """
+        group = leader.group
+        SolarContext.reset(group)
+        try:
+            if not group.warm_started:
+                PvExcessControl._warm_start_history(group)
+            PvExcessControl._check_settle(group)
+            if control_tick:
+                started = time.perf_counter()
+                Metrics.history_updated(
+                    group, PvExcessControl._update_pv_history(group)
+                )
+                Metrics.history_ms += round((time.perf_counter() - started) * 1000, 1)
+                started = time.perf_counter()
+                leader._control_pass()
+                Metrics.control_ms += round((time.perf_counter() - started) * 1000, 1)
+            CurrentController.tick(group)
+        finally:
+            SolarContext.reset(group)
+
+    @staticmethod
+    def sensor_trigger_factory(group):
+        """
+        (Re)creates the state trigger on the configured power sensors of a control group, if they changed, and seeds
+        the power signals with the current sensor states.
+
+        :param group:   ControlGroup
+        """
+        sensors = {}
+        for entity_id, name in (
+            (group.pv_power, "pv"),
+            (group.export_power, "export"),
+            (group.load_power, "load"),
+            (group.import_export_power, "import_export"),
+        ):
+            if entity_id:
+                sensors.setdefault(entity_id, []).append(name)
+        if sensors == group.power_sensors:
+            return
+        group.power_sensors = sensors
+        now = _power_timestamp()
+        for name, signal in group.power_signals.items():
+            if name != "appliances":
+                signal.update(None, now)
+        for entity_id in sensors:
+            PvExcessControl._update_power_sensor(
+                group, entity_id, _read_state(entity_id), now
             )
-        )
-        log.info(f"{inst.log_prefix} Registered appliance.")
-
-    def trigger_factory(self):
-        # trigger every 10s
-        @time_trigger("period(now, 10s)")
-        def on_time():
-            # Sanity check
-            if (not PvExcessControl.instances) or (not self.sanity_check()):
-                return on_time
-
-            # execute only if this the first instance of the dictionary (avoid two automations acting)
-            # log.info(f'{self.log_prefix} I am around.')
-            first_item = next(iter(PvExcessControl.instances.values()))
-            if first_item["instance"] != self:
-                return on_time
-
-            PvExcessControl.on_time_counter += 1
-            PvExcessControl._update_pv_history()
-            # ensure that control algo only runs every minute (= every 6th on_time trigger)
-            if PvExcessControl.on_time_counter % 6 != 0:
-                return on_time
-            PvExcessControl.on_time_counter = 0
-
-            # ----------------------------------- go through each appliance (highest prio to lowest) ---------------------------------------
-            # this is for determining which devices can be switched on
-            instances = []
-            switched_off_appliance_to_switch_on_higher_prioritized_one = False
-            for a_id, e in PvExcessControl.instances.copy().items():
-                inst = e["instance"]
-                inst.switch_interval_counter += 1
-                inst.current_interval_counter += 1
-
-                # Check if automation is activated for specific instance
-                if not self.automation_activated(inst.automation_id, inst.enabled):
-                    continue
 
-                # Check if we are enforcing the minimum daily run time
-                # This gets set by enforce_runtime() if daily run time was not sufficient to reach expected deadline
-                # and forces the appliance on no matter what until minimum runtime is met
-                if inst.enforce_minimum_run:
-                    # If we aren't on, then turn on
-                    if _get_state(inst.appliance_switch) != "on":
-                        self.switch_on(inst)
-                        log.info(
-                            f"{inst.log_prefix} Switched on appliance to meet minimum runtime."
-                        )
+        @state_trigger(list(sensors))
+        def on_sensor_change(var_name=None, value=None, **kwargs):
+            PvExcessControl._update_power_sensor(
+                group, var_name, value, _power_timestamp()
+            )
 
-                    # Update runtime
-                    run_time = (
-                        inst.daily_run_time
-                        + (
-                            datetime.datetime.now() - inst.switched_on_time
-                        ).total_seconds()
-                    ) / 60
-                    log.debug(
-                        f"{inst.log_prefix} Appliance has run for {run_time:.1f} minutes (min: {inst.appliance_minimum_run_time}, max: {inst.appliance_maximum_run_time})."
-                    )
+        group.sensor_trigger = on_sensor_change
 
-                    if run_time > inst.appliance_minimum_run_time:
-                        log.info(
-                            f"{inst.log_prefix} Minimum runtime met, turning off appliance."
-                        )
-                        # Try to switch off appliance
-                        power_consumption = self.switch_off(inst)
+    def power_trigger_factory(self):
+        """
+        (Re)creates the state trigger on the switch and actual power entities of the appliance, if they changed, and
+        seeds its power contribution.
+        """
+        entity_ids = [
+            x for x in [self.config.appliance_switch, self.config.actual_power] if x
+        ]
+        if entity_ids != self.power_trigger_entities:
+            self.power_trigger_entities = entity_ids
 
-                        # If the device turned off, disable enforced running
-                        if power_consumption > 0:
-                            inst.enforce_minimum_run = False
+            @state_trigger(entity_ids)
+            def on_power_change(**kwargs):
+                PvExcessControl._update_appliance_power(self)
 
-                    continue
+            self.power_trigger = on_power_change
+        PvExcessControl._update_appliance_power(self)
 
-                # calculate average load power
-                # TODO - load history should be configurable, as it is not dependent of appliance switch interval
-                # for now as "beta", I'm setting it as appliance_switch_in
+    @staticmethod
+    def _update_power_sensor(
+        group, entity_id: str, value: Union[str, None], now: float
+    ):
+        """
+        Feeds a new state of a power sensor into its power signals.
 
-                avg_load_power = int(
-                    sum(PvExcessControl.load_history[-inst.appliance_switch_interval :])
-                    / max(1, inst.appliance_switch_interval)
+        :param group:       ControlGroup
+        :param entity_id:   Entity ID of the power sensor
+        :param value:       New state
+        :param now:         Timestamp of the change in seconds
+        """
+        if value is None or value in ("unavailable", "unknown"):
+            num = None
+        else:
+            num = _validate_number(value)
+        for name in group.power_sensors.get(entity_id, []):
+            group.power_signals[name].update(num, now)
+            if name == "import_export":
+                group.power_signals["grid_export"].update(
+                    None if num is None else abs(min(0, num)), now
                 )
-                log.debug(f"{inst.log_prefix} Avg_load_power: {avg_load_power}).")
 
-                # check min bat lvl and decide whether to regard export power or solar power minus load power
-                if PvExcessControl.home_battery_level is None:
-                    home_battery_level = 100
+    @staticmethod
+    def _update_appliance_power(inst, power: Union[float, None] = None):
+        """
+        Updates the power contribution of an appliance and the total appliance power signal.
+
+        :param inst:    PVExcesscontrol Class instance
+        :param power:   New power contribution in W, determined from the switch and actual power entities if None
+        """
+        if power is None:
+            power = 0
+            if _get_state(inst.config.appliance_switch) == "on":
+                if inst.config.actual_power is None:
+                    power = inst.config.defined_power
                 else:
-                    home_battery_level = _get_num_state(
-                        PvExcessControl.home_battery_level
-                    )
-                if (
-                    home_battery_level >= PvExcessControl.min_home_battery_level
-                    and PvExcessControl.min_home_battery_level_start
-                ):
-                    # home battery charge is high enough to direct solar power to appliances, if solar power is higher than load power
-                    # calc avg based on pv excess (solar power - load power) according to specified window
-                    avg_excess_power = int(
-                        sum(
-                            PvExcessControl.pv_history[
-                                -inst.appliance_switch_interval :
-                            ]
-                        )
-                        / max(1, inst.appliance_switch_interval)
-                    )
-                    avg_excess_power_off = int(
-                        sum(
-                            PvExcessControl.pv_history[
-                                -inst.appliance_switch_off_interval :
-                            ]
-                        )
-                        / max(1, inst.appliance_switch_off_interval)
-                    )
-                    log.debug(
-                        f"{inst.log_prefix} Home battery charge is sufficient ({home_battery_level}/{PvExcessControl.min_home_battery_level} %)"
-                        f" AND {PvExcessControl.min_home_battery_level_start} is on. "
+                    power = _get_num_state(inst.config.actual_power, return_on_error=0)
+        inst.group.appliance_pwr_load += power - inst.state.current_power
+        inst.state.current_power = power
+        inst.group.power_signals["appliances"].update(
+            inst.group.appliance_pwr_load, _power_timestamp()
+        )
+
+    def _control_pass(self):
+        """
+        Decides which appliances of the control group are switched on/off or changed in current. Runs once a minute.
+        """
+        group = self.group
+        group.planned_pwr_load = group.appliance_pwr_load
+        # ----------------------------------- go through each appliance (highest prio to lowest) ---------------------------------------
+        # this is for determining which devices can be switched on
+        instances = []
+        switched_off_appliance_to_switch_on_higher_prioritized_one = False
+        appliances = self._index_pwr_reducible()
+        RuntimePlanner.update(
+            group, [inst for inst, activated in appliances if activated]
+        )
+        for inst, activated in appliances:
+            inst.state.switch_interval_counter += 1
+            inst.state.current_interval_counter += 1
+
+            # Check if automation is activated for specific instance
+            if not activated:
+                continue
+
+            # Check if we are enforcing the minimum daily run time
+            # This gets set by RuntimeDeadlines if daily run time was not sufficient to reach expected deadline
+            # and forces the appliance on no matter what until minimum runtime is met
+            if inst.state.enforce_minimum_run:
+                # If we aren't on, then turn on
+                if _get_state(inst.config.appliance_switch) != "on":
+                    self.switch_on(inst)
+                    Log.info("Switched on appliance to meet minimum runtime.", inst)
+
+                # Update runtime
+                run_time = (
+                    inst.state.daily_run_time
+                    + (
+                        datetime.datetime.now() - inst.state.switched_on_time
+                    ).total_seconds()
+                ) / 60
+                Log.debug(
+                    lambda run_time=run_time, inst=inst: (
+                        f"Appliance has run for {run_time:.1f} minutes (min: {inst.config.appliance_minimum_run_time}, max: {inst.config.appliance_maximum_run_time})."
+                    ),
+                    inst,
+                )
+
+                if run_time > inst.config.appliance_minimum_run_time:
+                    Log.info("Minimum runtime met, turning off appliance.", inst)
+                    # Try to switch off appliance
+                    power_consumption = self.switch_off(inst)
+
+                    # If the device turned off, disable enforced running
+                    if power_consumption > 0:
+                        inst.state.enforce_minimum_run = False
+
+                continue
+
+            # calculate average load power
+            # TODO - load history should be configurable, as it is not dependent of appliance switch interval
+            # for now as "beta", I'm setting it as appliance_switch_in
+
+            avg_load_power = group.load_history.window_avg(
+                inst.config.appliance_switch_interval
+            )
+            Log.debug(
+                lambda avg_load_power=avg_load_power: (
+                    f"Avg_load_power: {avg_load_power})."
+                ),
+                inst,
+            )
+
+            # check min bat lvl and decide whether to regard export power or solar power minus load power
+            if group.home_battery_level is None:
+                home_battery_level = 100
+            else:
+                home_battery_level = _get_num_state(group.home_battery_level)
+            if (
+                home_battery_level >= group.min_home_battery_level
+                and group.min_home_battery_level_start
+            ):
+                # home battery charge is high enough to direct solar power to appliances, if solar power is higher than load power
+                # calc avg based on pv excess (solar power - load power) according to specified window
+                avg_excess_power = group.pv_history.window_avg(
+                    inst.config.appliance_switch_interval
+                )
+                avg_excess_power_off = group.pv_history.window_avg(
+                    inst.config.appliance_switch_off_interval
+                )
+                inst.state.feedback_source = "excess"
+                Log.debug(
+                    lambda home_battery_level=home_battery_level, avg_excess_power=avg_excess_power: (
+                        f"Home battery charge is sufficient ({home_battery_level}/{group.min_home_battery_level} %)"
+                        f" AND {group.min_home_battery_level_start} is on. "
                         f"Calculated average excess power based on >> solar power - load power <<: {avg_excess_power} W"
-                    )
+                    ),
+                    inst,
+                )
 
-                elif (
-                    home_battery_level >= PvExcessControl.min_home_battery_level
-                    or not self._force_charge_battery(avg_load_power)
-                ):
-                    # home battery charge is high enough to direct solar power to appliances, if solar power is higher than load power
-                    # calc avg based on pv excess (solar power - load power) according to specified window
-                    avg_excess_power = int(
-                        sum(
-                            PvExcessControl.pv_history[
-                                -inst.appliance_switch_interval :
-                            ]
-                        )
-                        / max(1, inst.appliance_switch_interval)
-                    )
-                    avg_excess_power_off = int(
-                        sum(
-                            PvExcessControl.pv_history[
-                                -inst.appliance_switch_off_interval :
-                            ]
-                        )
-                        / max(1, inst.appliance_switch_off_interval)
-                    )
-                    log.debug(
-                        f"{inst.log_prefix} Home battery charge is sufficient ({home_battery_level}/{PvExcessControl.min_home_battery_level} %) "
-                        f"OR remaining solar forecast is higher than remaining capacity of home battery. "
+            elif home_battery_level >= group.min_home_battery_level:
+                # home battery charge is high enough to direct solar power to appliances, if solar power is higher than load power
+                # calc avg based on pv excess (solar power - load power) according to specified window
+                avg_excess_power = group.pv_history.window_avg(
+                    inst.config.appliance_switch_interval
+                )
+                avg_excess_power_off = group.pv_history.window_avg(
+                    inst.config.appliance_switch_off_interval
+                )
+                inst.state.feedback_source = "excess"
+                Log.debug(
+                    lambda home_battery_level=home_battery_level, avg_excess_power=avg_excess_power: (
+                        f"Home battery charge is sufficient ({home_battery_level}/{group.min_home_battery_level} %). "
                         f"Calculated average excess power based on >> solar power - load power <<: {avg_excess_power} W"
-                    )
+                    ),
+                    inst,
+                )
 
-                else:
-                    # home battery charge is not yet high enough OR battery force charge is necessary.
-                    # Only use excess power (which would otherwise be exported to the grid) for appliance
-                    # calc avg based on export power history according to specified window
-                    avg_excess_power = int(
-                        sum(
-                            PvExcessControl.export_history[
-                                -inst.appliance_switch_interval :
-                            ]
-                        )
-                        / max(1, inst.appliance_switch_interval)
-                    )
-                    avg_excess_power_off = int(
-                        sum(
-                            PvExcessControl.pv_history[
-                                -inst.appliance_switch_off_interval :
-                            ]
-                        )
-                        / max(1, inst.appliance_switch_off_interval)
-                    )
-                    log.debug(
-                        f"{inst.log_prefix} Home battery charge is not sufficient ({home_battery_level}/{PvExcessControl.min_home_battery_level} %), "
-                        f"OR remaining solar forecast is lower than remaining capacity of home battery. "
-                        f"Calculated average excess power based on >> export power <<: {avg_excess_power} W"
-                    )
+            else:
+                # home battery charge is not yet high enough. Appliances may use the excess power which would otherwise
+                # be exported to the grid, and as much of the solar power minus load power as the battery plan affords
+                # (see BatteryPlan). If the appliances already use more, the lowest prioritized ones are switched off
+                # until they fit.
+                affordable_power = (
+                    BatteryPlan.affordable_power(group, avg_load_power)
+                    - group.planned_pwr_load
+                )
+                export_power = group.export_history.window_avg(
+                    inst.config.appliance_switch_interval
+                )
+                export_power_off = group.export_history.window_avg(
+                    inst.config.appliance_switch_off_interval
+                )
+                # exported power is never charged into the battery, solar power which is not even enough for the
+                # load is never affordable. Without export, the appliances exceeding the plan have to be switched off.
+                avg_excess_power = min(
+                    group.pv_history.window_avg(inst.config.appliance_switch_interval),
+                    max(export_power, affordable_power)
+                    if export_power > 0
+                    else affordable_power,
+                )
+                avg_excess_power_off = min(
+                    group.pv_history.window_avg(
+                        inst.config.appliance_switch_off_interval
+                    ),
+                    max(export_power_off, affordable_power)
+                    if export_power_off > 0
+                    else affordable_power,
+                )
+                # the current controller follows the export power while the battery plan limits the appliances
+                inst.state.feedback_source = (
+                    "export" if avg_excess_power <= export_power else "excess"
+                )
+                Log.debug(
+                    lambda home_battery_level=home_battery_level, affordable_power=affordable_power, avg_excess_power=avg_excess_power: (
+                        f"Home battery charge is not sufficient ({home_battery_level}/{group.min_home_battery_level} %), "
+                        f"the battery plan affords {affordable_power} W more appliance power. "
+                        f"Calculated average excess power based on >> export power << and >> solar power - load power <<: "
+                        f"{avg_excess_power} W"
+                    ),
+                    inst,
+                )
+
+            # add instance including calculated excess power to the list, which is walked backwards (priority from low
+            # to high) below
+            instances.append(
+                {
+                    "instance": inst,
+                    "avg_excess_power": avg_excess_power,
+                    "avg_excess_power_off": avg_excess_power_off,
+                },
+            )
+            if group.allocation_mode == "optimal":
+                # switching is decided for all appliances at once below
+                continue
 
-                # add instance including calculated excess power to inverted list (priority from low to high)
-                instances.insert(
-                    0,
-                    {
-                        "instance": inst,
-                        "avg_excess_power": avg_excess_power,
-                        "avg_excess_power_off": avg_excess_power_off,
-                    },
+            # Prevent the appliance from turning on if it already run its maximum daily runtime
+            if (
+                inst.config.appliance_maximum_run_time > 0
+                and (inst.state.daily_run_time / 60)
+                > inst.config.appliance_maximum_run_time
+            ):
+                Log.debug(
+                    "Appliance has already run its maximum daily runtime, not turning on",
+                    inst,
                 )
+                continue
 
-                # Prevent the appliance from turning on if it already run its maximum daily runtime
+            # -------------------------------------------------------------------
+            # Determine if appliance can be turned on or current can be increased
+            if _get_state(inst.config.appliance_switch) == "on":
+                # check if current of appliance can be increased
+                run_time = (
+                    inst.state.daily_run_time
+                    + (
+                        datetime.datetime.now() - inst.state.switched_on_time
+                    ).total_seconds()
+                ) / 60
+                Log.debug(
+                    lambda run_time=run_time: (
+                        f"Appliance is already switched on and has run for {(run_time):.1f} minutes."
+                    ),
+                    inst,
+                )
                 if (
-                    inst.appliance_maximum_run_time > 0
-                    and (inst.daily_run_time / 60) > inst.appliance_maximum_run_time
+                    avg_excess_power >= PvExcessControl.min_excess_power
+                    and inst.config.dynamic_current_appliance
+                    and inst.config.current_control == "step"
                 ):
-                    log.debug(
-                        f"{inst.log_prefix} Appliance has already run its maximum daily runtime, not turning on"
+                    # try to increase dynamic current, because excess solar power is available
+                    actual_current, diff_current, target_current = _target_current(
+                        self._calculate_power_consumption(inst),
+                        avg_excess_power,
+                        inst.config.phase_power,
+                        inst.config.min_current,
+                        inst.config.max_current,
+                        inst.config.round_target_current,
                     )
-                    continue
-
-                # -------------------------------------------------------------------
-                # Determine if appliance can be turned on or current can be increased
-                if _get_state(inst.appliance_switch) == "on":
-                    # check if current of appliance can be increased
-                    run_time = (
-                        inst.daily_run_time
-                        + (
-                            datetime.datetime.now() - inst.switched_on_time
-                        ).total_seconds()
-                    ) / 60
-                    log.debug(
-                        f"{inst.log_prefix} Appliance is already switched on and has run for {(run_time):.1f} minutes."
+                    # TODO: prev_set_amps or just actual_current?
+                    prev_set_amps = _get_num_state(
+                        inst.config.appliance_current_set_entity,
+                        return_on_error=inst.config.min_current,
                     )
+                    Log.debug(
+                        lambda prev_set_amps=prev_set_amps, actual_current=actual_current, diff_current=diff_current, target_current=target_current, inst=inst: (
+                            f"{prev_set_amps=}A | {actual_current=}A | {diff_current=}A | {target_current=}A | Round: {inst.config.round_target_current}"
+                        ),
+                        inst,
+                    )
+                    # TODO: minimum current step should be made configurable (e.g. 1A)
+                    # increase current if following conditions are met
+                    # - current has to be increased
+                    # - previously set current was above minimum, alternatively  if appliance can run at min current partially on solar
+                    # - If appliance was not just turned on from 0 in last round (as some chargers take a minute to start charging)
                     if (
-                        avg_excess_power >= PvExcessControl.min_excess_power
-                        and inst.dynamic_current_appliance
-                    ):
-                        # try to increase dynamic current, because excess solar power is available
-                        actual_current = round(
-                            self._calculate_power_consumption(inst)
-                            / (PvExcessControl.grid_voltage * inst.phases),
-                            1,
-                        )
-                        # TODO: prev_set_amps or just actual_current?
-                        prev_set_amps = _get_num_state(
-                            inst.appliance_current_set_entity,
-                            return_on_error=inst.min_current,
+                        prev_set_amps < target_current
+                        and (
+                            prev_set_amps >= inst.config.min_current
+                            or (
+                                prev_set_amps < inst.config.min_current
+                                and diff_current
+                                > inst.config.min_solar_fraction
+                                * inst.config.min_current
+                            )
                         )
-                        diff_current = round(
-                            avg_excess_power
-                            / (PvExcessControl.grid_voltage * inst.phases),
-                            1,
+                        and not (
+                            inst.state.previous_current_buffer == 0
+                            and actual_current > 0
                         )
-                        if inst.round_target_current:
-                            target_current = int(
-                                max(
-                                    inst.min_current,
-                                    min(
-                                        actual_current + diff_current, inst.max_current
-                                    ),
-                                ),
+                    ):
+                        if (
+                            inst.state.current_interval_counter
+                            >= inst.config.appliance_current_interval
+                        ):
+                            _set_value(
+                                inst.config.appliance_current_set_entity, target_current
+                            )
+                            Log.info(
+                                "Increasing dynamic current appliance (per phase).",
+                                inst,
+                                current_from=prev_set_amps,
+                                current_to=target_current,
+                                interval=f"{inst.state.current_interval_counter}/{inst.config.appliance_current_interval}",
                             )
+                            inst.state.current_interval_counter = 0
                         else:
-                            target_current = round(
-                                max(
-                                    inst.min_current,
-                                    min(
-                                        actual_current + diff_current, inst.max_current
-                                    ),
+                            Log.debug(
+                                lambda inst=inst: (
+                                    f"Cannot change current appliance, because appliance current interval is not reached "
+                                    f"({inst.state.current_interval_counter}/{inst.config.appliance_current_interval})."
                                 ),
-                                1,
+                                inst,
                             )
-                        log.debug(
-                            f"{inst.log_prefix} {prev_set_amps=}A | {actual_current=}A | {diff_current=}A | {target_current=}A | Round: {inst.round_target_current}"
+                        # TODO: should we use previously set current below there?
+                        diff_power = int(
+                            (target_current - actual_current) * inst.config.phase_power
                         )
-                        # TODO: minimum current step should be made configurable (e.g. 1A)
-                        # increase current if following conditions are met
-                        # - current has to be increased
-                        # - previously set current was above minimum, alternatively  if appliance can run at min current partially on solar
-                        # - If appliance was not just turned on from 0 in last round (as some chargers take a minute to start charging)
-                        if (
-                            prev_set_amps < target_current
-                            and (
-                                prev_set_amps >= inst.min_current
-                                or (
-                                    prev_set_amps < inst.min_current
-                                    and diff_current
-                                    > inst.min_solar_percent * inst.min_current
-                                )
-                            )
-                            and not (
-                                inst.previous_current_buffer == 0 and actual_current > 0
-                            )
-                        ):
-                            if (
-                                inst.current_interval_counter
-                                >= inst.appliance_current_interval
-                            ):
-                                _set_value(
-                                    inst.appliance_current_set_entity, target_current
-                                )
-                                log.info(
-                                    f"{inst.log_prefix} Increasing dynamic current appliance from {prev_set_amps}A to {target_current}A per phase "
-                                    f"({inst.current_interval_counter}/{inst.appliance_current_interval})."
-                                )
-                                inst.current_interval_counter = 0
-                            else:
-                                log.debug(
-                                    f"{inst.log_prefix} Cannot change current appliance, because appliance current interval is not reached "
-                                    f"({inst.current_interval_counter}/{inst.appliance_current_interval})."
-                                )
-                            # TODO: should we use previously set current below there?
-                            diff_power = int(
-                                (target_current - actual_current)
-                                * PvExcessControl.grid_voltage
-                                * inst.phases
-                            )
-                            # "restart" history by subtracting power difference from each history value within the specified time frame
-                            log.info(
-                                f"{inst.log_prefix} Adjusting power history by {-diff_power}W due to increasing dynamic current of appliance from {prev_set_amps}A to {target_current}A per phase."
-                            )
-                            self._adjust_pwr_history(inst, -diff_power)
-                        inst.previous_current_buffer = actual_current
-
-                elif not (inst.appliance_once_only and inst.switched_on_today):
-                    # check if appliance can be switched on
-                    if _get_state(inst.appliance_switch) != "off":
-                        log.warning(
-                            f"{inst.log_prefix} Appliance state (={_get_state(inst.appliance_switch)}) is neither ON nor OFF. "
-                            f"Assuming OFF state."
+                        # "restart" history by subtracting power difference from each history value within the specified time frame
+                        Log.info(
+                            "Adjusting power history due to increasing dynamic current of appliance (per phase).",
+                            inst,
+                            offset=-diff_power,
+                            current_from=prev_set_amps,
+                            current_to=target_current,
                         )
+                        self._adjust_pwr_history(inst, -diff_power)
+                    inst.state.previous_current_buffer = actual_current
 
-                    # Check if there is sufficient excess power to power the appliance
-                    #   or if the appliance has a high priority (see #64)
-                    #   or if the appliance should be turned anyways to meet appliance_minimum_run_time
-                    defined_power = int(self._estimate_power_consumption(inst))
+            elif not (inst.config.appliance_once_only and inst.state.switched_on_today):
+                # check if appliance can be switched on
+                if _get_state(inst.config.appliance_switch) != "off":
+                    Log.warning(
+                        f"Appliance state (={_get_state(inst.config.appliance_switch)}) is neither ON nor OFF. "
+                        f"Assuming OFF state.",
+                        inst,
+                    )
+
+                # Check if there is sufficient excess power to power the appliance
+                #   or if the appliance has a high priority (see #64)
+                #   or if the appliance should be turned anyways to meet appliance_minimum_run_time
+                defined_power = int(self._estimate_power_consumption(inst))
+                if (
+                    avg_excess_power >= defined_power
+                    or (inst.config.appliance_priority > 1000 and avg_excess_power > 0)
+                    or self._force_minimum_runtime(
+                        inst, (inst.state.daily_run_time / 60), avg_excess_power
+                    )
+                    or (
+                        avg_excess_power
+                        >= int(defined_power * inst.config.min_solar_fraction)
+                        and inst.config.dynamic_current_appliance
+                    )
+                ):
+                    Log.debug(
+                        lambda avg_excess_power=avg_excess_power, defined_power=defined_power, inst=inst: (
+                            f"Average Excess power ({avg_excess_power} W) is high enough to switch on appliance with {defined_power} or appliance has high priority {inst.config.appliance_priority} or it didn't meet minimum runtime yet or minimum solar power percentage (to start) fits: {defined_power * inst.config.min_solar_fraction}."
+                        ),
+                        inst,
+                    )
                     if (
-                        avg_excess_power >= defined_power
-                        or (inst.appliance_priority > 1000 and avg_excess_power > 0)
-                        or self._force_minimum_runtime(
-                            inst, (inst.daily_run_time / 60), avg_excess_power
+                        inst.state.switch_interval_counter
+                        >= inst.config.appliance_switch_interval
+                    ):
+                        self.switch_on(inst)
+                        inst.state.switch_interval_counter = 0
+                        inst.state.current_interval_counter = 0
+                        Log.info(
+                            "Switched on appliance. Adjusting power history due to start of appliance.",
+                            inst,
+                            offset=-defined_power,
                         )
-                        or (
-                            avg_excess_power
-                            >= int(defined_power * inst.min_solar_percent)
-                            and inst.dynamic_current_appliance
+                        # "restart" history by subtracting defined power from each history value within the specified time frame
+                        self._adjust_pwr_history(inst, -defined_power)
+                        if inst.config.dynamic_current_appliance:
+                            _set_value(
+                                inst.config.appliance_current_set_entity,
+                                inst.config.min_current,
+                            )
+                    else:
+                        Log.debug(
+                            lambda inst=inst: (
+                                f"Cannot switch on appliance, because appliance switch interval is not reached "
+                                f"({inst.state.switch_interval_counter}/{inst.config.appliance_switch_interval})."
+                            ),
+                            inst,
                         )
+                elif (
+                    not switched_off_appliance_to_switch_on_higher_prioritized_one
+                ) and (
+                    self._calculate_pwr_reducible(inst.config.appliance_priority)
+                    + avg_excess_power
+                ) >= (defined_power if inst.config.appliance_priority <= 1000 else 0):
+                    # excess power is sufficient by switching off lower prioritized appliance(s)
+                    if (
+                        inst.state.switch_interval_counter
+                        >= inst.config.appliance_switch_interval
                     ):
-                        log.debug(
-                            f"{inst.log_prefix} Average Excess power ({avg_excess_power} W) is high enough to switch on appliance with {defined_power} or appliance has high priority {inst.appliance_priority} or it didn't meet minimum runtime yet or minimum solar power percentage (to start) fits: {defined_power * inst.min_solar_percent}."
+                        self.switch_on(inst)
+                        inst.state.switch_interval_counter = 0
+                        inst.state.current_interval_counter = 0
+                        switched_off_appliance_to_switch_on_higher_prioritized_one = (
+                            True
                         )
-                        if (
-                            inst.switch_interval_counter
-                            >= inst.appliance_switch_interval
-                        ):
-                            self.switch_on(inst)
-                            inst.switch_interval_counter = 0
-                            inst.current_interval_counter = 0
-                            log.info(
-                                f"{inst.log_prefix} Switched on appliance. "
-                                f"Adjusting power history by {-defined_power}W due to start of appliance"
-                            )
-                            # "restart" history by subtracting defined power from each history value within the specified time frame
-                            self._adjust_pwr_history(inst, -defined_power)
-                            task.sleep(1)
-                            if inst.dynamic_current_appliance:
-                                _set_value(
-                                    inst.appliance_current_set_entity, inst.min_current
-                                )
-                        else:
-                            log.debug(
-                                f"{inst.log_prefix} Cannot switch on appliance, because appliance switch interval is not reached "
-                                f"({inst.switch_interval_counter}/{inst.appliance_switch_interval})."
-                            )
-                    elif (
-                        not switched_off_appliance_to_switch_on_higher_prioritized_one
-                    ) and (
-                        self._calculate_pwr_reducible(inst.appliance_priority)
-                        + avg_excess_power
-                    ) >= (defined_power if inst.appliance_priority <= 1000 else 0):
-                        # excess power is sufficient by switching off lower prioritized appliance(s)
-                        if (
-                            inst.switch_interval_counter
-                            >= inst.appliance_switch_interval
-                        ):
-                            self.switch_on(inst)
-                            inst.switch_interval_counter = 0
-                            inst.current_interval_counter = 0
-                            switched_off_appliance_to_switch_on_higher_prioritized_one = True
-                            log.info(
-                                f"{inst.log_prefix} Average Excess power will be high enough by switching off lower prioritized appliance(s). Switched on appliance."
+                        Log.info(
+                            "Average Excess power will be high enough by switching off lower prioritized appliance(s). Switched on appliance.",
+                            inst,
+                        )
+                        # "restart" history by subtracting defined power from each history value within the specified time frame
+                        self._adjust_pwr_history(inst, -defined_power)
+                        if inst.config.dynamic_current_appliance:
+                            _set_value(
+                                inst.config.appliance_current_set_entity,
+                                inst.config.min_current,
                             )
-                            # "restart" history by subtracting defined power from each history value within the specified time frame
-                            self._adjust_pwr_history(inst, -defined_power)
-                            task.sleep(1)
-                            if inst.dynamic_current_appliance:
-                                _set_value(
-                                    inst.appliance_current_set_entity, inst.min_current
-                                )
+                else:
+                    Log.debug(
+                        lambda avg_excess_power=avg_excess_power, defined_power=defined_power, inst=inst: (
+                            f"Average Excess power ({avg_excess_power} W) not high enough to switch on appliance with {defined_power} or appliance has high priority {inst.config.appliance_priority} or it didn't meet minimum runtime yet or minimum solar power percentage (to start) fits: {defined_power * inst.config.min_solar_fraction}."
+                        ),
+                        inst,
+                    )
+            # -------------------------------------------------------------------
+
+        if group.allocation_mode == "optimal":
+            self._allocate(instances)
+            return
+
+        # ----------------------------------- go through each appliance (lowest prio to highest prio) ----------------------------------
+        # this is for determining which devices need to be switched off or decreased in current
+        prev_consumption_sum = 0
+        for dic in reversed(instances):
+            inst = dic["instance"]
+            avg_excess_power = dic["avg_excess_power"] + prev_consumption_sum
+            avg_excess_power_off = dic["avg_excess_power_off"] + prev_consumption_sum
+
+            # -------------------------------------------------------------------
+            if _get_state(inst.config.appliance_switch) == "on":
+                # check if inst.config.appliance_priority > 1000 and switching of will cause excess. In that case keep it on
+                if inst.config.appliance_priority > 1000:
+                    allowed_excess_power_consumption = (
+                        self._calculate_power_consumption(inst)
+                    )
+                # 07.03.2025 elif inst.config.dynamic_current_appliance:
+                #    allowed_excess_power_consumption = (
+                #        inst.config.defined_current
+                #        * inst.config.phase_power
+                #        * (1 - inst.config.min_solar_fraction)
+                # 07.03.2025    )
+                else:
+                    allowed_excess_power_consumption = 0
+
+                # Check if appliance already run its maximum runtime and if so, turn it off
+                # TODO: this approach does not work when the appliance gets switched on manually, outside of this automation
+                run_time = (
+                    inst.state.daily_run_time
+                    + (
+                        datetime.datetime.now() - inst.state.switched_on_time
+                    ).total_seconds()
+                ) / 60
+                Log.debug(
+                    lambda run_time=run_time, inst=inst: (
+                        f"Appliance is on, and it has run for {run_time:.1f} out of maximum {inst.config.appliance_maximum_run_time:.1f} minutes"
+                    ),
+                    inst,
+                )
+                if (
+                    inst.config.appliance_maximum_run_time > 0
+                    and run_time > inst.config.appliance_maximum_run_time
+                ):
+                    Log.info(
+                        "Appliance has already run its maximum daily runtime, turning off",
+                        inst,
+                    )
+                    power_consumption = self.switch_off(inst)
+                    if power_consumption != 0:
+                        prev_consumption_sum += power_consumption
+                        Log.debug(
+                            lambda power_consumption=power_consumption, prev_consumption_sum=prev_consumption_sum: (
+                                f"Added {power_consumption=} W to prev_consumption_sum, "
+                                f"which is now {prev_consumption_sum} W."
+                            ),
+                            inst,
+                        )
+                    continue
+
+                # Note that we add the current appliance usage to the appliance excess power, because we want to continue
+                # running if the current appliance is only partially using excess power
+                power_consumption = self._calculate_power_consumption(inst)
+                appliance_excess_power = avg_excess_power + power_consumption
+
+                # Check if we don't have enough excess power and if we aren't trying to meet a minimum run time --> Turn off
+                if (
+                    avg_excess_power
+                    < PvExcessControl.min_excess_power
+                    - allowed_excess_power_consumption
+                    and not self._force_minimum_runtime(
+                        inst, run_time, appliance_excess_power
+                    )
+                ):
+                    if avg_excess_power < PvExcessControl.min_excess_power:
+                        Log.debug(
+                            lambda avg_excess_power=avg_excess_power: (
+                                f"Average Excess Power ({avg_excess_power} W) is less than minimum excess power "
+                                f"({PvExcessControl.min_excess_power} W)."
+                            ),
+                            inst,
+                        )
                     else:
-                        log.debug(
-                            f"{inst.log_prefix} Average Excess power ({avg_excess_power} W) not high enough to switch on appliance with {defined_power} or appliance has high priority {inst.appliance_priority} or it didn't meet minimum runtime yet or minimum solar power percentage (to start) fits: {defined_power * inst.min_solar_percent}."
+                        Log.debug(
+                            lambda power_consumption=power_consumption, appliance_excess_power=appliance_excess_power: (
+                                f"The appliance {power_consumption}W is not using any excess power {appliance_excess_power}W"
+                            ),
+                            inst,
                         )
-                # -------------------------------------------------------------------
-
-            # ----------------------------------- go through each appliance (lowest prio to highest prio) ----------------------------------
-            # this is for determining which devices need to be switched off or decreased in current
-            prev_consumption_sum = 0
-            for dic in instances:
-                inst = dic["instance"]
-                avg_excess_power = dic["avg_excess_power"] + prev_consumption_sum
-                avg_excess_power_off = (
-                    dic["avg_excess_power_off"] + prev_consumption_sum
-                )
 
-                # -------------------------------------------------------------------
-                if _get_state(inst.appliance_switch) == "on":
-                    # check if inst.appliance_priority > 1000 and switching of will cause excess. In that case keep it on
-                    if inst.appliance_priority > 1000:
-                        allowed_excess_power_consumption = (
-                            self._calculate_power_consumption(inst)
+                    # check if current of dyn. curr. appliance can be reduced
+                    if inst.config.dynamic_current_appliance:
+                        # diff_current is used to eventually lower current every interval. The current is only
+                        # limited by the minimum current here.
+                        actual_current, diff_current, target_current = _target_current(
+                            self._calculate_power_consumption(inst),
+                            avg_excess_power,
+                            inst.config.phase_power,
+                            inst.config.min_current,
+                            float("inf"),
+                            inst.config.round_target_current,
                         )
-                    # 07.03.2025 elif inst.dynamic_current_appliance:
-                    #    allowed_excess_power_consumption = (
-                    #        inst.defined_current
-                    #        * PvExcessControl.grid_voltage
-                    #        * inst.phases
-                    #        * (1 - inst.min_solar_percent)
-                    # 07.03.2025    )
-                    else:
-                        allowed_excess_power_consumption = 0
-
-                    # Check if appliance already run its maximum runtime and if so, turn it off
-                    # TODO: this approach does not work when the appliance gets switched on manually, outside of this automation
-                    run_time = (
-                        inst.daily_run_time
-                        + (
-                            datetime.datetime.now() - inst.switched_on_time
-                        ).total_seconds()
-                    ) / 60
-                    log.debug(
-                        f"{inst.log_prefix} Appliance is on, and it has run for {run_time:.1f} out of maximum {inst.appliance_maximum_run_time:.1f} minutes"
-                    )
-                    if (
-                        inst.appliance_maximum_run_time > 0
-                        and run_time > inst.appliance_maximum_run_time
-                    ):
-                        log.info(
-                            f"{inst.log_prefix} Appliance has already run its maximum daily runtime, turning off"
+                        # TODO: prev_set_amps or just actual_current?
+                        prev_set_amps = _get_num_state(
+                            inst.config.appliance_current_set_entity,
+                            return_on_error=inst.config.max_current,
                         )
-                        power_consumption = self.switch_off(inst)
-                        if power_consumption != 0:
-                            prev_consumption_sum += power_consumption
-                            log.debug(
-                                f"{inst.log_prefix} Added {power_consumption=} W to prev_consumption_sum, "
-                                f"which is now {prev_consumption_sum} W."
-                            )
-                        continue
-
-                    # Note that we add the current appliance usage to the appliance excess power, because we want to continue
-                    # running if the current appliance is only partially using excess power
-                    power_consumption = self._calculate_power_consumption(inst)
-                    appliance_excess_power = avg_excess_power + power_consumption
-
-                    # Check if we don't have enough excess power and if we aren't trying to meet a minimum run time --> Turn off
-                    if (
-                        avg_excess_power
-                        < PvExcessControl.min_excess_power
-                        - allowed_excess_power_consumption
-                        and not self._force_minimum_runtime(
-                            inst, run_time, appliance_excess_power
+                        # diff_current_off is evaluated over the switch off interval and it is therefore used to turn off appliance
+                        diff_current_off = round(
+                            avg_excess_power_off / inst.config.phase_power,
+                            1,
                         )
-                    ):
-                        if avg_excess_power < PvExcessControl.min_excess_power:
-                            log.debug(
-                                f"{inst.log_prefix} Average Excess Power ({avg_excess_power} W) is less than minimum excess power "
-                                f"({PvExcessControl.min_excess_power} W)."
-                            )
-                        else:
-                            log.debug(
-                                f"{inst.log_prefix} The appliance {power_consumption}W is not using any excess power {appliance_excess_power}W"
-                            )
-
-                        # check if current of dyn. curr. appliance can be reduced
-                        if inst.dynamic_current_appliance:
-                            actual_current = round(
-                                self._calculate_power_consumption(inst)
-                                / (PvExcessControl.grid_voltage * inst.phases),
-                                1,
-                            )
-                            # TODO: prev_set_amps or just actual_current?
-                            prev_set_amps = _get_num_state(
-                                inst.appliance_current_set_entity,
-                                return_on_error=inst.max_current,
-                            )
-                            # diff_current is used to eventually lower current every interval
-                            # diff_current_off is evaluated over the switch off interval and it is therefore used to turn off appliance
-                            diff_current = round(
-                                avg_excess_power
-                                / (PvExcessControl.grid_voltage * inst.phases),
-                                1,
-                            )
-                            diff_current_off = round(
-                                avg_excess_power_off
-                                / (PvExcessControl.grid_voltage * inst.phases),
-                                1,
+                        Log.debug(
+                            lambda prev_set_amps=prev_set_amps, actual_current=actual_current, diff_current=diff_current, target_current=target_current, inst=inst: (
+                                f"{prev_set_amps=}A | {actual_current=}A | {diff_current=}A | {target_current=}A | Round: {inst.config.round_target_current}"
+                            ),
+                            inst,
+                        )
+                        if (
+                            inst.config.current_control == "pi"
+                            and prev_set_amps > inst.config.min_current
+                        ):
+                            # switched off only once the current controller reached the minimum current
+                            Log.debug(
+                                "Leaving the reduction of the current to the current controller.",
+                                inst,
                             )
-                            if inst.round_target_current:
-                                target_current = int(
-                                    max(
-                                        inst.min_current, actual_current + diff_current
-                                    ),
+                        elif inst.config.min_current <= target_current < prev_set_amps:
+                            # current can be reduced
+                            if (
+                                inst.state.current_interval_counter
+                                >= inst.config.appliance_current_interval
+                            ):
+                                _set_value(
+                                    inst.config.appliance_current_set_entity,
+                                    target_current,
+                                )
+                                Log.info(
+                                    "Reducing dynamic current appliance (per phase).",
+                                    inst,
+                                    current_from=prev_set_amps,
+                                    current_to=target_current,
+                                    interval=f"{inst.state.current_interval_counter}/{inst.config.appliance_current_interval}",
                                 )
+                                inst.state.current_interval_counter = 0
                             else:
-                                target_current = round(
-                                    max(
-                                        inst.min_current, actual_current + diff_current
+                                Log.debug(
+                                    lambda inst=inst: (
+                                        f"Cannot change current appliance, because appliance current interval is not reached "
+                                        f"({inst.state.current_interval_counter}/{inst.config.appliance_current_interval})."
                                     ),
-                                    1,
+                                    inst,
                                 )
-                            log.debug(
-                                f"{inst.log_prefix} {prev_set_amps=}A | {actual_current=}A | {diff_current=}A | {target_current=}A | Round: {inst.round_target_current}"
+                            # add released power consumption to next appliances in list
+                            diff_power = int(
+                                (actual_current - target_current)
+                                * inst.config.phase_power
                             )
-                            if inst.min_current <= target_current < prev_set_amps:
-                                # current can be reduced
-                                if (
-                                    inst.current_interval_counter
-                                    >= inst.appliance_current_interval
-                                ):
-                                    _set_value(
-                                        inst.appliance_current_set_entity,
-                                        target_current,
-                                    )
-                                    log.info(
-                                        f"{inst.log_prefix} Reducing dynamic current appliance from {prev_set_amps}A to {target_current}A per phase "
-                                        f"({inst.current_interval_counter}/{inst.appliance_current_interval})."
-                                    )
-                                    inst.current_interval_counter = 0
-                                else:
-                                    log.debug(
-                                        f"{inst.log_prefix} Cannot change current appliance, because appliance current interval is not reached "
-                                        f"({inst.current_interval_counter}/{inst.appliance_current_interval})."
-                                    )
-                                # add released power consumption to next appliances in list
-                                diff_power = int(
-                                    (actual_current - target_current)
-                                    * PvExcessControl.grid_voltage
-                                    * inst.phases
-                                )
-                                prev_consumption_sum += diff_power
-                                log.debug(
-                                    f"{inst.log_prefix} Added {diff_power=} W to prev_consumption_sum, "
+                            prev_consumption_sum += diff_power
+                            Log.debug(
+                                lambda diff_power=diff_power, prev_consumption_sum=prev_consumption_sum: (
+                                    f"Added {diff_power=} W to prev_consumption_sum, "
                                     f"which is now {prev_consumption_sum} W."
+                                ),
+                                inst,
+                            )
+                            # "restart" history by adding defined power to each history value within the specified time frame
+                            Log.info(
+                                "Adjusting power history due to dynamic reduction of appliance power.",
+                                inst,
+                                offset=diff_power,
+                            )
+                            self._adjust_pwr_history(inst, diff_power)
+                        else:
+                            if diff_current_off >= -(
+                                inst.config.min_current
+                                - (
+                                    inst.config.min_current
+                                    * inst.config.min_solar_fraction
                                 )
-                                # "restart" history by adding defined power to each history value within the specified time frame
-                                log.info(
-                                    f"{inst.log_prefix} Adjusting power history by {diff_power}W due to dynamic redution of appliance power"
+                            ):
+                                Log.debug(
+                                    lambda inst=inst, diff_current_off=diff_current_off: (
+                                        f"leaving dynamic appliance on at minimum current {inst.config.min_current} on at least {inst.config.min_solar_fraction} solar - diff_current_off {diff_current_off}"
+                                    ),
+                                    inst,
                                 )
-                                self._adjust_pwr_history(inst, diff_power)
                             else:
-                                if diff_current_off >= -(
-                                    inst.min_current
-                                    - (inst.min_current * inst.min_solar_percent)
-                                ):
-                                    log.debug(
-                                        f"{inst.log_prefix} leaving dynamic appliance on at minimum current {inst.min_current} on at least {inst.min_solar_percent} solar - diff_current_off {diff_current_off}"
+                                # current cannot be reduced
+                                # Set current to 0 and turn off appliance
+                                Log.debug(
+                                    lambda inst=inst, diff_current_off=diff_current_off: (
+                                        f"switching dynamic appliance off min_current: {inst.config.min_current} min_solar_percent: {inst.config.min_solar_fraction} diff_current_off: {diff_current_off}"
+                                    ),
+                                    inst,
+                                )
+                                # Some wallboxes may need to set current to 0 for deactivating
+                                if inst.config.deactivating_current:
+                                    _set_value(
+                                        inst.config.appliance_current_set_entity, 0
                                     )
+                                # homeassistant.exceptions.ServiceValidationError: Value 0.0 for number.keba_p30_keba_p30_charging_current is outside valid range 6 - 10.0
                                 else:
-                                    # current cannot be reduced
-                                    # Set current to 0 and turn off appliance
-                                    log.debug(
-                                        f"{inst.log_prefix} switching dynamic appliance off min_current: {inst.min_current} min_solar_percent: {inst.min_solar_percent} diff_current_off: {diff_current_off}"
+                                    _set_value(
+                                        inst.config.appliance_current_set_entity,
+                                        inst.config.min_current,
                                     )
-                                    # Some wallboxes may need to set current to 0 for deactivating
-                                    if inst.deactivating_current:
-                                        _set_value(inst.appliance_current_set_entity, 0)
-                                    # homeassistant.exceptions.ServiceValidationError: Value 0.0 for number.keba_p30_keba_p30_charging_current is outside valid range 6 - 10.0
-                                    else:
-                                        _set_value(
-                                            inst.appliance_current_set_entity,
-                                            inst.min_current,
-                                        )
-                                    inst.previous_current_buffer = 0
-                                    power_consumption = self.switch_off(inst)
-                                    if power_consumption != 0:
-                                        prev_consumption_sum += power_consumption
-                                        log.debug(
-                                            f"{inst.log_prefix} Added {power_consumption=} W to prev_consumption_sum, "
+                                inst.state.previous_current_buffer = 0
+                                power_consumption = self.switch_off(inst)
+                                if power_consumption != 0:
+                                    prev_consumption_sum += power_consumption
+                                    Log.debug(
+                                        lambda power_consumption=power_consumption, prev_consumption_sum=prev_consumption_sum: (
+                                            f"Added {power_consumption=} W to prev_consumption_sum, "
                                             f"which is now {prev_consumption_sum} W."
-                                        )
-                        else:
-                            # Try to switch off appliance
-                            power_consumption = self.switch_off(inst)
-                            if power_consumption != 0:
-                                prev_consumption_sum += power_consumption
-                                log.debug(
-                                    f"{inst.log_prefix} Added {power_consumption=} W to prev_consumption_sum, "
-                                    f"which is now {prev_consumption_sum} W."
-                                )
+                                        ),
+                                        inst,
+                                    )
                     else:
-                        if avg_excess_power > PvExcessControl.min_excess_power:
-                            log.debug(
-                                f"{inst.log_prefix} Average Excess Power ({avg_excess_power} W) is still greater than minimum excess power "
-                                f"({PvExcessControl.min_excess_power} W) - Doing nothing."
+                        # Try to switch off appliance
+                        power_consumption = self.switch_off(inst)
+                        if power_consumption != 0:
+                            prev_consumption_sum += power_consumption
+                            Log.debug(
+                                lambda power_consumption=power_consumption, prev_consumption_sum=prev_consumption_sum: (
+                                    f"Added {power_consumption=} W to prev_consumption_sum, "
+                                    f"which is now {prev_consumption_sum} W."
+                                ),
+                                inst,
                             )
-
                 else:
-                    if _get_state(inst.appliance_switch) != "off":
-                        log.warning(
-                            f"{inst.log_prefix} Appliance state (={_get_state(inst.appliance_switch)}) is neither ON nor OFF. "
-                            f"Assuming OFF state."
+                    if avg_excess_power > PvExcessControl.min_excess_power:
+                        Log.debug(
+                            lambda avg_excess_power=avg_excess_power: (
+                                f"Average Excess Power ({avg_excess_power} W) is still greater than minimum excess power "
+                                f"({PvExcessControl.min_excess_power} W) - Doing nothing."
+                            ),
+                            inst,
                         )
-                    # Note: This can misfire right after an appliance has been switched on. Generally no problem.
-                    log.debug(f"{inst.log_prefix} Appliance is already switched off.")
-                # -------------------------------------------------------------------
 
-        return on_time
+            else:
+                if _get_state(inst.config.appliance_switch) != "off":
+                    Log.warning(
+                        f"Appliance state (={_get_state(inst.config.appliance_switch)}) is neither ON nor OFF. "
+                        f"Assuming OFF state.",
+                        inst,
+                    )
+                # Note: This can misfire right after an appliance has been switched on. Generally no problem.
+                Log.debug("Appliance is already switched off.", inst)
+            # -------------------------------------------------------------------
+
+    def _allocate(self, instances: list):
+        """
+        Optimal allocation mode: Instead of the greedy passes, distributes the averaged excess power among the
+        appliances at once (see _solve_allocation). On/off appliances are either off or on at their power. Dynamic
+        current appliances take any power between their minimum and maximum current, and are only started if
+        min_solar_percent of their minimum current is excess power. The allocation maximizes the excess power used by
+        the appliances, weighted by their priority.
+        Appliances within their switch interval, only-on appliances which are on and once-only appliances which already
+        ran keep their state. Appliances with a priority above 1000 or needing to run to meet their minimum runtime are
+        kept on, like appliances exceeding their maximum runtime are switched off.
+
+        :param instances:   List of dicts with the activated instances and their average excess power
+        """
+        if not instances:
+            return
+        now = datetime.datetime.now()
+        # lowest average of all appliance windows, i.e. excess power which was available on all time scales
+        excess = min([dic["avg_excess_power"] for dic in instances])
+        plans = []
+        pool = excess
+        for dic in instances:
+            inst = dic["instance"]
+            on = _get_state(inst.config.appliance_switch) == "on"
+            power = self._calculate_power_consumption(inst) if on else 0
+            # power of running appliances is available for reallocation
+            pool += power
+            plans.append({"instance": inst, "on": on, "power": power})
+
+        reserved = 0
+        for plan in plans:
+            inst = plan["instance"]
+            on = plan["on"]
+            run_time = inst.state.daily_run_time / 60
+            if on:
+                run_time += (now - inst.state.switched_on_time).total_seconds() / 60
+            can_switch = (
+                inst.state.switch_interval_counter
+                >= inst.config.appliance_switch_interval
+            )
+            max_reached = (
+                inst.config.appliance_maximum_run_time > 0
+                and run_time > inst.config.appliance_maximum_run_time
+            )
+            plan["ranged"] = inst.config.dynamic_current_appliance and (
+                not on
+                or inst.state.current_interval_counter
+                >= inst.config.appliance_current_interval
+            )
+            if on and (inst.config.appliance_on_only or not can_switch):
+                plan["keep"] = True
+            elif not on and (
+                not can_switch
+                or max_reached
+                or (inst.config.appliance_once_only and inst.state.switched_on_today)
+            ):
+                # stays off, not part of the allocation
+                plan["target"] = False
+                continue
+            elif on and max_reached:
+                Log.info(
+                    "Appliance has already run its maximum daily runtime, turning off",
+                    inst,
+                )
+                plan["target"] = False
+                continue
+            else:
+                plan["keep"] = (
+                    inst.config.appliance_priority > 1000 and pool > 0
+                ) or self._force_minimum_runtime(inst, run_time, pool)
+
+            if plan["ranged"]:
+                phase_power = inst.config.phase_power
+                # the appliance draws at least its minimum current, min_solar_percent only decides if it may start
+                low = inst.config.min_current * phase_power
+                high = inst.config.max_current * phase_power
+                if not on and pool < low * inst.config.min_solar_fraction:
+                    plan["target"] = False
+                    continue
+            else:
+                low = plan["power"] if on else self._estimate_power_consumption(inst)
+                high = low
+            if plan["keep"]:
+                # appliances kept on need their (minimum) power, dynamic ones can take more
+                plan["low"] = low
+                reserved += low
+                high -= low
+                low = 0
+            else:
+                plan["low"] = 0
+            plan["range"] = (low, high)
+
+        capacity = pool - reserved
+        resolution = max(
+            PvExcessControl.allocation_resolution,
+            capacity / PvExcessControl.allocation_cells,
+        )
+        cells = int(capacity / resolution) if capacity > 0 else 0
+        items = []
+        candidates = []
+        # tie-breaker, preferring the current state. Its sum stays below the value of one cell.
+        bonus = 0.5 / (len(plans) + 1)
+        for plan in plans:
+            if "range" not in plan or plan["range"][1] <= 0:
+                continue
+            low, high = plan["range"]
+            kmin = max(1, -int(-low // resolution))
+            kmax = kmin if high == low else max(kmin, int(high // resolution))
+            items.append(
+                (
+                    kmin,
+                    kmax,
+                    float(plan["instance"].config.appliance_priority),
+                    bonus if plan["on"] else 0,
+                )
+            )
+            candidates.append(plan)
+        chosen = _solve_allocation(cells, items) if cells > 0 else [0] * len(items)
+        for plan, k in zip(candidates, chosen):
+            plan["share"] = plan["low"] + k * resolution
+            if not plan["keep"]:
+                plan["target"] = k > 0
+
+        Log.debug(
+            lambda: (
+                f"Allocating {capacity:.0f} W excess power (resolution {resolution:.0f} W) to {len(items)} appliances: "
+                f"{sum(chosen)} of {cells} cells used."
+            ),
+            excess=excess,
+            reserved=round(reserved),
+        )
+        for plan in plans:
+            self._apply_allocation(plan)
+
+    def _apply_allocation(self, plan: dict):
+        """
+        Switches an appliance and sets its current according to its allocation.
+
+        :param plan:    Allocation of the appliance, see _allocate()
+        """
+        inst = plan["instance"]
+        target = plan.get("target", True)
+        if plan["on"] and not target:
+            if inst.config.dynamic_current_appliance:
+                # Some wallboxes may need to set current to 0 for deactivating
+                _set_value(
+                    inst.config.appliance_current_set_entity,
+                    0 if inst.config.deactivating_current else inst.config.min_current,
+                )
+                inst.state.previous_current_buffer = 0
+            self.switch_off(inst)
+            return
+        if not target or not plan["ranged"]:
+            if target and not plan["on"]:
+                defined_power = int(self._estimate_power_consumption(inst))
+                self.switch_on(inst)
+                inst.state.switch_interval_counter = 0
+                inst.state.current_interval_counter = 0
+                Log.info(
+                    "Switched on appliance by allocation. Adjusting power history due to start of appliance.",
+                    inst,
+                    offset=-defined_power,
+                )
+                self._adjust_pwr_history(inst, -defined_power)
+            return
+
+        phase_power = inst.config.phase_power
+        target_current = min(
+            inst.config.max_current,
+            max(inst.config.min_current, plan["share"] / phase_power),
+        )
+        if inst.config.round_target_current:
+            target_current = int(target_current)
+        else:
+            target_current = int(target_current * 10) / 10
+        if not plan["on"]:
+            self.switch_on(inst)
+            inst.state.switch_interval_counter = 0
+            inst.state.current_interval_counter = 0
+            _set_value(inst.config.appliance_current_set_entity, target_current)
+            start_power = int(target_current * phase_power)
+            Log.info(
+                "Switched on dynamic current appliance by allocation. Adjusting power history due to start of appliance.",
+                inst,
+                current_to=target_current,
+                offset=-start_power,
+            )
+            self._adjust_pwr_history(inst, -start_power)
+            return
+
+        actual_current = round(plan["power"] / phase_power, 1)
+        prev_set_amps = _get_num_state(
+            inst.config.appliance_current_set_entity,
+            return_on_error=inst.config.min_current,
+        )
+        inst.state.previous_current_buffer = actual_current
+        if target_current == prev_set_amps or inst.config.current_control == "pi":
+            # the current of running appliances with "pi" current control is set by the CurrentController
+            return
+        _set_value(inst.config.appliance_current_set_entity, target_current)
+        inst.state.current_interval_counter = 0
+        diff_power = int((target_current - actual_current) * phase_power)
+        Log.info(
+            "Changing dynamic current appliance (per phase) by allocation. Adjusting power history.",
+            inst,
+            current_from=prev_set_amps,
+            current_to=target_current,
+            offset=-diff_power,
+        )
+        self._adjust_pwr_history(inst, -diff_power)
 
     @staticmethod
-    def _update_pv_history():
+    def _update_pv_history(group):
         """
-        Update Export and PV history
+        Update Export and PV history with the time-weighted averages of the power signals over the last minute
+
+        :param group:   ControlGroup
+        :return:        True if the history was updated
         """
+        now = _power_timestamp()
+        avg = {
+            name: _roll_power(signal, now)
+            for name, signal in group.power_signals.items()
+        }
         try:
-            current_appliance_pwr_load = 0
-            pv_power_state = _get_num_state(PvExcessControl.pv_power)
-            # Go through all appliances to get actual total appliance power
-
-            for e in PvExcessControl.instances.values():
-                inst = e["instance"]
-                if _get_state(inst.appliance_switch) == "on":
-                    if inst.actual_power is None:
-                        power_consumption = (
-                            inst.defined_current
-                            * PvExcessControl.grid_voltage
-                            * inst.phases
-                        )
-                    else:
-                        power_consumption = _get_num_state(inst.actual_power)
+            export_pwr, excess_pwr, load_pwr = PvExcessControl._history_values(
+                group, avg
+            )
+        except Exception as e:
+            Log.error(f"Could not update Export/PV history!: {e}")
+            return False
 
-                    current_appliance_pwr_load = (
-                        current_appliance_pwr_load + power_consumption
-                    )
-            log.debug(
-                f"Update_pv_history actual total appliance power: {current_appliance_pwr_load}W"
+        # add avg to history (the oldest value is dropped, max. 60 minute length of history)
+        group.export_history.append(round(export_pwr))
+        group.pv_history.append(round(excess_pwr))
+        group.load_history.append(round(load_pwr))
+        # the averages cover the last minute
+        minute = datetime.datetime.now() - datetime.timedelta(seconds=30)
+        group.load_profile.add(round(load_pwr), minute)
+        if avg["pv"] is not None:
+            group.solar_profile.add(round(avg["pv"]), minute)
+        if Log.enabled():
+            Log.debug(
+                "Updated power histories.",
+                export=group.export_history.values(),
+                excess=group.pv_history.values(),
+                load=group.load_history.values(),
             )
+        return True
 
-            if PvExcessControl.import_export_power:
-                # Calc values based on combined import/export power sensor
-                import_export_state = _get_num_state(
-                    PvExcessControl.import_export_power
-                )
-                if import_export_state is None:
-                    raise Exception(
-                        f"Could not update Export/PV history: {PvExcessControl.import_export_power} is None."
-                    )
-                import_export = int(import_export_state)
-                # load_pwr = pv_pwr + import_export
-                export_pwr = abs(min(0, import_export))
-                excess_pwr = -import_export
-                load_pwr = (
-                    int(pv_power_state) - excess_pwr - int(current_appliance_pwr_load)
+    @staticmethod
+    def _history_values(group, avg: dict) -> tuple:
+        """
+        Calculates the values for the Export, PV Excess and Load history from averaged power signals
+
+        :param group:   ControlGroup
+        :param avg:     Average power per power signal (see power_signals), None if unknown
+        :return:        Tuple of export, excess and load power in W
+        """
+        current_appliance_pwr_load = avg["appliances"] or 0
+        pv_power_state = avg["pv"]
+        Log.debug(
+            lambda: (
+                f"Update_pv_history average total appliance power: {current_appliance_pwr_load}W"
+            )
+        )
+
+        if group.import_export_power:
+            # Calc values based on combined import/export power sensor
+            import_export_state = avg["import_export"]
+            if import_export_state is None:
+                raise Exception(
+                    f"Could not update Export/PV history: {group.import_export_power} is None."
                 )
+            import_export = round(import_export_state)
+            # load_pwr = pv_pwr + import_export
+            export_pwr = round(avg["grid_export"])
+            excess_pwr = -import_export
+            load_pwr = round(pv_power_state - excess_pwr - current_appliance_pwr_load)
 
+        else:
+            # Calc values based on separate sensors
+            export_pwr_state = avg["export"]
+            load_power_state = avg["load"]
+            if group.home_battery_level is not None:
+                home_battery_level = _get_num_state(group.home_battery_level)
             else:
-                # Calc values based on separate sensors
-                export_pwr_state = _get_num_state(PvExcessControl.export_power)
-                load_power_state = _get_num_state(PvExcessControl.load_power)
-                if PvExcessControl.home_battery_level is not None:
-                    home_battery_level = _get_num_state(
-                        PvExcessControl.home_battery_level
-                    )
-                else:
-                    home_battery_level = None
-                if (
-                    export_pwr_state is None
-                    or pv_power_state is None
-                    or load_power_state is None
-                ):
-                    raise Exception(
-                        f"Could not update Export/PV history {PvExcessControl.export_power=} | {PvExcessControl.pv_power=} | "
-                        f"{PvExcessControl.load_power=} = {export_pwr_state=} | {pv_power_state=} | {load_power_state=}"
+                home_battery_level = None
+            if (
+                export_pwr_state is None
+                or pv_power_state is None
+                or load_power_state is None
+            ):
+                raise Exception(
+                    f"Could not update Export/PV history {group.export_power=} | {group.pv_power=} | "
+                    f"{group.load_power=} = {export_pwr_state=} | {pv_power_state=} | {load_power_state=}"
+                )
+            export_pwr = round(export_pwr_state)
+            load_pwr = round(load_power_state - current_appliance_pwr_load)
+            ## zero feed in is detected from the averages of the last minute
+            ## only applicable if not exporting to grid. likely to have separate sensors and export_pwr_state must be 0
+            ## 300 pv_power_state - load < 300 given there's always some hedge between production and current load when batteries are 100%
+            if (
+                group.zero_feed_in
+                and (
+                    (
+                        home_battery_level is not None
+                        and home_battery_level > group.zero_feed_in_level
                     )
-                export_pwr = int(export_pwr_state)
-                load_pwr = int(load_power_state) - int(current_appliance_pwr_load)
-                ## only applicable if not exporting to grid. likely to have separate sensors and export_pwr_state must be 0
-                ## 300 pv_power_state - load < 300 given there's always some hedge between production and current load when batteries are 100%
-                if (
-                    PvExcessControl.zero_feed_in
-                    and (
-                        (
-                            home_battery_level is not None
-                            and home_battery_level > PvExcessControl.zero_feed_in_level
+                    or home_battery_level is None
+                )
+                and export_pwr_state == 0
+                and (int(pv_power_state - load_power_state) < group.zero_feed_in_load)
+            ):
+                # load_power = _get_num_state(group.load_power)
+                ## recalc the average to forecast best case planned_excess.
+                solar = SolarContext.current(group)
+                if group.solar_production_forecast_this_hour:
+                    excess_pwr = solar.forecast_this_hour - load_power_state
+                    Log.debug(
+                        lambda: (
+                            f"Zero feed in active, excess calc based on current hour solar forecast. excess calc: {excess_pwr}"
                         )
-                        or home_battery_level is None
                     )
-                    and export_pwr_state == 0
-                    and (
-                        int(pv_power_state - load_power_state)
-                        < PvExcessControl.zero_feed_in_load
+                elif group.solar_production_forecast and solar.hours_until_sunset > 0:
+                    excess_pwr = _zero_feed_in_excess(
+                        solar.remaining_usage(
+                            load_power_state - current_appliance_pwr_load,
+                            current_appliance_pwr_load,
+                        ),
+                        solar.remaining_forecast,
+                        solar.hours_until_sunset,
                     )
-                ):
-                    # load_power = _get_num_state(PvExcessControl.load_power)
-                    ## recalc the average to forecast best case planned_excess.
-                    if PvExcessControl.solar_production_forecast_this_hour:
-                        remaining_hour_forecast = _get_num_state(
-                            PvExcessControl.solar_production_forecast_this_hour,
-                            return_on_error=0,
-                        )
-                        excess_pwr = remaining_hour_forecast - load_power_state
-                        log.debug(
-                            f"Zero feed in active, excess calc based on current hour solar forecast. excess calc: {excess_pwr}"
-                        )
-                    elif PvExcessControl.solar_production_forecast:
-                        remaining_forecast = _get_num_state(
-                            PvExcessControl.solar_production_forecast, return_on_error=0
-                        )
-                        # Calculate remaining overall load power usage until sunset, assuming current load
-                        sunset_string = _get_state(PvExcessControl.time_of_sunset)
-                        sunset_time = datetime.datetime.fromisoformat(sunset_string)
-                        time_now = datetime.datetime.now(datetime.timezone.utc)
-                        time_of_sunset = (sunset_time - time_now).total_seconds() / (
-                            60 * 60
-                        )
-                        # Calc values based on separate sensors
-                        remaining_usage = time_of_sunset * load_power_state / 1000
-                        ## todo create variable for power factor (1.2) to deal with non-linear PV production towards dusk
-                        excess_pwr = (
-                            (remaining_forecast - remaining_usage)
-                            / time_of_sunset
-                            * 1000
-                            * 1.2
-                        )
-                        log.debug(
+                    Log.debug(
+                        lambda: (
                             f"Zero feed in active, excess calc based on linear forecast of excess until dusk. excess calc: {excess_pwr}"
                         )
-                    else:
-                        excess_pwr = 0
-                        log.debug(
-                            f"Zero feed in active, but no solar production forecast configured. Zeroing excess calc; excess calc: {excess_pwr}"
-                        )
+                    )
                 else:
-                    excess_pwr = int(pv_power_state - load_power_state)
-                    log.debug(f"planned excess calc:  {excess_pwr}")
+                    excess_pwr = 0
+                    Log.debug(
+                        lambda: (
+                            f"Zero feed in active, but no solar production forecast configured or sun already set. Zeroing excess calc; excess calc: {excess_pwr}"
+                        )
+                    )
+            else:
+                excess_pwr = round(pv_power_state - load_power_state)
+                Log.debug(lambda: f"planned excess calc:  {excess_pwr}")
+        return export_pwr, excess_pwr, load_pwr
+
+    @staticmethod
+    def _warm_start_history(group):
+        """
+        Fills the power histories of a control group with the last hour of the power sensors from the recorder
+        database, so that the averages are valid from the first control pass. Runs once, in the first tick of the group
+        after startup (when all appliances are registered). Skipped if the histories were restored from the saved
+        state, or if the recorder does not use the default SQLite database.
+
+        :param group:   ControlGroup
+        """
+        group.warm_started = True
+        if group.restored_histories:
+            return
+        if PvExcessControl.recorder_db is None:
+            try:
+                PvExcessControl.recorder_db = hass.config.path("home-assistant_v2.db")
+            except NameError:
+                # hass is only available with hass_is_global enabled in the pyscript configuration
+                PvExcessControl.recorder_db = "/config/home-assistant_v2.db"
+        minutes = group.pv_history.capacity
+        start = _power_timestamp() - minutes * 60
+        sensors = {
+            "pv": group.pv_power,
+            "export": group.export_power,
+            "load": group.load_power,
+            "import_export": group.import_export_power,
+        }
+        sensors = {name: e_id for name, e_id in sensors.items() if e_id}
+        appliances = []
+        for inst in group.instances.descending:
+            appliances.append(
+                (inst, inst.config.actual_power or inst.config.appliance_switch)
+            )
+        entity_ids = list(
+            dict.fromkeys(list(sensors.values()) + [a[1] for a in appliances])
+        )
+        try:
+            points = task.executor(
+                _read_recorder_states, PvExcessControl.recorder_db, entity_ids, start
+            )
         except Exception as e:
-            log.error(f"Could not update Export/PV history!: {e}")
+            Log.error(
+                f"Could not read power history from {PvExcessControl.recorder_db}: {e}"
+            )
             return
-        else:
-            PvExcessControl.export_history_buffer.append(export_pwr)
-            PvExcessControl.pv_history_buffer.append(excess_pwr)
-            PvExcessControl.load_history_buffer.append(load_pwr)
-
-        # log.debug(f'Export History Buffer: {PvExcessControl.export_history_buffer}')
-        # log.debug(f'PV Excess (PV Power - Load Power) History Buffer: {PvExcessControl.pv_history_buffer}')
-
-        if PvExcessControl.on_time_counter % 6 == 0:
-            # enforce max. 60 minute length of history
-            if len(PvExcessControl.export_history) >= 60:
-                PvExcessControl.export_history.pop(0)
-            if len(PvExcessControl.pv_history) >= 60:
-                PvExcessControl.pv_history.pop(0)
-            if len(PvExcessControl.load_history) >= 60:
-                PvExcessControl.load_history.pop(0)
-            # calc avg of buffer
-            export_avg = round(
-                sum(PvExcessControl.export_history_buffer)
-                / len(PvExcessControl.export_history_buffer)
+        if points is None:
+            Log.info(
+                f"Recorder database {PvExcessControl.recorder_db} not found, power history starts empty."
             )
-            excess_avg = round(
-                sum(PvExcessControl.pv_history_buffer)
-                / len(PvExcessControl.pv_history_buffer)
+            return
+
+        series = {}
+        for name, entity_id in sensors.items():
+            series[name] = _minute_averages(
+                points.get(entity_id, []), start, minutes, _recorded_number
             )
-            load_avg = round(
-                sum(PvExcessControl.load_history_buffer)
-                / len(PvExcessControl.load_history_buffer)
+        if "import_export" in sensors:
+
+            def grid_export(value):
+                num = _recorded_number(value)
+                return None if num is None else abs(min(0, num))
+
+            series["grid_export"] = _minute_averages(
+                points.get(sensors["import_export"], []), start, minutes, grid_export
             )
-            # add avg to history
-            PvExcessControl.export_history.append(export_avg)
-            PvExcessControl.pv_history.append(excess_avg)
-            PvExcessControl.load_history.append(load_avg)
-            log.debug(f"Export History: {PvExcessControl.export_history}")
-            log.debug(
-                f"PV Excess (PV Power - Load Power) History: {PvExcessControl.pv_history}"
+        appliance_load = [0] * minutes
+        for inst, entity_id in appliances:
+            if inst.config.actual_power is not None:
+                convert = _recorded_number
+            else:
+                defined_power = inst.config.defined_power
+
+                def convert(value, defined_power=defined_power):
+                    if value in (None, "unavailable", "unknown"):
+                        return None
+                    return 0 if value == "off" else defined_power
+
+            averages = _minute_averages(
+                points.get(entity_id, []), start, minutes, convert
             )
-            log.debug(f"Load History: {PvExcessControl.load_history}")
-            # clear buffer
-            PvExcessControl.export_history_buffer = []
-            PvExcessControl.pv_history_buffer = []
-            PvExcessControl.load_history_buffer = []
+            appliance_load = [
+                total + (x or 0) for total, x in zip(appliance_load, averages)
+            ]
+        series["appliances"] = appliance_load
+
+        histories = ([], [], [])
+        filled = 0
+        for m in range(minutes):
+            avg = dict.fromkeys(group.power_signals)
+            for name, averages in series.items():
+                avg[name] = averages[m]
+            try:
+                values = PvExcessControl._history_values(group, avg)
+            except Exception:
+                # no recorded values (yet), keep the default
+                values = (0, 0, 0)
+            else:
+                filled += 1
+            for history, value in zip(histories, values):
+                history.append(round(value))
+        if filled == 0:
+            Log.info("No recorded power values found, power history starts empty.")
+            return
+        group.export_history.restore(histories[0])
+        group.pv_history.restore(histories[1])
+        group.load_history.restore(histories[2])
+        group.history_updates = filled
+        Log.info(
+            "Filled power history from the recorder database.",
+            minutes=filled,
+            states=sum([len(x) for x in points.values()]),
+        )
+
+    @staticmethod
+    def _tracked_entities(group, control_tick: bool) -> list:
+        """
+        Collects the configured entities of a control group, which are read at the start of each tick. Ticks without
+        control pass only confirm switching actions and read on demand, the power sensors are sampled by state triggers.
+
+        :param group:           ControlGroup
+        :param control_tick:    True if the control pass runs in this tick
+        :return:                List of unique entity IDs
+        """
+        if not control_tick:
+            return []
+        entity_ids = [
+            group.pv_power,
+            group.export_power,
+            group.load_power,
+            group.import_export_power,
+            group.home_battery_level,
+        ]
+        entity_ids.extend(
+            [
+                group.solar_production_forecast,
+                group.solar_production_forecast_this_hour,
+                group.time_of_sunset,
+            ]
+        )
+        for inst in group.instances.descending:
+            entity_ids.append(inst.config.appliance_switch)
+            entity_ids.append(inst.config.actual_power)
+            entity_ids.append(inst.config.automation_id)
+            entity_ids.append(inst.config.enabled)
+            entity_ids.append(inst.config.appliance_current_set_entity)
+        return list(dict.fromkeys([x for x in entity_ids if x]))
+
+    @staticmethod
+    def _expect_settle(inst, expected_state: str):
+        """
+        Registers a sent switching action, which is confirmed by _check_settle() in one of the next ticks.
+
+        :param inst:            PVExcesscontrol Class instance
+        :param expected_state:  State the appliance switch is expected to reach ("on" or "off")
+        """
+        inst.state.settle_pending = (
+            expected_state,
+            datetime.datetime.now(datetime.timezone.utc),
+        )
+
+    @staticmethod
+    def _check_settle(group):
+        """
+        Confirms switching actions sent in previous ticks without blocking: Appliances which reached the expected state
+        get their confirmation latency recorded (based on the last_changed time of the switch, if available). Appliances
+        which did not reach it within settle_timeout seconds are reported.
+
+        :param group:   ControlGroup
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for inst in group.instances.descending:
+            if inst.state.settle_pending is None:
+                continue
+            expected_state, sent = inst.state.settle_pending
+            switch_state = _get_state(inst.config.appliance_switch)
+            if switch_state == expected_state:
+                changed = _get_last_changed(inst.config.appliance_switch)
+                if changed is None or changed < sent:
+                    changed = now
+                inst.state.settle_latency = (changed - sent).total_seconds()
+                inst.state.settle_pending = None
+                Log.debug(
+                    lambda expected_state=expected_state, inst=inst: (
+                        f"Appliance confirmed switching {expected_state} after {inst.state.settle_latency:.1f}s."
+                    ),
+                    inst,
+                )
+            elif (now - sent).total_seconds() > PvExcessControl.settle_timeout:
+                inst.state.settle_pending = None
+                Log.warning(
+                    f"Appliance did not confirm switching {expected_state} within "
+                    f"{PvExcessControl.settle_timeout}s (state: {switch_state}).",
+                    inst,
+                )
 
-    def sanity_check(self) -> bool:
+    @staticmethod
+    def sanity_check(group) -> bool:
+        """
+        :param group:   ControlGroup
+        :return:        True if the configured sensors of the control group allow controlling its appliances
+        """
         if (
-            PvExcessControl.import_export_power is not None
-            and PvExcessControl.home_battery_level is not None
+            group.import_export_power is not None
+            and group.home_battery_level is not None
         ):
-            log.warning(
+            Log.warning(
                 '"Import/Export power" has been defined together with "Home Battery". This is not intended and will lead to always '
                 "giving the home battery priority over appliances, regardless of the specified min. battery level."
             )
             return True
-        if PvExcessControl.import_export_power is not None and (
-            PvExcessControl.export_power is not None
-            or PvExcessControl.load_power is not None
+        if group.import_export_power is not None and (
+            group.export_power is not None or group.load_power is not None
         ):
-            log.error(
+            Log.error(
                 '"Import/Export power" has been defined together with either "Export power" or "Load power". This is not '
                 'allowed. Please specify either "Import/Export power" or both "Load power" & "Export Power".'
             )
             return False
         if not (
-            PvExcessControl.import_export_power is not None
-            or (
-                PvExcessControl.export_power is not None
-                and PvExcessControl.load_power is not None
-            )
+            group.import_export_power is not None
+            or (group.export_power is not None and group.load_power is not None)
         ):
-            log.error(
+            Log.error(
                 'Either "Export power" or "Load power" have not been defined. This is not '
                 'allowed. Please specify either "Import/Export power" or both "Load power" & "Export Power".'
             )
@@ -1288,14 +4491,26 @@ class PvExcessControl:
         Switches an appliance on, if possible.
         :param inst:        PVExcesscontrol Class instance
         """
-        if inst.appliance_once_only and inst.switched_on_today:
-            log.debug(
-                f'{inst.log_prefix} "Only-Run-Once-Appliance" detected - Appliance was already switched on today - '
-                f"Not switching on again."
+        if inst.config.appliance_once_only and inst.state.switched_on_today:
+            Log.debug(
+                '"Only-Run-Once-Appliance" detected - Appliance was already switched on today - '
+                "Not switching on again.",
+                inst,
             )
-        elif _turn_on(inst.appliance_switch):
-            inst.switched_on_today = True
-            inst.switched_on_time = datetime.datetime.now()
+        else:
+            previous = (inst.state.switched_on_today, inst.state.switched_on_time)
+
+            def on_result(success):
+                # revert the bookkeeping if the (batched) action failed
+                if not success:
+                    inst.state.switched_on_today, inst.state.switched_on_time = previous
+                else:
+                    inst.state.switch_events_today += 1
+                    PvExcessControl._expect_settle(inst, "on")
+
+            if _turn_on(inst.config.appliance_switch, on_result=on_result):
+                inst.state.switched_on_today = True
+                inst.state.switched_on_time = datetime.datetime.now()
 
     def switch_off(self, inst) -> float:
         """
@@ -1305,42 +4520,54 @@ class PvExcessControl:
                             not be switched off)
         """
         # Check if automation is activated for specific instance
-        if not self.automation_activated(inst.automation_id, inst.enabled):
+        if not self.automation_activated(
+            inst.config.automation_id, inst.config.enabled
+        ):
             return 0
         # Do not turn off only-on-appliances
-        if inst.appliance_on_only:
-            log.debug(
-                f'{inst.log_prefix} "Only-On-Appliance" detected - Not switching off.'
-            )
+        if inst.config.appliance_on_only:
+            Log.debug('"Only-On-Appliance" detected - Not switching off.', inst)
             return 0
         # Do not turn off if switch interval not reached
-        elif inst.switch_interval_counter < inst.appliance_switch_interval:
-            log.debug(
-                f"{inst.log_prefix} Cannot switch off appliance, because appliance switch interval is not reached "
-                f"({inst.switch_interval_counter}/{inst.appliance_switch_interval})."
+        elif inst.state.switch_interval_counter < inst.config.appliance_switch_interval:
+            Log.debug(
+                lambda: (
+                    f"Cannot switch off appliance, because appliance switch interval is not reached "
+                    f"({inst.state.switch_interval_counter}/{inst.config.appliance_switch_interval})."
+                ),
+                inst,
             )
             return 0
         else:
             # switch off
             # get last power consumption
             power_consumption = self._calculate_power_consumption(inst)
-            log.debug(
-                f"{inst.log_prefix} Current power consumption: {power_consumption} W"
-            )
-            # switch off appliance
-            _turn_off(inst.appliance_switch)
-            inst.daily_run_time += (
-                datetime.datetime.now() - inst.switched_on_time
+            Log.debug(lambda: f"Current power consumption: {power_consumption} W", inst)
+
+            # switch off appliance. Instead of waiting for the appliance to settle, switching is confirmed in the next
+            # tick (see _check_settle)
+            def on_result(success):
+                if success:
+                    inst.state.switch_events_today += 1
+                    PvExcessControl._expect_settle(inst, "off")
+
+            _turn_off(inst.config.appliance_switch, on_result=on_result)
+            inst.state.daily_run_time += (
+                datetime.datetime.now() - inst.state.switched_on_time
             ).total_seconds()
-            log.info(
-                f"{inst.log_prefix} Switched off appliance. Appliance has run for {(inst.daily_run_time / 60):.1f} minutes"
+            RuntimeDeadlines.update(inst)
+            Log.info(
+                "Switched off appliance.",
+                inst,
+                run_minutes=round(inst.state.daily_run_time / 60, 1),
             )
-            task.sleep(1)
-            inst.switch_interval_counter = 0
-            inst.current_interval_counter = 0
+            inst.state.switch_interval_counter = 0
+            inst.state.current_interval_counter = 0
             # "restart" history by adding defined power to each history value within the specified time frame
-            log.info(
-                f"{inst.log_prefix} Adjusting power history by {power_consumption}W due to appliance switch off"
+            Log.info(
+                "Adjusting power history due to appliance switch off.",
+                inst,
+                offset=power_consumption,
             )
             self._adjust_pwr_history(inst, power_consumption)
             return power_consumption
@@ -1354,18 +4581,23 @@ class PvExcessControl:
         """
         automation_state = _get_state(a_id)
         if automation_state == "off":
-            log.debug(
-                f"Doing nothing, because automation is not activated: State is {automation_state}."
+            Log.debug(
+                lambda: (
+                    f"Doing nothing, because automation is not activated: State is {automation_state}."
+                )
             )
             return False
         elif automation_state is None:
-            log.info(
+            Log.info(
                 f'Automation "{a_id}" was deleted. Removing related class instance.'
             )
-            del PvExcessControl.instances[a_id]
+            inst = ControlGroup.find(a_id)
+            if inst is not None:
+                inst.power_trigger = None
+                ControlGroup.unregister(inst)
             return False
         elif automation_state == "on" and s_enabled and _get_state(s_enabled) == "off":
-            log.debug(
+            Log.debug(
                 "Doing nothing, because automation is activated but optional switch is off."
             )
             return False
@@ -1375,163 +4607,94 @@ class PvExcessControl:
         """
         Adjusts the historical power data for export and PV excess based on a given value.
 
-        This method modifies the last `appliance_switch_interval` entries in the export and PV excess history
-        by adding the specified value. It ensures export values do not fall below zero.
+        This method adds the specified value to the last `appliance_switch_interval` entries in the export and PV excess
+        history. The adjustment is applied lazily by the histories. Export values do not fall below zero.
 
         :param inst: The device instance containing the `appliance_switch_interval` attribute.
         :param value: The numeric value to adjust the history entries by (can be positive or negative).
         :return: None
         """
-        log.debug(f"Adjusting power history by {value}.")
-
-        # Adjust PV export history - Only if zero feed-in is not active
-        if not (PvExcessControl.zero_feed_in):
-            log.debug(f"Export history: {PvExcessControl.export_history}")
-            PvExcessControl.export_history[-inst.appliance_switch_interval :] = [
-                max(0, x + value)  # Prevent negative export values
-                for x in PvExcessControl.export_history[
-                    -inst.appliance_switch_interval :
-                ]
-            ]
-            log.debug(f"Adjusted export history: {PvExcessControl.export_history}")
-
-        # Adjust PV excess history
-        log.debug(
-            f"PV Excess (solar power - load power) history: {PvExcessControl.pv_history}"
-        )
-        PvExcessControl.pv_history[-inst.appliance_switch_interval :] = [
-            x + value
-            for x in PvExcessControl.pv_history[-inst.appliance_switch_interval :]
-        ]
-        log.debug(
-            f"Adjusted PV Excess (solar power - load power) history: {PvExcessControl.pv_history}"
+        Log.debug(
+            "Adjusting power history.",
+            inst,
+            minutes=inst.config.appliance_switch_interval,
+            offset=value,
         )
 
-    def _force_charge_battery(self, avg_load_power, kwh_offset: float = 2):
-        """
-        Calculates if the remaining solar power forecast is enough to ensure the specified min. home battery level is reached at the end
-        of the day.
-
-        :param kwh_offset:  Offset in kWh, which will be added to the calculated remaining battery capacity to ensure an earlier
-                            triggering of a force charge
-        :return:            True if force charge is necessary, False otherwise
-        """
-        #        log.debug(
-        #                f"Force battery charge necessary: avg excess power {PvExcessControl.avg_excess_power=}"
-        #        )
-        if PvExcessControl.home_battery_level is None:
-            return False
-        sunset_string = _get_state(PvExcessControl.time_of_sunset)
-        sunset_time = datetime.datetime.fromisoformat(sunset_string)
-        time_now = datetime.datetime.now(datetime.timezone.utc)
-        time_of_sunset = (sunset_time - time_now).total_seconds() / (60 * 60)
-        # Calc values based on separate sensors
-        remaining_usage = time_of_sunset * avg_load_power / 1000
-
-        log.debug(f"_force_charge_battery remaining_usage: {remaining_usage}")
-
-        capacity = PvExcessControl.home_battery_capacity
-        remaining_capacity = capacity - (
-            0.01
-            * capacity
-            * _get_num_state(PvExcessControl.home_battery_level, return_on_error=0)
-        )
-        remaining_forecast = _get_num_state(
-            PvExcessControl.solar_production_forecast, return_on_error=0
-        )
-        if remaining_forecast <= remaining_capacity + kwh_offset + remaining_usage:
-            log.debug(
-                f"Force battery charge necessary (ON): {capacity=} kWh|{remaining_capacity=} kWh|{remaining_forecast=} kWh| "
-                f"{kwh_offset=} kWh | {remaining_usage=} kWh "
-            )
-            # go through appliances lowest to highest priority, and try switching them off individually
-            for a_id, e in dict(
-                sorted(
-                    PvExcessControl.instances.items(),
-                    key=lambda item: item[1]["priority"],
-                )
-            ).items():
-                inst = e["instance"]
-                if _get_state(inst.appliance_switch) == "on":
-                    self.switch_off(inst)
-            return True
-        else:
-            log.debug(
-                f"Debug force battery values (OFF): {capacity=} kWh|{remaining_capacity=} kWh|{remaining_forecast=} kWh| "
-                f"{kwh_offset=} kWh | {remaining_usage=} kWh "
+        # Adjust PV export history - Only if zero feed-in is not active. Export values are limited to 0 by the history.
+        if not (inst.group.zero_feed_in):
+            inst.group.export_history.adjust(
+                value, inst.config.appliance_switch_interval
             )
-            return False
+
+        # Adjust PV excess history
+        inst.group.pv_history.adjust(value, inst.config.appliance_switch_interval)
+        inst.group.planned_pwr_load -= value
 
     def _force_minimum_runtime(self, inst, current_run_time, avg_excess_power):
         """
-        Calculates if the appliance should be force turned on in case the remaining solar production forecast is not fully sufficient to run loads and
-        the appliance ran for appliance_minimum_run_time, but there is still some excess production
+        Calculates if the appliance should be force turned on to meet its minimum runtime, because the running
+        quarter-hour is planned for it (see RuntimePlanner) and there is some excess power
 
         :param inst:        PVExcesscontrol Class instance
-        :return:            True if remaining production is insufficient but there is still some excess power, false otherwise
+        :return:            True if the appliance is planned to run now and there is some excess power, false otherwise
         """
-        if inst.appliance_minimum_run_time == 0:
+        if (
+            inst.config.appliance_minimum_run_time == 0
+            or current_run_time >= inst.config.appliance_minimum_run_time
+            or not RuntimePlanner.planned(inst)
+        ):
             return False
 
-        # Calculate remaining appliance power need to meet minimum runtime
-        defined_power = int(self._estimate_power_consumption(inst))
-        projected_future_power_usage = (
-            -1
-            * (
-                defined_power
-                * ((current_run_time - inst.appliance_minimum_run_time) / 60)
-            )
-            / 1000
-        )
-
-        if PvExcessControl.solar_production_forecast:
-            remaining_forecast = _get_num_state(
-                PvExcessControl.solar_production_forecast, return_on_error=0
-            )
-        else:
-            remaining_forecast = 0
-
-        # Calculate remaining overall load power usage until sunset, assuming current load
-        sunset_string = _get_state(PvExcessControl.time_of_sunset)
-        sunset_time = datetime.datetime.fromisoformat(sunset_string)
-        time_now = datetime.datetime.now(datetime.timezone.utc)
-        time_of_sunset = (sunset_time - time_now).total_seconds() / (60 * 60)
-        try:
-            if PvExcessControl.import_export_power:
-                # Calc values based on combined import/export power sensor
-                import_export = _get_num_state(PvExcessControl.import_export_power)
-                load_power = _get_num_state(PvExcessControl.pv_power) + import_export
-            else:
-                # Calc values based on separate sensors
-                load_power = _get_num_state(PvExcessControl.load_power)
-        except Exception:
-            log.error(
-                "Could not get the current load power, using default of 500 - {e}"
+        # The plan expects the most solar power for the appliance now, but it only runs if there actually is some
+        # excess power. Otherwise, the next plan moves the runtime to other quarter-hours.
+        if avg_excess_power > 0:
+            Log.debug(
+                lambda: (
+                    f"Turning/keeping appliance on to meet minimum runtime as it is planned now and there is some excess power: {avg_excess_power:.3f}W."
+                ),
+                inst,
             )
-            load_power = 500
-        remaining_usage = time_of_sunset * load_power / 1000
-        remaining_power = remaining_forecast - remaining_usage
+            return True
 
-        log.debug(
-            f"{inst.log_prefix} ran for {current_run_time:.1f} min out of {inst.appliance_minimum_run_time:.1f} min and the current total load is {load_power:.3f} Kw. Appliance is projected to use {projected_future_power_usage:.3f}kWh to meet minimum runtime. With current load the remaining solar power is {remaining_power:.1f}kWh"
-        )
+        return False
 
-        if (
-            projected_future_power_usage >= remaining_power
-            and current_run_time < inst.appliance_minimum_run_time
-        ):
-            # If we get here then the appliance is expected to use more
-            # electricity to hit the minimum run time then the solar
-            # production for the rest of the day
-            # So we want to run if there is any excess power, otherwise we
-            # have to run later at night
-            if avg_excess_power > 0:
-                log.debug(
-                    f"{inst.log_prefix} Turning/keeping appliance on to meet minimum runtime as there is some excess power: {avg_excess_power:.3f}kW."
-                )
-                return True
+    def _index_pwr_reducible(self) -> list:
+        """
+        Checks once per control pass which automations are activated and sums up the reducible power from the lowest to
+        the highest prioritized appliance, so that _calculate_pwr_reducible() is a lookup.
+        The appliances are checked before the control pass changes any of their counters or switches. The control pass
+        walks the appliances by descending priority and only switches the candidate and appliances of higher priority
+        before it asks for the reducible power below the candidate, which does not include them. Code switching
+        appliances of lower priority before that (e.g. all appliances at once) has to rebuild the index afterwards.
 
-        return False
+        :return:    List of (PVExcesscontrol Class instance, automation activated), highest priority first
+        """
+        group = self.group
+        descending = group.instances.descending
+        group.reducible_keys = group.instances.keys
+        reducible = 0
+        # reducible power of the appliances at the index and below in descending order
+        sums = [0] * (len(descending) + 1)
+        activated = [False] * len(descending)
+        for i in range(len(descending) - 1, -1, -1):
+            inst = descending[i]
+            activated[i] = self.automation_activated(
+                inst.config.automation_id, inst.config.enabled
+            )
+            if (
+                activated[i]
+                # Do not turn off only-on-appliances
+                and not inst.config.appliance_on_only
+                # Do not turn off if switch interval not reached
+                and inst.state.switch_interval_counter
+                >= inst.config.appliance_switch_interval
+                and _get_state(inst.config.appliance_switch) == "on"
+            ):
+                reducible += inst.state.current_power
+            sums[i] = reducible
+        group.reducible_sums = sums
+        return list(zip(descending, activated))
 
     def _calculate_pwr_reducible(self, max_priority):
         """
@@ -1540,25 +4703,11 @@ class PvExcessControl:
         :param  max_priority: see description
         :return:              reducible power
         """
-        pwr_reducible = 0
-        for a_id, e in PvExcessControl.instances.copy().items():
-            inst = e["instance"]
-            if not self.automation_activated(inst.automation_id, inst.enabled):
-                continue
-            # Do not turn off only-on-appliances
-            if inst.appliance_on_only:
-                continue
-            # Do not turn off if switch interval not reached
-            if inst.switch_interval_counter < inst.appliance_switch_interval:
-                continue
-            # Skip appliances with equal or higher priority than max_priority
-            if inst.appliance_priority >= max_priority:
-                continue
-            if _get_state(inst.appliance_switch) != "on":
-                continue
-            pwr_reducible += self._calculate_power_consumption(inst)
-
-        return pwr_reducible
+        # first appliance with a priority below max_priority, appliances with equal priority are skipped
+        i = bisect.bisect_right(
+            self.group.reducible_keys, (-max_priority, float("inf"))
+        )
+        return self.group.reducible_sums[i]
 
     def _calculate_power_consumption(self, inst) -> float:
         """
@@ -1570,9 +4719,9 @@ class PvExcessControl:
         :param inst: The device instance containing power-related attributes.
         :return: The calculated or measured power consumption in watts (float).
         """
-        if inst.actual_power:
+        if inst.config.actual_power:
             # Use the actual measured power if available
-            return _get_num_state(inst.actual_power)
+            return _get_num_state(inst.config.actual_power)
         else:
             # Estimate power: current × voltage × phases
             return self._estimate_power_consumption(inst)
@@ -1586,7 +4735,5 @@ class PvExcessControl:
         :param inst: The device instance containing power-related attributes.
         :return: The calculated power consumption in watts (float).
         """
-        # Estimate power: current × voltage × phases
-        if not all([inst.defined_current, PvExcessControl.grid_voltage, inst.phases]):
-            raise ValueError("Missing data for power estimation.")
-        return inst.defined_current * PvExcessControl.grid_voltage * inst.phases
+        # current × voltage × phases, precomputed at registration
+        return inst.config.defined_power
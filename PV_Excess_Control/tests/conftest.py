@@ -0,0 +1,52 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+# the tests run the script with the stubbed pyscript runtime of the offline tools
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"),
+)
+
+START = datetime.datetime(2025, 6, 1, 8, 0, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def sandbox():
+    """
+    pv_excess_control.py loaded with the stubbed pyscript runtime, see tools/pyscript_stubs.py
+    """
+    from pyscript_stubs import PyscriptSandbox
+
+    return PyscriptSandbox(START)
+
+
+def register(sandbox, automation_id: str, **inputs):
+    """
+    Registers an appliance with the blueprint defaults and activates its automation.
+
+    :param sandbox:         PyscriptSandbox
+    :param automation_id:   Automation ID
+    :param inputs:          Blueprint inputs deviating from the defaults
+    :return:                The registered PVExcesscontrol Class instance
+    """
+    from replay import SERVICE_DEFAULTS
+
+    inputs = {
+        **SERVICE_DEFAULTS,
+        "automation_id": automation_id,
+        "pv_power": "sensor.pv_power",
+        "export_power": "sensor.export_power",
+        "load_power": "sensor.load_power",
+        "appliance_switch": f"switch.{automation_id.split('.')[1]}",
+        **inputs,
+    }
+    states = sandbox.state.states
+    for key in ("pv_power", "export_power", "load_power"):
+        states.setdefault(inputs[key], "0")
+    states.setdefault(inputs["appliance_switch"], "off")
+    sandbox.call_service("pv_excess_control", **inputs)
+    sandbox.state.states[automation_id] = "on"
+    return sandbox["ControlGroup"].find(automation_id)
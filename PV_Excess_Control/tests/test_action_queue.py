@@ -0,0 +1,49 @@
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+
+def _sent(sandbox: PyscriptSandbox) -> list:
+    return [(call[1], call[2], call[3]) for call in sandbox.service.calls]
+
+
+def test_flush_sets_current_between_switching(sandbox: PyscriptSandbox):
+    queue = sandbox["ActionQueue"].begin()
+    # a deactivating wallbox gets current 0 before it is switched off, another one is switched on before its current
+    # is set
+    sandbox["_set_value"]("number.wallbox_1_current", 0)
+    sandbox["_turn_off"]("switch.wallbox_1")
+    sandbox["_turn_on"]("switch.wallbox_2")
+    sandbox["_set_value"]("number.wallbox_2_current", 6)
+    sandbox["ActionQueue"].flush(queue)
+
+    assert _sent(sandbox) == [
+        ("switch", "turn_on", "switch.wallbox_2"),
+        ("number", "set_value", "number.wallbox_1_current"),
+        ("number", "set_value", "number.wallbox_2_current"),
+        ("switch", "turn_off", "switch.wallbox_1"),
+    ]
+
+
+def test_superseded_action_reports_none(sandbox: PyscriptSandbox):
+    results = []
+    queue = sandbox["ActionQueue"].begin()
+    sandbox["_turn_on"]("switch.pump", on_result=lambda s: results.append(("on", s)))
+    sandbox["_turn_off"]("switch.pump", on_result=lambda s: results.append(("off", s)))
+    sandbox["ActionQueue"].flush(queue)
+
+    assert _sent(sandbox) == [("switch", "turn_off", "switch.pump")]
+    assert results == [("on", None), ("off", True)]
+
+
+def test_superseded_switch_on_reverts_bookkeeping(sandbox: PyscriptSandbox):
+    inst = register(sandbox, "automation.pv_pump")
+    inst.state.switch_interval_counter = inst.config.appliance_switch_interval
+
+    queue = sandbox["ActionQueue"].begin()
+    inst.switch_on(inst)
+    assert inst.state.switched_on_today
+    inst.switch_off(inst)
+    sandbox["ActionQueue"].flush(queue)
+
+    assert not inst.state.switched_on_today
+    assert inst.state.switch_events_today == 1
@@ -0,0 +1,104 @@
+import itertools
+import random
+
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+
+def _value(items: list, cells: list) -> float:
+    return sum(
+        [value * k + bonus for (kmin, kmax, value, bonus), k in zip(items, cells) if k]
+    )
+
+
+def _brute_force(capacity: int, items: list) -> float:
+    options = [
+        [0] + list(range(max(1, kmin), max(kmin, kmax) + 1))
+        for kmin, kmax, value, bonus in items
+    ]
+    return max(
+        [
+            _value(items, cells)
+            for cells in itertools.product(*options)
+            if sum(cells) <= capacity
+        ]
+    )
+
+
+def test_solve_allocation_matches_brute_force(sandbox: PyscriptSandbox):
+    solve = sandbox["_solve_allocation"]
+    rng = random.Random(16)
+    for _ in range(300):
+        capacity = rng.randint(0, 20)
+        items = []
+        for _ in range(rng.randint(1, 4)):
+            kmin = rng.randint(1, 8)
+            kmax = kmin if rng.random() < 0.5 else rng.randint(kmin, 12)
+            items.append((kmin, kmax, float(rng.randint(1, 5)), rng.choice([0, 0.1])))
+        cells = solve(capacity, items)
+
+        assert sum(cells) <= capacity
+        for (kmin, kmax, value, bonus), k in zip(items, cells):
+            assert k == 0 or kmin <= k <= kmax
+        assert abs(_value(items, cells) - _brute_force(capacity, items)) < 1e-9
+
+
+def test_allocation_keeps_minimum_current_within_excess(sandbox: PyscriptSandbox):
+    # 2000 W excess: the pump (1200 W) and the wallbox (1380 W at 6 A) do not fit together, even though
+    # min_solar_percent lets the wallbox start on 690 W of excess power
+    pump = register(
+        sandbox,
+        "automation.pv_pump",
+        appliance_priority=100,
+        allocation_mode="optimal",
+        defined_current=1200 / 230,
+    )
+    wallbox = register(
+        sandbox,
+        "automation.pv_wallbox",
+        appliance_priority=50,
+        allocation_mode="optimal",
+        dynamic_current_appliance=True,
+        appliance_current_set_entity="number.wallbox_current",
+        min_solar_percent=50,
+    )
+    for inst in (pump, wallbox):
+        sandbox.state.states[inst.config.appliance_switch] = "off"
+        inst.state.switch_interval_counter = inst.config.appliance_switch_interval
+    sandbox.state.states["number.wallbox_current"] = "6"
+
+    pump._allocate(
+        [
+            {"instance": inst, "avg_excess_power": 2000, "avg_excess_power_off": 2000}
+            for inst in (pump, wallbox)
+        ]
+    )
+
+    switched_on = [call[3] for call in sandbox.service.calls if call[2] == "turn_on"]
+    assert switched_on == ["switch.pv_pump"]
+
+
+def test_allocation_requires_min_solar_percent_to_start(sandbox: PyscriptSandbox):
+    wallbox = register(
+        sandbox,
+        "automation.pv_wallbox",
+        allocation_mode="optimal",
+        dynamic_current_appliance=True,
+        appliance_current_set_entity="number.wallbox_current",
+        min_solar_percent=50,
+    )
+    sandbox.state.states["switch.pv_wallbox"] = "off"
+    sandbox.state.states["number.wallbox_current"] = "6"
+    wallbox.state.switch_interval_counter = wallbox.config.appliance_switch_interval
+
+    wallbox._allocate(
+        [{"instance": wallbox, "avg_excess_power": 600, "avg_excess_power_off": 600}]
+    )
+    assert sandbox.service.calls == []
+
+    wallbox._allocate(
+        [{"instance": wallbox, "avg_excess_power": 1500, "avg_excess_power_off": 1500}]
+    )
+    calls = {call[3]: call for call in sandbox.service.calls}
+    assert calls["switch.pv_wallbox"][2] == "turn_on"
+    assert calls["number.wallbox_current"][4]["value"] == 6.5
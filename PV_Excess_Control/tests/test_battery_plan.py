@@ -0,0 +1,107 @@
+import pytest
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+
+def state_of_charge(
+    pv: list, loads: list, appliances: list, level: float, capacity: float
+) -> float:
+    """
+    Simulates the state of charge of the home battery step by step.
+
+    :return:    State of charge after the last step in kWh
+    """
+    for produced, load, appliance in zip(pv, loads, appliances):
+        level = min(capacity, max(0.0, level + produced - load - appliance))
+    return level
+
+
+def setup_group(sandbox: PyscriptSandbox, battery_level: int):
+    """
+    Registers two switched on appliances of 1380W with a home battery of 10kWh, which should be charged to 60% by
+    sunset in one hour. 6kWh solar production are forecast (4kWh after the reserve), the load without the appliances
+    is 1000W.
+    """
+    sandbox.state.states.update(
+        {
+            "sensor.pv_power": "5000",
+            "sensor.export_power": "0",
+            "sensor.load_power": "3760",
+            "sensor.battery": str(battery_level),
+            "sensor.forecast": "6",
+            "sensor.sunset": "2025-06-01T09:00:00+00:00",
+            "switch.pv_high": "on",
+            "switch.pv_low": "on",
+        }
+    )
+    inputs = dict(
+        home_battery_level="sensor.battery",
+        min_home_battery_level=60,
+        home_battery_capacity=10,
+        solar_production_forecast="sensor.forecast",
+        time_of_sunset="sensor.sunset",
+        appliance_switch_interval=1,
+        appliance_switch_off_interval=1,
+    )
+    register(sandbox, "automation.pv_high", appliance_priority=20, **inputs)
+    return register(sandbox, "automation.pv_low", appliance_priority=10, **inputs).group
+
+
+def run_control_pass(sandbox: PyscriptSandbox):
+    for _ in range(6):
+        sandbox.clock.advance(10)
+        sandbox["PvExcessControl"].tick()
+
+
+def test_budget_reaches_target_at_sunset(sandbox: PyscriptSandbox):
+    pv, loads, steps = [4, 4, 4], [1, 1, 1], [1, 1, 1]
+    affordable, soc_at_sunset = sandbox["_battery_budget"](pv, steps, loads, 2, 10, 8)
+
+    # without appliances, the battery would be full
+    assert soc_at_sunset == 10
+    assert affordable == pytest.approx(3000)
+    # the affordable power of the first hour still reaches the target
+    assert state_of_charge(pv, loads, [3, 0, 0], 2, 10) == pytest.approx(8)
+    assert state_of_charge(pv, loads, [3.1, 0, 0], 2, 10) < 8
+
+
+def test_budget_is_zero_if_target_is_unreachable(sandbox: PyscriptSandbox):
+    affordable, soc_at_sunset = sandbox["_battery_budget"](
+        [1, 1], [1, 1], [1, 1], 2, 10, 8
+    )
+
+    assert affordable == 0
+    assert soc_at_sunset == 2
+
+
+def test_budget_of_full_battery(sandbox: PyscriptSandbox):
+    pv, loads, steps = [2, 2], [1, 1], [1, 1]
+    affordable, soc_at_sunset = sandbox["_battery_budget"](pv, steps, loads, 10, 10, 9)
+
+    # the battery cannot be charged above its capacity, it may be discharged down to the target
+    assert soc_at_sunset == 10
+    assert affordable == pytest.approx(3000)
+    assert state_of_charge(pv, loads, [3, 0], 10, 10) == pytest.approx(9)
+
+
+def test_appliances_exceeding_the_plan_are_switched_off_by_priority(
+    sandbox: PyscriptSandbox,
+):
+    group = setup_group(sandbox, 50)
+    run_control_pass(sandbox)
+
+    # the plan affords (5kWh + 4kWh - 1kWh - 6kWh) / 1h = 2000W (slightly more, as sunset is less than an hour away),
+    # which covers one of the appliances
+    affordable = group.battery_plan[1]
+    assert 2000 < affordable < 2760
+    assert sandbox.state.states["switch.pv_low"] == "off"
+    assert sandbox.state.states["switch.pv_high"] == "on"
+
+
+def test_battery_at_minimum_level_is_not_planned(sandbox: PyscriptSandbox):
+    group = setup_group(sandbox, 60)
+    run_control_pass(sandbox)
+
+    assert group.battery_plan is None
+    assert sandbox.state.states["switch.pv_low"] == "on"
+    assert sandbox.state.states["switch.pv_high"] == "on"
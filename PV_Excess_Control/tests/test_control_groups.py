@@ -0,0 +1,20 @@
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+
+def test_failing_group_does_not_stop_other_groups(sandbox: PyscriptSandbox):
+    first = register(sandbox, "automation.pv_first", control_group="first")
+    second = register(sandbox, "automation.pv_second", control_group="second")
+    ticked = []
+
+    def failing(leader, control_tick):
+        ticked.append(leader.group.name)
+        if leader is first:
+            raise ValueError("broken sensor")
+
+    sandbox["PvExcessControl"]._tick_group = staticmethod(failing)
+    sandbox["PvExcessControl"].tick()
+
+    assert sorted(ticked) == ["first", "second"]
+    assert second.group is not first.group
+    assert sandbox.log.counts["ERROR"] == 1
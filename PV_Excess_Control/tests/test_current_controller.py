@@ -0,0 +1,85 @@
+import random
+
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+# proportional gain, integral gain times step length, current range and slew rate of the default controller
+GAINS = (0.2, 0.6)
+RANGE = (6, 16)
+SLEW_RATE = 2
+
+
+def run_controller(sandbox: PyscriptSandbox, errors: list, output: float = 6) -> list:
+    """
+    Runs the PI controller kernel with the given excess currents, starting at the given output.
+
+    :return:    Outputs of all steps
+    """
+    integral = output
+    outputs = []
+    for error in errors:
+        output, integral = sandbox["_pi_current"](
+            error, integral, output, *GAINS, *RANGE, SLEW_RATE
+        )
+        outputs.append(output)
+    return outputs
+
+
+def test_output_saturates_at_maximum_current(sandbox: PyscriptSandbox):
+    outputs = run_controller(sandbox, [20] * 30)
+
+    assert max(outputs) == 16
+    assert outputs[-1] == 16
+
+
+def test_output_saturates_at_minimum_current(sandbox: PyscriptSandbox):
+    outputs = run_controller(sandbox, [-20] * 30, output=16)
+
+    assert min(outputs) == 6
+    assert outputs[-1] == 6
+
+
+def test_output_recovers_immediately_after_windup(sandbox: PyscriptSandbox):
+    # a long time at the maximum current, then slightly too little excess
+    outputs = run_controller(sandbox, [20] * 100 + [-1] * 3)
+
+    assert outputs[99] == 16
+    # the integral did not wind up, the current is reduced in the first step
+    assert outputs[100] < 16
+    assert outputs[100] > outputs[101] > outputs[102]
+
+
+def test_output_change_is_limited_by_slew_rate(sandbox: PyscriptSandbox):
+    rng = random.Random(22)
+    outputs = run_controller(sandbox, [rng.uniform(-30, 30) for _ in range(500)])
+
+    steps = [abs(b - a) for a, b in zip([6] + outputs, outputs)]
+    assert max(steps) <= SLEW_RATE + 1e-9
+    assert all(RANGE[0] <= x <= RANGE[1] for x in outputs)
+
+
+def test_controller_ramps_current_by_slew_rate(sandbox: PyscriptSandbox):
+    sandbox.state.states.update(
+        {
+            "sensor.pv_power": "10000",
+            "sensor.load_power": "2380",
+            "switch.pv_wallbox": "on",
+            "number.wallbox_current": "6",
+        }
+    )
+    register(
+        sandbox,
+        "automation.pv_wallbox",
+        dynamic_current_appliance=True,
+        appliance_current_set_entity="number.wallbox_current",
+        current_control="pi",
+    )
+    currents = []
+    for _ in range(12):
+        sandbox.clock.advance(10)
+        sandbox["PvExcessControl"].tick()
+        currents.append(float(sandbox.state.states["number.wallbox_current"]))
+
+    steps = [b - a for a, b in zip([6] + currents, currents)]
+    assert max(steps) <= SLEW_RATE
+    assert currents[-1] == 16
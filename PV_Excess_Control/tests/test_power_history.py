@@ -0,0 +1,66 @@
+from pyscript_stubs import PyscriptSandbox
+
+
+def export_history(sandbox: PyscriptSandbox, values: list):
+    """
+    :return:    PowerHistory with a lower limit of 0W, like the export history, filled with the given values
+    """
+    history = sandbox["PowerHistory"](len(values), floor=0)
+    for value in values:
+        history.append(value)
+    return history
+
+
+def test_offsets_are_clamped_at_floor_in_recording_order(sandbox: PyscriptSandbox):
+    history = export_history(sandbox, [500, 400, 300, 200, 100, 50])
+
+    history.adjust(-150, 4)
+    history.adjust(100, 2)
+    history.adjust(-20, 5)
+
+    # -150 clamps the last two values to 0 before +100 and -20 are added, clamping the summed offsets would give 30
+    # and 0 for them
+    assert history.values() == [500, 380, 130, 30, 80, 80]
+    sums = [history.window_sum(n) for n in range(1, 7)]
+    assert sums == [80, 160, 190, 320, 700, 1200]
+
+
+def test_floor_is_not_undone_by_later_positive_offset(sandbox: PyscriptSandbox):
+    history = export_history(sandbox, [300, 200, 100, 50])
+
+    history.adjust(-150, 3)
+    history.adjust(100, 2)
+
+    # 100 - 150 and 50 - 150 are clamped to 0 first, an unclamped sum would give 50 and 0
+    assert history.values() == [300, 50, 100, 100]
+    assert history.window_sum(2) == 200
+    assert history.window_avg(4) == 137
+
+
+def test_offsets_hit_floor_in_different_windows(sandbox: PyscriptSandbox):
+    history = export_history(sandbox, [100] * 6)
+
+    history.adjust(-80, 6)
+    assert history.window_sum(6) == 120
+    history.append(50)
+    history.adjust(-100, 2)
+    # the offset of the previous round is folded before the new one is clamped
+    assert history.values() == [20, 20, 20, 20, 0, 0]
+    assert history.window_sum(3) == 20
+    history.append(0)
+    history.adjust(-30, 4)
+    history.adjust(40, 1)
+    assert history.values() == [20, 20, 0, 0, 0, 40]
+    assert [history.window_sum(n) for n in range(1, 7)] == [40, 40, 40, 40, 60, 80]
+
+
+def test_history_without_floor_keeps_negative_values(sandbox: PyscriptSandbox):
+    history = sandbox["PowerHistory"](4)
+    for value in [100, 50, 0, -50]:
+        history.append(value)
+
+    history.adjust(-100, 3)
+    history.adjust(60, 1)
+
+    assert history.window_sum(2) == -190
+    assert history.values() == [100, -50, -100, -90]
@@ -0,0 +1,51 @@
+import pytest
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+
+def update_pv(sandbox: PyscriptSandbox, changes: list):
+    """
+    Changes the pv power sensor.
+
+    :param changes: List of (seconds to advance the clock by before the change, new state)
+    """
+    for seconds, value in changes:
+        sandbox.clock.advance(seconds)
+        sandbox.state.update("sensor.pv_power", str(value))
+
+
+def roll_minute(sandbox: PyscriptSandbox, changes: list) -> float:
+    """
+    Feeds the changes of the pv power sensor into a fresh one-minute averaging period.
+
+    :return:    Time-weighted average of the minute
+    """
+    group = register(sandbox, "automation.pv_pump").group
+    pv = group.power_signals["pv"]
+    start = sandbox["_power_timestamp"]()
+    pv.roll(start)
+    update_pv(sandbox, changes)
+    sandbox.clock.advance(start + 60 - sandbox["_power_timestamp"]())
+    return pv.roll(start + 60)
+
+
+def test_alternating_sensor_is_averaged_exactly(sandbox: PyscriptSandbox):
+    # 1s sensor alternating between 2000W and 0W, starting at the beginning of the minute
+    changes = [(0, 2000)] + [(1, 0 if i % 2 else 2000) for i in range(1, 60)]
+    average = roll_minute(sandbox, changes)
+
+    assert average == pytest.approx(1000)
+
+
+def test_burst_is_weighted_by_held_time(sandbox: PyscriptSandbox):
+    # 3000W for 0.1s and 1000W for 19.4s within a burst, 0W for the rest of the minute
+    average = roll_minute(sandbox, [(0.5, 3000), (0.1, 1000), (19.4, 0)])
+
+    assert average == pytest.approx((3000 * 0.1 + 1000 * 19.4) / 60)
+
+
+def test_unknown_state_is_left_out(sandbox: PyscriptSandbox):
+    # 2000W for 30s, unavailable for 20s, 500W for 10s
+    average = roll_minute(sandbox, [(0, 2000), (30, "unavailable"), (20, 500)])
+
+    assert average == pytest.approx((2000 * 30 + 500 * 10) / 40)
@@ -0,0 +1,135 @@
+import sqlite3
+
+from conftest import START, register
+from pyscript_stubs import PyscriptSandbox
+
+# start of the last hour, which is read from the recorder database
+HOUR_AGO = START.timestamp() - 3600
+
+
+def create_recorder_db(path: str, states: list):
+    """
+    Creates a recorder database with the states and states_meta tables of Home Assistant 2023.4 or greater.
+
+    :param path:    Path of the database
+    :param states:  List of (entity ID, seconds since HOUR_AGO, state)
+    """
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE states_meta (metadata_id INTEGER PRIMARY KEY, entity_id VARCHAR(255))"
+        )
+        connection.execute(
+            "CREATE TABLE states (state_id INTEGER PRIMARY KEY, state VARCHAR(255), last_updated_ts FLOAT, "
+            "metadata_id INTEGER)"
+        )
+        metadata_ids = {}
+        for entity_id, offset, state in states:
+            if entity_id not in metadata_ids:
+                metadata_ids[entity_id] = len(metadata_ids) + 1
+                connection.execute(
+                    "INSERT INTO states_meta (metadata_id, entity_id) VALUES (?, ?)",
+                    (metadata_ids[entity_id], entity_id),
+                )
+            connection.execute(
+                "INSERT INTO states (state, last_updated_ts, metadata_id) VALUES (?, ?, ?)",
+                (state, HOUR_AGO + offset, metadata_ids[entity_id]),
+            )
+    connection.close()
+
+
+def warm_start(sandbox: PyscriptSandbox, db_path: str):
+    """
+    Registers an appliance and fills the power histories of its control group from the given recorder database.
+
+    :return:    ControlGroup
+    """
+    inst = register(sandbox, "automation.pv_pump")
+    sandbox["PvExcessControl"].recorder_db = db_path
+    sandbox["PvExcessControl"]._warm_start_history(inst.group)
+    return inst.group
+
+
+def test_warm_start_reads_recorded_power(sandbox: PyscriptSandbox, tmp_path):
+    db_path = str(tmp_path / "home-assistant_v2.db")
+    create_recorder_db(
+        db_path,
+        [
+            # only the last state before the hour is used, valid from its start
+            ("sensor.pv_power", -900, "100"),
+            ("sensor.pv_power", -600, "3000"),
+            ("sensor.load_power", -300, "1000"),
+            ("sensor.export_power", -300, "500"),
+            ("switch.pv_pump", -60, "off"),
+            # pump (1380W) and load change in the middle of minute 30
+            ("switch.pv_pump", 30 * 60 + 30, "on"),
+            ("sensor.load_power", 30 * 60 + 30, "2000"),
+            # pv power unknown for all of minute 40 and the first half of minute 41
+            ("sensor.pv_power", 40 * 60, "unavailable"),
+            ("sensor.pv_power", 41 * 60 + 30, "2500"),
+            # entities not configured are not read
+            ("sensor.other_power", 0, "5000"),
+        ],
+    )
+    group = warm_start(sandbox, db_path)
+
+    excess = group.pv_history.values()
+    load = group.load_history.values()
+    export = group.export_history.values()
+    assert excess[:30] == [2000] * 30
+    assert load[:30] == [1000] * 30
+    assert (excess[30], load[30]) == (1500, 810)
+    assert excess[31:40] == [1000] * 9
+    assert load[31:40] == [620] * 9
+    # a minute without pv power is not filled
+    assert (export[40], excess[40], load[40]) == (0, 0, 0)
+    # unknown time is left out of the averages
+    assert excess[41:] == [500] * 19
+    assert load[41:] == [620] * 19
+    assert export[:40] + export[41:] == [500] * 59
+    assert group.history_updates == 59
+    assert sandbox.log.counts["ERROR"] == 0
+
+
+def test_warm_start_without_recorded_appliance(sandbox: PyscriptSandbox, tmp_path):
+    db_path = str(tmp_path / "home-assistant_v2.db")
+    create_recorder_db(
+        db_path,
+        [
+            ("sensor.pv_power", -600, "3000"),
+            ("sensor.load_power", -300, "1000"),
+            ("sensor.export_power", -300, "bad"),
+            ("sensor.export_power", 30 * 60, "500"),
+        ],
+    )
+    group = warm_start(sandbox, db_path)
+
+    # minutes without a numeric export power are not filled
+    assert group.export_history.values() == [0] * 30 + [500] * 30
+    assert group.pv_history.values() == [0] * 30 + [2000] * 30
+    # the appliance switch was never recorded, it does not reduce the load
+    assert group.load_history.values() == [0] * 30 + [1000] * 30
+    assert group.history_updates == 30
+    # the invalid state is logged
+    assert sandbox.log.counts["ERROR"] == 1
+
+
+def test_warm_start_without_recorded_sensors(sandbox: PyscriptSandbox, tmp_path):
+    db_path = str(tmp_path / "home-assistant_v2.db")
+    create_recorder_db(db_path, [("switch.pv_pump", -60, "on")])
+    group = warm_start(sandbox, db_path)
+
+    assert group.warm_started
+    assert group.pv_history.values() == [0] * 60
+    assert group.history_updates == 0
+    assert sandbox.log.counts["ERROR"] == 0
+
+
+def test_warm_start_without_database(sandbox: PyscriptSandbox, tmp_path):
+    group = warm_start(sandbox, str(tmp_path / "missing.db"))
+
+    assert group.warm_started
+    assert group.pv_history.values() == [0] * 60
+    assert group.load_history.values() == [0] * 60
+    assert group.history_updates == 0
+    assert sandbox.log.counts["ERROR"] == 0
+    assert not (tmp_path / "missing.db").exists()
@@ -0,0 +1,80 @@
+import datetime
+
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+
+def register_deadlines(sandbox: PyscriptSandbox, appliances: dict) -> list:
+    """
+    Registers appliances with minimum runtimes and records the enforcement of their minimum runtime.
+
+    :param appliances:  Name -> (minimum runtime in minutes, deadline)
+    :return:            List of (automation ID, local time) of each enforcement, filled while the sandbox runs
+    """
+    deadlines = sandbox["RuntimeDeadlines"]
+    enforce = deadlines._enforce
+    enforced = []
+
+    def record(inst, latest_activation):
+        enforced.append((inst.config.automation_id, sandbox.clock.local()))
+        enforce(inst, latest_activation)
+
+    deadlines._enforce = staticmethod(record)
+    for name, (minutes, deadline) in appliances.items():
+        register(
+            sandbox,
+            f"automation.pv_{name}",
+            appliance_minimum_run_time=minutes,
+            appliance_runtime_deadline=deadline,
+        )
+    return enforced
+
+
+def run_until(sandbox: PyscriptSandbox, hour: int, minute: int = 0):
+    while sandbox.clock.local() < datetime.datetime(2025, 6, 1, hour, minute):
+        sandbox.step(60)
+
+
+def test_deadlines_are_enforced_in_order(sandbox: PyscriptSandbox):
+    enforced = register_deadlines(
+        sandbox,
+        {
+            "first": (60, "12:00:00"),
+            "second": (60, "10:00:00"),
+            "third": (30, "12:00:00"),
+        },
+    )
+    deadlines = sandbox["RuntimeDeadlines"]
+
+    # a single trigger waits for the earliest latest activation
+    assert deadlines.trigger_time == datetime.datetime(2025, 6, 1, 9, 0)
+    assert len([ref for _, ref in sandbox.triggers.once if ref() is not None]) == 1
+    run_until(sandbox, 12)
+
+    assert enforced == [
+        ("automation.pv_second", datetime.datetime(2025, 6, 1, 9, 0)),
+        ("automation.pv_first", datetime.datetime(2025, 6, 1, 11, 0)),
+        ("automation.pv_third", datetime.datetime(2025, 6, 1, 11, 30)),
+    ]
+    assert deadlines.trigger_time is None
+
+
+def test_trigger_is_rearmed_after_remove(sandbox: PyscriptSandbox):
+    enforced = register_deadlines(
+        sandbox, {"first": (60, "12:00:00"), "second": (60, "10:00:00")}
+    )
+    deadlines = sandbox["RuntimeDeadlines"]
+    deadlines.remove("automation.pv_second")
+
+    assert deadlines.trigger_time == datetime.datetime(2025, 6, 1, 11, 0)
+    run_until(sandbox, 12)
+    assert enforced == [("automation.pv_first", datetime.datetime(2025, 6, 1, 11, 0))]
+
+
+def test_passed_deadline_is_enforced_right_away(sandbox: PyscriptSandbox):
+    enforced = register_deadlines(sandbox, {"late": (60, "08:30:00")})
+    deadlines = sandbox["RuntimeDeadlines"]
+
+    assert enforced == [("automation.pv_late", datetime.datetime(2025, 6, 1, 8, 0))]
+    assert deadlines.heap == []
+    assert deadlines.trigger_time is None
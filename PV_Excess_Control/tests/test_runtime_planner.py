@@ -0,0 +1,102 @@
+from conftest import register
+from pyscript_stubs import PyscriptSandbox
+
+
+def plan_runtimes(sandbox: PyscriptSandbox, surplus: list, demands: list) -> list:
+    """
+    Plans the demands into quarter-hours with the given surplus, starting now.
+
+    :return:    Planned quarter-hour indices per demand
+    """
+    ends = [15 * (i + 1) for i in range(len(surplus))]
+    plans, _ = sandbox["_plan_runtimes"](surplus, ends, demands, 2)
+    return plans
+
+
+def register_planned(sandbox: PyscriptSandbox, **inputs):
+    """
+    Registers an appliance with a minimum runtime of one hour until noon. 20kWh solar production are forecast until
+    sunset at 16:00.
+    """
+    sandbox.state.states.update(
+        {
+            "sensor.forecast": "20",
+            "sensor.sunset": "2025-06-01T16:00:00+00:00",
+        }
+    )
+    inputs = {
+        "solar_production_forecast": "sensor.forecast",
+        "time_of_sunset": "sensor.sunset",
+        "appliance_minimum_run_time": 60,
+        "appliance_runtime_deadline": "12:00:00",
+        **inputs,
+    }
+    return register(sandbox, "automation.pv_dishwasher", **inputs)
+
+
+def test_plan_chooses_quarter_hours_with_most_surplus(sandbox: PyscriptSandbox):
+    plans = plan_runtimes(sandbox, [100, 2000, 500, 3000], [(30, 1000, 60)])
+
+    assert plans == [[1, 3]]
+
+
+def test_plan_ends_before_deadline(sandbox: PyscriptSandbox):
+    surplus = [100, 2000, 500, 3000]
+
+    assert plan_runtimes(sandbox, surplus, [(30, 1000, 45)]) == [[1, 2]]
+    # the remaining runtime does not fit before the deadline anymore
+    assert plan_runtimes(sandbox, surplus, [(30, 1000, 15)]) == [[0]]
+
+
+def test_plan_shares_surplus_between_appliances(sandbox: PyscriptSandbox):
+    plans = plan_runtimes(sandbox, [1000, 1000, 0, 0], [(15, 1000, 60), (15, 1000, 30)])
+
+    # the appliance with the earlier deadline is planned first, the other one around it
+    assert sorted(plans) == [[0], [1]]
+
+
+def test_running_quarter_hour_is_planned(sandbox: PyscriptSandbox):
+    inst = register_planned(sandbox)
+    sandbox["RuntimePlanner"].update(inst.group, [inst])
+
+    # the solar production falls towards sunset, so the runtime is planned from now on
+    assert sandbox["RuntimePlanner"].planned(inst)
+    assert inst._force_minimum_runtime(inst, 0, 100)
+    # without excess power, the appliance is not switched on
+    assert not inst._force_minimum_runtime(inst, 0, 0)
+
+
+def test_nothing_is_planned_without_runtime_left(sandbox: PyscriptSandbox):
+    inst = register_planned(sandbox)
+    inst.state.daily_run_time = 60 * 60
+    sandbox["RuntimePlanner"].update(inst.group, [inst])
+
+    assert inst.group.runtime_plan is None
+    assert not sandbox["RuntimePlanner"].planned(inst)
+    assert not inst._force_minimum_runtime(inst, 60, 100)
+
+
+def test_nothing_is_planned_after_deadline(sandbox: PyscriptSandbox):
+    inst = register_planned(sandbox, appliance_runtime_deadline="07:00:00")
+    sandbox["RuntimePlanner"].update(inst.group, [inst])
+
+    assert inst.group.runtime_plan is None
+
+
+def test_plan_is_kept_while_the_appliance_runs(sandbox: PyscriptSandbox):
+    inst = register_planned(sandbox)
+    sandbox.state.states["switch.pv_dishwasher"] = "on"
+    inst.state.switched_on_time = sandbox["datetime"].datetime.now()
+    planner = sandbox["RuntimePlanner"]
+    planner.update(inst.group, [inst])
+    plan = inst.group.runtime_plan
+
+    # the remaining runtime drops by a minute, but not by a quarter-hour
+    sandbox.clock.advance(60)
+    planner.update(inst.group, [inst])
+    assert inst.group.runtime_plan is plan
+
+    # the next quarter-hour starts
+    sandbox.clock.advance(14 * 60)
+    planner.update(inst.group, [inst])
+    assert inst.group.runtime_plan is not plan
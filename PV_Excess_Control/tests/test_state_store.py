@@ -0,0 +1,105 @@
+import datetime
+import json
+
+from conftest import START, register
+from pyscript_stubs import PyscriptSandbox
+
+AUTOMATION_ID = "automation.pv_pump"
+
+
+def save_state(state_file: str):
+    """
+    Runs an appliance with known power histories, load profile and daily runtime, and saves its state.
+
+    :return:    ControlGroup
+    """
+    sandbox = PyscriptSandbox(START, state_file=state_file)
+    inst = register(sandbox, AUTOMATION_ID)
+    group = inst.group
+    group.export_history.restore(list(range(60)))
+    group.pv_history.restore([1000 + i for i in range(60)])
+    group.load_history.restore([2000 + i for i in range(60)])
+    group.history_updates = 60
+    group.load_profile.values[5] = 750
+    group.load_profile.counts[5] = 3
+    group.load_profile.encoded = None
+    inst.state.daily_run_time = 1800
+    inst.state.switch_interval_counter = 2
+    sandbox["StateStore"].save()
+    return group
+
+
+def restart(state_file: str, minutes: int) -> PyscriptSandbox:
+    """
+    Starts a new sandbox the given minutes after the state was saved and registers the appliance again.
+    """
+    sandbox = PyscriptSandbox(
+        START + datetime.timedelta(minutes=minutes), state_file=state_file
+    )
+    register(sandbox, AUTOMATION_ID)
+    return sandbox
+
+
+def test_histories_are_shifted_by_missed_minutes(tmp_path):
+    state_file = str(tmp_path / "state.json")
+    saved = save_state(state_file)
+    sandbox = restart(state_file, 5)
+    inst = sandbox["ControlGroup"].find(AUTOMATION_ID)
+    group = inst.group
+
+    # the last saved value is assumed for the 5 missed minutes
+    assert group.export_history.values() == list(range(5, 60)) + [59] * 5
+    assert group.pv_history.values() == [1000 + i for i in range(5, 60)] + [1059] * 5
+    assert group.load_history.values() == [2000 + i for i in range(5, 60)] + [2059] * 5
+    assert group.restored_histories
+    assert group.history_updates == 60
+    assert group.load_profile.encode() == saved.load_profile.encode()
+    assert group.load_profile.values[5] == 750
+    assert group.load_profile.counts[5] == 3
+    # the interval counters count the missed control passes
+    assert inst.state.daily_run_time == 1800
+    assert inst.state.switch_interval_counter == 7
+    assert sandbox.log.counts["ERROR"] == 0
+
+
+def test_histories_older_than_an_hour_are_not_restored(tmp_path):
+    state_file = str(tmp_path / "state.json")
+    save_state(state_file)
+    sandbox = restart(state_file, 60)
+    group = sandbox["ControlGroup"].find(AUTOMATION_ID).group
+
+    assert not group.restored_histories
+    assert group.pv_history.values() == [0] * 60
+    # the profiles do not expire
+    assert group.load_profile.values[5] == 750
+
+
+def test_invalid_profiles_are_logged_and_skipped(tmp_path):
+    state_file = tmp_path / "state.json"
+    save_state(str(state_file))
+    snapshot = json.loads(state_file.read_text())
+    saved_group = next(iter(snapshot["groups"].values()))
+    saved_group["load_profile"] = "not a profile"
+    # valid base64, but one bucket short
+    saved_group["solar_profile"] = saved_group["solar_profile"][:-4]
+    state_file.write_text(json.dumps(snapshot))
+    sandbox = restart(str(state_file), 5)
+    group = sandbox["ControlGroup"].find(AUTOMATION_ID).group
+
+    assert sandbox.log.counts["ERROR"] == 2
+    assert list(group.load_profile.values) == [0] * len(group.load_profile.values)
+    assert list(group.solar_profile.counts) == [0] * len(group.solar_profile.counts)
+    # the histories are restored nevertheless
+    assert group.restored_histories
+
+
+def test_corrupt_state_file_is_logged_and_skipped(tmp_path):
+    state_file = tmp_path / "state.json"
+    save_state(str(state_file))
+    state_file.write_text(state_file.read_text()[:-10])
+    sandbox = restart(str(state_file), 5)
+    inst = sandbox["ControlGroup"].find(AUTOMATION_ID)
+
+    assert sandbox.log.counts["ERROR"] == 1
+    assert not inst.group.restored_histories
+    assert inst.state.daily_run_time == 0
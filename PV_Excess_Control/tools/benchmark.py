@@ -0,0 +1,322 @@
+# INFO --------------------------------------------
+# Scaling benchmark of the pv_excess_control.py control loop.
+#
+# Registers N synthetic appliances through the pv_excess_control service against the stubbed pyscript runtime and
+# measures the 10s on_time ticks: wall time, state reads and service calls per tick, and peak memory. Results are
+# written as JSON, so that they can be compared between releases.
+#
+# Plain Python runs the script much faster than the pyscript interpreter does in Home Assistant, except for the
+# functions compiled natively with @pyscript_compile. With --interpreted-lines, the benchmark also counts the lines
+# executed per tick outside of those functions, i.e. the work pyscript has to interpret.
+# -------------------------------------------------
+import argparse
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import types
+import tracemalloc
+
+from pyscript_stubs import SCRIPT_PATH, PyscriptSandbox
+
+START = datetime.datetime(2025, 6, 1, 8, 0, tzinfo=datetime.timezone.utc)
+VOLTAGE = 230
+
+
+class Scenario:
+    """
+    N synthetic appliances behind a shared PV system. Half of the appliances could run on the available PV power, which
+    fluctuates from minute to minute, so that appliances keep getting switched on and off. Every 4th appliance has
+    dynamic current control. Currents are kept small, so that the sensor values stay within the range accepted by the
+    script even for 1000 appliances.
+    """
+
+    def __init__(
+        self,
+        sandbox: PyscriptSandbox,
+        appliances: int,
+        seed: int = 1,
+        allocation_mode: str = "greedy",
+    ):
+        self.sandbox = sandbox
+        self.random = random.Random(seed)
+        self.appliances = []
+        states = sandbox.state.states
+        states["sensor.battery"] = "95"
+        states["sensor.solar_forecast"] = "30"
+        states["sensor.sun_next_setting"] = (
+            START + datetime.timedelta(hours=10)
+        ).isoformat()
+        for i in range(appliances):
+            dynamic = i % 4 == 0
+            appliance = {
+                "automation_id": f"automation.pv_appliance_{i}",
+                "appliance_priority": self.random.randint(1, 1000),
+                "export_power": "sensor.export_power",
+                "pv_power": "sensor.pv_power",
+                "load_power": "sensor.load_power",
+                "home_battery_level": "sensor.battery",
+                "min_home_battery_level": 90,
+                "min_home_battery_level_start": False,
+                "zero_feed_in": False,
+                "zero_feed_in_load": 300,
+                "zero_feed_in_level": 99,
+                "dynamic_current_appliance": dynamic,
+                "round_target_current": False,
+                "deactivating_current": False,
+                "appliance_current_interval": 1,
+                "appliance_phases": 1,
+                "min_current": 1,
+                "max_current": 4,
+                "min_solar_percent": 100,
+                "appliance_switch": f"switch.appliance_{i}",
+                "appliance_switch_interval": self.random.randint(1, 5),
+                "appliance_switch_off_interval": 5,
+                "appliance_current_set_entity": f"number.appliance_{i}_current"
+                if dynamic
+                else None,
+                "actual_power": f"sensor.appliance_{i}_power",
+                "defined_current": 1
+                if dynamic
+                else self.random.choice([0.5, 1, 1.5, 2]),
+                "appliance_on_only": i % 10 == 9,
+                "grid_voltage": VOLTAGE,
+                "import_export_power": None,
+                "home_battery_capacity": 10,
+                "solar_production_forecast": "sensor.solar_forecast",
+                "solar_production_forecast_this_hour": None,
+                "time_of_sunset": "sensor.sun_next_setting",
+                "appliance_once_only": False,
+                "appliance_maximum_run_time": 0,
+                "appliance_minimum_run_time": 0,
+                "appliance_runtime_deadline": "23:59:00",
+                "enabled": None,
+            }
+            if allocation_mode != "greedy":
+                # scripts before the allocation modes do not know the parameter
+                appliance["allocation_mode"] = allocation_mode
+            states[appliance["appliance_switch"]] = "off"
+            states[appliance["actual_power"]] = "0"
+            if dynamic:
+                states[appliance["appliance_current_set_entity"]] = "1"
+            self.appliances.append(appliance)
+        self.nominal_power = sum(
+            [self._power(a, a["defined_current"]) for a in self.appliances]
+        )
+        self.minute = -1
+        self.pv_power = 0
+        self.update()
+
+    @staticmethod
+    def _power(appliance: dict, current: float) -> float:
+        return current * VOLTAGE * appliance["appliance_phases"]
+
+    def register(self):
+        for appliance in self.appliances:
+            self.sandbox.call_service("pv_excess_control", **appliance)
+        for automation_id in self.sandbox.automation_ids():
+            self.sandbox.state.states[automation_id] = "on"
+
+    def update(self):
+        """
+        Sets the sensors according to the switch states of the appliances.
+        """
+        state = self.sandbox.state
+        minute = int(self.sandbox.clock.now.timestamp() // 60)
+        if minute != self.minute:
+            self.minute = minute
+            self.pv_power = self.nominal_power * self.random.uniform(0.3, 0.7) + 500
+        consumption = 0
+        for appliance in self.appliances:
+            power = 0
+            if state.states[appliance["appliance_switch"]] == "on":
+                current = appliance["defined_current"]
+                if appliance["dynamic_current_appliance"]:
+                    current = float(
+                        state.states[appliance["appliance_current_set_entity"]]
+                    )
+                power = self._power(appliance, current)
+            state.update(appliance["actual_power"], str(power))
+            consumption += power
+        load = 500 + consumption
+        state.update("sensor.pv_power", str(round(self.pv_power)))
+        state.update("sensor.load_power", str(round(load)))
+        state.update("sensor.export_power", str(round(max(0, self.pv_power - load))))
+
+
+class LineCounter:
+    """
+    Counts the executed lines of the script outside of natively compiled functions, as a measure of the work
+    interpreted by pyscript. Tracing slows down the script considerably, wall times are not comparable with it.
+    """
+
+    def __init__(self, sandbox: PyscriptSandbox, script_path: str):
+        self.native_code = sandbox.native_code
+        self.script_path = script_path
+        self.lines = 0
+
+    def _trace(self, frame: types.FrameType, event: str, arg):
+        code = frame.f_code
+        if code.co_filename != self.script_path or code in self.native_code:
+            return None
+        return self._trace_lines
+
+    def _trace_lines(self, frame: types.FrameType, event: str, arg):
+        if event == "line":
+            self.lines += 1
+        return self._trace_lines
+
+    def start(self):
+        sys.settrace(self._trace)
+
+    def stop(self):
+        sys.settrace(None)
+
+
+def _stats(values: list) -> dict:
+    return {
+        "mean": round(statistics.fmean(values), 3),
+        "median": round(statistics.median(values), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def run(
+    appliances: int,
+    minutes: int,
+    script_path: str,
+    allocation_mode: str = "greedy",
+    interpreted_lines: bool = False,
+) -> dict:
+    """
+    Runs the benchmark for one number of appliances.
+
+    :param appliances:          Number of synthetic appliances
+    :param minutes:             Number of simulated minutes (6 ticks each)
+    :param script_path:         Path of the script to benchmark
+    :param allocation_mode:     Allocation mode of the appliances
+    :param interpreted_lines:   Count the lines interpreted by pyscript per tick
+    :return:                    Result dict
+    """
+    tracemalloc.start()
+    sandbox = PyscriptSandbox(START, script_path=script_path, log_level="ERROR")
+    scenario = Scenario(sandbox, appliances, allocation_mode=allocation_mode)
+    started = time.perf_counter()
+    scenario.register()
+    registration = time.perf_counter() - started
+
+    counter = LineCounter(sandbox, script_path) if interpreted_lines else None
+    ticks = {"sample": [], "control": []}
+    for i in range(minutes * 6):
+        reads = sandbox.state.reads
+        calls = len(sandbox.service.calls)
+        lookups = sandbox.service.lookups
+        lines = counter.lines if counter else 0
+        started = time.perf_counter()
+        if counter:
+            counter.start()
+        sandbox.step(10, before_triggers=scenario.update)
+        if counter:
+            counter.stop()
+        duration = time.perf_counter() - started
+        # every 6th tick runs the control pass
+        kind = "control" if (i + 1) % 6 == 0 else "sample"
+        ticks[kind].append(
+            (
+                duration * 1000,
+                sandbox.state.reads - reads,
+                len(sandbox.service.calls) - calls,
+                sandbox.service.lookups - lookups,
+                counter.lines - lines if counter else 0,
+            )
+        )
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        "appliances": appliances,
+        "registration_s": round(registration, 4),
+        "peak_memory_kib": round(peak / 1024, 1),
+        "ticks": {},
+    }
+    for kind, samples in ticks.items():
+        if not samples:
+            continue
+        result["ticks"][kind] = {
+            "count": len(samples),
+            "wall_time_ms": _stats([s[0] for s in samples]),
+            "state_reads": _stats([s[1] for s in samples]),
+            "service_calls": _stats([s[2] for s in samples]),
+            "service_lookups": _stats([s[3] for s in samples]),
+        }
+        if counter:
+            result["ticks"][kind]["interpreted_lines"] = _stats([s[4] for s in samples])
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Scaling benchmark of the pv_excess_control.py control loop"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100, 1000],
+        help="Numbers of appliances to benchmark",
+    )
+    parser.add_argument(
+        "--minutes", type=int, default=5, help="Simulated minutes per size"
+    )
+    parser.add_argument("--script", default=SCRIPT_PATH, help="Script to benchmark")
+    parser.add_argument(
+        "--allocation",
+        choices=["greedy", "optimal"],
+        default="greedy",
+        help="Allocation mode of the appliances",
+    )
+    parser.add_argument(
+        "--interpreted-lines",
+        action="store_true",
+        help="Count the lines interpreted by pyscript per tick (slow, wall times are not comparable)",
+    )
+    parser.add_argument(
+        "--output", help="Write the JSON results to this file instead of stdout"
+    )
+    args = parser.parse_args(argv)
+
+    results = {
+        "script": args.script,
+        "python": platform.python_version(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(
+            timespec="seconds"
+        ),
+        "minutes": args.minutes,
+        "allocation_mode": args.allocation,
+        "results": [],
+    }
+    for size in args.sizes:
+        results["results"].append(
+            run(
+                size,
+                args.minutes,
+                args.script,
+                args.allocation,
+                args.interpreted_lines,
+            )
+        )
+        print(f"Benchmarked {size} appliances", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,459 @@
+# INFO --------------------------------------------
+# Minimal stand-ins for the pyscript runtime, which allow running pv_excess_control.py with plain CPython.
+# Used by the offline tools in this folder, not needed in Home Assistant.
+# -------------------------------------------------
+import datetime
+import logging
+import os
+import re
+import sys
+import types
+import weakref
+from typing import Union
+
+SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "pyscript",
+    "pv_excess_control.py",
+)
+
+# Services provided per domain, as far as they are used by the script
+DOMAIN_SERVICES = {
+    "switch": ("turn_on", "turn_off"),
+    "light": ("turn_on", "turn_off"),
+    "fan": ("turn_on", "turn_off"),
+    "input_boolean": ("turn_on", "turn_off"),
+    "climate": ("turn_on", "turn_off"),
+    "number": ("set_value",),
+    "input_number": ("set_value",),
+}
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# Logger pyscript uses for the script, its level decides which messages the script builds at all
+LOGGER_NAME = "custom_components.pyscript.file.pv_excess_control"
+
+
+class VirtualClock:
+    """
+    Clock which only advances when told to. Holds an aware UTC timestamp and the local time zone of the replay.
+    """
+
+    def __init__(self, start: datetime.datetime, tz: datetime.tzinfo):
+        self.tz = tz
+        self.now = start.astimezone(datetime.timezone.utc)
+
+    def advance(self, seconds: float):
+        """
+        :param seconds: Seconds to move the clock forward
+        """
+        self.now += datetime.timedelta(seconds=seconds)
+
+    def set(self, moment: datetime.datetime):
+        """
+        Moves the clock to the given moment, but never backwards.
+
+        :param moment:  Aware datetime
+        """
+        self.now = max(self.now, moment.astimezone(datetime.timezone.utc))
+
+    def local(self) -> datetime.datetime:
+        """
+        :return:    Naive local time, as returned by datetime.datetime.now()
+        """
+        return self.now.astimezone(self.tz).replace(tzinfo=None)
+
+
+def make_datetime_module(clock: VirtualClock) -> types.SimpleNamespace:
+    """
+    Builds a replacement for the datetime module, whose datetime.now() follows the virtual clock.
+
+    :param clock:   Virtual clock
+    :return:        Module-like namespace
+    """
+
+    class VirtualDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            moment = clock.now.astimezone(tz) if tz else clock.local()
+            return cls.combine(moment.date(), moment.timetz())
+
+    module = types.SimpleNamespace(
+        **{k: getattr(datetime, k) for k in dir(datetime) if not k.startswith("_")}
+    )
+    module.datetime = VirtualDatetime
+    return module
+
+
+class StubLog:
+    """
+    Replacement for the pyscript log object. Counts messages per level and prints those at or above echo_level.
+    """
+
+    def __init__(
+        self, echo_level: str = "WARNING", clock: Union[VirtualClock, None] = None
+    ):
+        self.echo_level = LOG_LEVELS[echo_level.upper()]
+        self.clock = clock
+        self.counts = dict.fromkeys(LOG_LEVELS, 0)
+
+    def _log(self, level: str, msg: str):
+        self.counts[level] += 1
+        if LOG_LEVELS[level] >= self.echo_level:
+            stamp = f"{self.clock.local():%Y-%m-%d %H:%M:%S} " if self.clock else ""
+            print(f"{stamp}{level:7} {msg}", file=sys.stderr)
+
+    def debug(self, msg: str):
+        self._log("DEBUG", msg)
+
+    def info(self, msg: str):
+        self._log("INFO", msg)
+
+    def warning(self, msg: str):
+        self._log("WARNING", msg)
+
+    def error(self, msg: str):
+        self._log("ERROR", msg)
+
+
+class StateVal(str):
+    """
+    State value with the time of the last change, like the values returned by pyscript's state.get().
+    """
+
+    def __new__(cls, value, last_changed: datetime.datetime):
+        state_val = super().__new__(cls, value)
+        state_val.last_changed = last_changed
+        return state_val
+
+
+class StubState:
+    """
+    Replacement for the pyscript state object, backed by a dict of entity states.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.reads = 0
+        self.writes = 0
+        # callables(entity_id, value, old_value), notified about changed states
+        self.listeners = []
+
+    def get(self, entity_id: str) -> str:
+        self.reads += 1
+        if entity_id not in self.states:
+            raise NameError(f"name '{entity_id}' is not defined")
+        return self.states[entity_id]
+
+    def set(self, entity_id: str, value=None, **kwargs):
+        self.writes += 1
+        self.update(entity_id, str(value))
+
+    def update(self, entity_id: str, value: str):
+        """
+        Changes the state of an entity, notifying the listeners (state triggers) if the state changed.
+
+        :param entity_id:   Entity ID
+        :param value:       New state
+        """
+        old_value = self.states.get(entity_id)
+        self.states[entity_id] = value
+        if old_value is None or str(old_value) != str(value):
+            for listener in list(self.listeners):
+                listener(entity_id, value, old_value)
+
+
+class StubService:
+    """
+    Replacement for the pyscript service object. Registers script services (when used as decorator) and applies
+    called entity services to the stub state.
+    """
+
+    def __init__(self, state: StubState, clock: VirtualClock):
+        self.state = state
+        self.clock = clock
+        self.services = {}
+        self.calls = []
+        self.lookups = 0
+
+    def __call__(self, func):
+        self.services[func.__name__] = func
+        return func
+
+    def has_service(self, domain: str, name: str) -> bool:
+        self.lookups += 1
+        return name in DOMAIN_SERVICES.get(domain, ())
+
+    def call(self, domain: str, name: str, entity_id=None, **kwargs):
+        if name not in DOMAIN_SERVICES.get(domain, ()):
+            raise ValueError(f"Service {domain}.{name} not found")
+        self.calls.append((self.clock.local(), domain, name, entity_id, kwargs))
+        entity_ids = entity_id if isinstance(entity_id, list) else [entity_id]
+        for e_id in entity_ids:
+            if name == "turn_on":
+                value = "heat" if domain == "climate" else "on"
+            elif name == "turn_off":
+                value = "off"
+            else:
+                value = str(kwargs["value"])
+            self.state.update(e_id, StateVal(value, self.clock.now))
+
+
+class StubTask:
+    """
+    Replacement for the pyscript task object. Sleeping advances the virtual clock.
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.slept = 0
+
+    def sleep(self, seconds: float):
+        self.slept += seconds
+        self.clock.advance(seconds)
+
+    @staticmethod
+    def executor(func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class Triggers:
+    """
+    Registry for functions decorated with @time_trigger, @event_trigger or @state_trigger. Supports the
+    "period(now, <n>s)", "cron(...)" and "once(YYYY/MM/DD HH:MM:SS)" time triggers used by the script. Cron expressions
+    support "*", "*/n" and plain numbers in the minute and hour fields. State and once triggers are held by weak
+    references, like pyscript stops triggers of functions which are no longer referenced. State triggers support plain
+    entity IDs (strings or lists of strings).
+    """
+
+    def __init__(self):
+        self.periodic = []
+        self.cron = []
+        # (naive local time, weak reference to the function)
+        self.once = []
+        self.events = {}
+        self.states = {}
+
+    def state_trigger(self, *exprs, **kwargs):
+        def decorator(func):
+            for expr in exprs:
+                for entity_id in expr if isinstance(expr, list) else [expr]:
+                    self.states.setdefault(entity_id, []).append(weakref.ref(func))
+            return func
+
+        return decorator
+
+    def fire_state(self, entity_id: str, value, old_value):
+        """
+        Calls all live functions triggered by a state change of the given entity.
+
+        :param entity_id:   Entity ID
+        :param value:       New state
+        :param old_value:   Previous state
+        """
+        refs = self.states.get(entity_id)
+        if not refs:
+            return
+        refs[:] = [ref for ref in refs if ref() is not None]
+        for ref in list(refs):
+            func = ref()
+            if func is not None:
+                func(
+                    trigger_type="state",
+                    var_name=entity_id,
+                    value=value,
+                    old_value=old_value,
+                )
+
+    def event_trigger(self, event_type: str, *args, **kwargs):
+        def decorator(func):
+            self.events.setdefault(event_type, []).append(func)
+            return func
+
+        return decorator
+
+    def fire_event(self, event_type: str, **data):
+        """
+        Calls all functions triggered by the given event type.
+
+        :param event_type:  Event type
+        :param data:        Event data, passed as keyword arguments
+        """
+        for func in list(self.events.get(event_type, [])):
+            func(**data)
+
+    def time_trigger(self, *specs, **kwargs):
+        def decorator(func):
+            for spec in specs:
+                period = re.fullmatch(r"period\(now,\s*(\d+)s\)", spec)
+                cron = re.fullmatch(r"cron\((.+)\)", spec)
+                once = re.fullmatch(r"once\((\d{4}/\d\d/\d\d \d\d:\d\d:\d\d)\)", spec)
+                if period:
+                    self.periodic.append((int(period.group(1)), func))
+                elif cron:
+                    self.cron.append((cron.group(1).split(), func))
+                elif once:
+                    moment = datetime.datetime.strptime(
+                        once.group(1), "%Y/%m/%d %H:%M:%S"
+                    )
+                    self.once.append((moment, weakref.ref(func)))
+                else:
+                    raise ValueError(f"Unsupported time trigger: {spec}")
+            return func
+
+        return decorator
+
+    @staticmethod
+    def _cron_field_matches(field: str, value: int) -> bool:
+        if field == "*":
+            return True
+        if field.startswith("*/"):
+            return value % int(field[2:]) == 0
+        return int(field) == value
+
+    def fire_cron(self, local: datetime.datetime):
+        """
+        Calls all cron triggers matching the given local minute.
+
+        :param local:   Naive local time
+        """
+        for fields, func in list(self.cron):
+            if self._cron_field_matches(
+                fields[0], local.minute
+            ) and self._cron_field_matches(fields[1], local.hour):
+                func()
+
+    def fire_once(self, local: datetime.datetime):
+        """
+        Calls all live once triggers due at the given time, each only once.
+
+        :param local:   Naive local time
+        """
+        due = [(moment, ref) for moment, ref in self.once if moment <= local]
+        if not due:
+            return
+        self.once = [
+            (moment, ref)
+            for moment, ref in self.once
+            if moment > local and ref() is not None
+        ]
+        for _moment, ref in due:
+            func = ref()
+            if func is not None:
+                func()
+
+    def fire_periodic(self, elapsed: int):
+        """
+        Calls all periodic triggers due after the given number of elapsed seconds.
+
+        :param elapsed: Seconds since start of the replay
+        """
+        for period, func in list(self.periodic):
+            if elapsed % period == 0:
+                func()
+
+
+class PyscriptSandbox:
+    """
+    Loads pv_excess_control.py with stubbed pyscript builtins and a virtual clock.
+    """
+
+    def __init__(
+        self,
+        start: datetime.datetime,
+        tz: datetime.tzinfo = datetime.timezone.utc,
+        script_path: str = SCRIPT_PATH,
+        log_level: str = "WARNING",
+        state_file: Union[str, None] = None,
+    ):
+        """
+        :param start:       Start time (aware datetime)
+        :param tz:          Local time zone
+        :param script_path: Path of the script to load
+        :param log_level:   Log level of the script, messages at or above it are printed
+        :param state_file:  File the script persists its state to, None to disable persistence
+        """
+        self.clock = VirtualClock(start, tz)
+        self.state = StubState()
+        self.service = StubService(self.state, self.clock)
+        self.log = StubLog(log_level, self.clock)
+        self.task = StubTask(self.clock)
+        self.triggers = Triggers()
+        # code objects of the functions compiled natively by pyscript (@pyscript_compile), including nested ones
+        self.native_code = set()
+        logging.getLogger(LOGGER_NAME).setLevel(LOG_LEVELS[log_level.upper()])
+        self.namespace = {
+            "__name__": "pv_excess_control",
+            "__file__": script_path,
+            "state": self.state,
+            "service": self.service,
+            "log": self.log,
+            "task": self.task,
+            "time_trigger": self.triggers.time_trigger,
+            "event_trigger": self.triggers.event_trigger,
+            "state_trigger": self.triggers.state_trigger,
+            "pyscript_compile": self._pyscript_compile,
+        }
+        self.state.listeners.append(self.triggers.fire_state)
+        with open(script_path, encoding="utf-8") as f:
+            source = f.read()
+        exec(compile(source, script_path, "exec"), self.namespace)
+        self.namespace["datetime"] = make_datetime_module(self.clock)
+        if "StateStore" in self.namespace:
+            self.namespace["StateStore"].path = state_file
+            self.namespace["StateStore"].enabled = state_file is not None
+        # scheduled time of the last step. The clock itself may run ahead, when the script sleeps.
+        self.scheduled = self.clock.now
+        self.elapsed = 0
+
+    def _pyscript_compile(self, func):
+        codes = [func.__code__]
+        while codes:
+            code = codes.pop()
+            self.native_code.add(code)
+            codes.extend([c for c in code.co_consts if isinstance(c, types.CodeType)])
+        return func
+
+    def __getitem__(self, name: str):
+        return self.namespace[name]
+
+    def automation_ids(self) -> list:
+        """
+        :return:    Automation IDs of all registered appliances
+        """
+        if "ControlGroup" in self.namespace:
+            # scripts before the appliance configuration objects keep it in the instance
+            return [
+                getattr(inst, "config", inst).automation_id
+                for inst in self.namespace["ControlGroup"].all_instances()
+            ]
+        instances = self.namespace["PvExcessControl"].instances
+        # scripts before the priority registry keep their instances in a dict
+        return list(getattr(instances, "by_id", instances))
+
+    def call_service(self, name: str, **kwargs):
+        """
+        Calls a service defined by the script.
+
+        :param name:    Service name (without the pyscript domain)
+        """
+        return self.service.services[name](**kwargs)
+
+    def step(self, seconds: int = 10, before_triggers=None):
+        """
+        Advances the virtual clock by one step and fires all triggers due in that step.
+
+        :param seconds:         Step length, must divide 60
+        :param before_triggers: Optional callable, called after advancing the clock but before firing the triggers
+        """
+        before = self.scheduled.astimezone(self.clock.tz)
+        self.elapsed += seconds
+        self.scheduled += datetime.timedelta(seconds=seconds)
+        self.clock.set(self.scheduled)
+        if before_triggers:
+            before_triggers()
+        local = self.scheduled.astimezone(self.clock.tz)
+        if local.minute != before.minute:
+            self.triggers.fire_cron(local.replace(second=0, tzinfo=None))
+        self.triggers.fire_once(local.replace(tzinfo=None))
+        self.triggers.fire_periodic(self.elapsed)
@@ -0,0 +1,384 @@
+# INFO --------------------------------------------
+# Offline replay of pv_excess_control.py against recorded sensor data.
+#
+# Loads sensor histories exported from Home Assistant (CSV with the columns entity_id, state, last_changed), registers
+# the appliances from a JSON config file and drives the script on a virtual clock. Every _turn_on, _turn_off and
+# _set_value call is captured. A full day replays in seconds with plain CPython, see README.
+# -------------------------------------------------
+import argparse
+import csv
+import datetime
+import json
+import sys
+import zoneinfo
+from typing import Union
+
+from pyscript_stubs import PyscriptSandbox
+
+# Defaults of the optional blueprint inputs
+SERVICE_DEFAULTS = {
+    "appliance_priority": 1,
+    "export_power": None,
+    "load_power": None,
+    "home_battery_level": None,
+    "min_home_battery_level": 100,
+    "min_home_battery_level_start": False,
+    "zero_feed_in": False,
+    "zero_feed_in_load": 300,
+    "zero_feed_in_level": 99,
+    "dynamic_current_appliance": False,
+    "round_target_current": False,
+    "deactivating_current": False,
+    "appliance_current_interval": 1,
+    "appliance_phases": 1,
+    "min_current": 6,
+    "max_current": 16,
+    "min_solar_percent": 100,
+    "appliance_switch_interval": 5,
+    "appliance_switch_off_interval": 5,
+    "appliance_current_set_entity": None,
+    "actual_power": None,
+    "defined_current": 6,
+    "appliance_on_only": False,
+    "grid_voltage": 230,
+    "import_export_power": None,
+    "home_battery_capacity": 0,
+    "solar_production_forecast": None,
+    "solar_production_forecast_this_hour": None,
+    "time_of_sunset": None,
+    "appliance_once_only": False,
+    "appliance_maximum_run_time": 0,
+    "appliance_minimum_run_time": 0,
+    "appliance_runtime_deadline": "23:59:00",
+    "enabled": None,
+    "allocation_mode": "greedy",
+    "control_group": None,
+    "current_control": "step",
+    "current_slew_rate": 2,
+}
+
+
+def _parse_time(value: str) -> datetime.datetime:
+    moment = datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment
+
+
+def load_history(paths: list) -> dict:
+    """
+    Loads recorded entity states from Home Assistant history CSV exports.
+
+    :param paths:   CSV files with the columns entity_id, state, last_changed
+    :return:        Dict of entity_id -> list of (aware datetime, state), sorted by time
+    """
+    series = {}
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                series.setdefault(row["entity_id"], []).append(
+                    (_parse_time(row["last_changed"]), row["state"])
+                )
+    for points in series.values():
+        points.sort(key=lambda point: point[0])
+    return series
+
+
+def load_config(path: str) -> list:
+    """
+    Loads the appliance configuration. The file contains a "common" dict with the inputs shared by all automations
+    (sensors, battery settings, ...) and an "appliances" list with the appliance specific inputs. Missing optional
+    inputs fall back to the blueprint defaults.
+
+    :param path:    JSON config file
+    :return:        List of complete service call parameters, one per appliance
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    return [
+        {**SERVICE_DEFAULTS, **config.get("common", {}), **appliance}
+        for appliance in config["appliances"]
+    ]
+
+
+class Replay:
+    """
+    Drives the script through recorded sensor data.
+
+    With feedback enabled, the power of appliances switched on by the script is added to the recorded load (and
+    removed from the recorded export), as the recording does not contain it. Battery charging is not simulated.
+    """
+
+    def __init__(
+        self,
+        appliances: list,
+        series: dict,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        tz: datetime.tzinfo,
+        feedback: bool = True,
+        log_level: str = "WARNING",
+        state_file: Union[str, None] = None,
+    ):
+        self.appliances = appliances
+        self.end = end
+        self.feedback = feedback
+        self.sandbox = PyscriptSandbox(
+            start, tz, log_level=log_level, state_file=state_file
+        )
+        self.actions = []
+        self._wrap_actuators()
+
+        controlled = set()
+        for appliance in appliances:
+            controlled.update(
+                [
+                    appliance["appliance_switch"],
+                    appliance["appliance_current_set_entity"],
+                    appliance["actual_power"],
+                ]
+            )
+        # entities controlled by the script are not taken from the recording
+        self.series = {
+            e_id: points
+            for e_id, points in series.items()
+            if not (feedback and e_id in controlled)
+        }
+        self.cursors = dict.fromkeys(self.series, -1)
+        self.recorded = {}
+
+        common = appliances[0] if appliances else {}
+        self.load_power = common.get("load_power")
+        self.export_power = common.get("export_power")
+        self.import_export_power = common.get("import_export_power")
+
+        self._update_sensors()
+        for appliance in appliances:
+            states = self.sandbox.state.states
+            states.setdefault(appliance["appliance_switch"], "off")
+            if appliance["enabled"]:
+                states.setdefault(appliance["enabled"], "on")
+            if appliance["appliance_current_set_entity"]:
+                states.setdefault(
+                    appliance["appliance_current_set_entity"],
+                    str(appliance["min_current"]),
+                )
+            self.sandbox.call_service("pv_excess_control", **appliance)
+        for automation_id in self.sandbox.automation_ids():
+            self.sandbox.state.states[automation_id] = "on"
+        self._apply_feedback()
+
+    def _wrap_actuators(self):
+        """
+        Replaces the actuator functions of the script with wrappers, which record each call and its result. Actions
+        superseded by a later action for the same entity within one tick are not sent and therefore not recorded.
+        """
+
+        def wrap(kind, func):
+            def wrapper(entity_id, *args, on_result=None):
+                moment = self.sandbox.clock.local()
+                recorded = []
+
+                def record(success):
+                    # actions may be batched, the result is only known once they have been sent. Superseded actions
+                    # (None) are not sent.
+                    recorded.append(success)
+                    if success is not None:
+                        self.actions.append(
+                            (moment, kind, entity_id, args[0] if args else "", success)
+                        )
+                    if on_result is not None:
+                        on_result(success)
+
+                result = func(entity_id, *args, on_result=record)
+                if not result and not recorded:
+                    record(False)
+                return result
+
+            return wrapper
+
+        for kind in ("_turn_on", "_turn_off", "_set_value"):
+            self.sandbox.namespace[kind] = wrap(kind, self.sandbox[kind])
+
+    def _update_sensors(self):
+        """
+        Sets all recorded entities to their last recorded state at the current virtual time.
+        """
+        now = self.sandbox.clock.now
+        for e_id, points in self.series.items():
+            i = self.cursors[e_id]
+            while i + 1 < len(points) and points[i + 1][0] <= now:
+                i += 1
+            self.cursors[e_id] = i
+            if i >= 0:
+                self.recorded[e_id] = points[i][1]
+                self.sandbox.state.update(e_id, points[i][1])
+
+    def _appliance_power(self, appliance: dict) -> float:
+        """
+        :return:    Simulated power consumption of an appliance in W
+        """
+        states = self.sandbox.state.states
+        if states.get(appliance["appliance_switch"]) in (None, "off"):
+            return 0
+        current = float(appliance["defined_current"])
+        if appliance["dynamic_current_appliance"]:
+            current = float(
+                states.get(appliance["appliance_current_set_entity"], current)
+            )
+        return (
+            current
+            * float(appliance["grid_voltage"])
+            * int(appliance["appliance_phases"])
+        )
+
+    def _apply_feedback(self):
+        """
+        Adds the consumption of switched on appliances to the recorded load and export sensors.
+        """
+        if not self.feedback:
+            return
+        extra = 0
+        for appliance in self.appliances:
+            power = self._appliance_power(appliance)
+            extra += power
+            if appliance["actual_power"]:
+                self.sandbox.state.update(appliance["actual_power"], str(power))
+
+        def shift(entity_id, delta, minimum=None):
+            value = self.recorded.get(entity_id)
+            try:
+                value = float(value) + delta
+            except (TypeError, ValueError):
+                return
+            self.sandbox.state.update(
+                entity_id, str(value if minimum is None else max(minimum, value))
+            )
+
+        if self.load_power:
+            shift(self.load_power, extra)
+        if self.export_power:
+            shift(self.export_power, -extra, minimum=0)
+        if self.import_export_power:
+            shift(self.import_export_power, extra)
+
+    def run(self, step: int = 10):
+        """
+        Replays until the end time.
+
+        :param step:    Step length in seconds
+        """
+        while self.sandbox.scheduled < self.end:
+            self.sandbox.step(step, before_triggers=self._tick)
+
+    def _tick(self):
+        self._update_sensors()
+        self._apply_feedback()
+
+    def summary(self) -> dict:
+        """
+        :return:    Switching statistics per appliance switch entity
+        """
+        result = {}
+        for appliance in self.appliances:
+            switch = appliance["appliance_switch"]
+            on_since = None
+            on_seconds = 0
+            stats = {"turn_on": 0, "turn_off": 0, "set_value": 0}
+            for moment, kind, e_id, value, success in self.actions:
+                if not success:
+                    continue
+                if e_id == switch and kind == "_turn_on":
+                    stats["turn_on"] += 1
+                    on_since = on_since or moment
+                elif e_id == switch and kind == "_turn_off":
+                    stats["turn_off"] += 1
+                    if on_since:
+                        on_seconds += (moment - on_since).total_seconds()
+                    on_since = None
+                elif e_id == appliance["appliance_current_set_entity"]:
+                    stats["set_value"] += 1
+            if on_since:
+                on_seconds += (self.sandbox.clock.local() - on_since).total_seconds()
+            stats["on_minutes"] = round(on_seconds / 60, 1)
+            result[switch] = stats
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay recorded sensor data through pv_excess_control.py"
+    )
+    parser.add_argument("config", help="JSON file with the appliance configuration")
+    parser.add_argument(
+        "history", nargs="+", help="Home Assistant history CSV export(s)"
+    )
+    parser.add_argument(
+        "--start", help="Start time (ISO format), default: first recorded state"
+    )
+    parser.add_argument(
+        "--end", help="End time (ISO format), default: last recorded state"
+    )
+    parser.add_argument(
+        "--tz", default="UTC", help="Local time zone, e.g. Europe/Berlin"
+    )
+    parser.add_argument(
+        "--no-feedback",
+        action="store_true",
+        help="Do not add the consumption of switched appliances to the recorded load",
+    )
+    parser.add_argument("--actions", help="Write all captured actions to this CSV file")
+    parser.add_argument(
+        "--state-file",
+        help="Persist the script state to this file, restoring it at the start if it exists",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        help="Echo script log messages from this level",
+    )
+    args = parser.parse_args(argv)
+
+    series = load_history(args.history)
+    if not series:
+        parser.error("No recorded states found")
+    times = [point[0] for points in series.values() for point in points]
+    start = _parse_time(args.start) if args.start else min(times)
+    end = _parse_time(args.end) if args.end else max(times)
+
+    replay = Replay(
+        load_config(args.config),
+        series,
+        start,
+        end,
+        zoneinfo.ZoneInfo(args.tz),
+        feedback=not args.no_feedback,
+        log_level=args.log_level,
+        state_file=args.state_file,
+    )
+    replay.run()
+
+    if args.actions:
+        with open(args.actions, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time", "action", "entity_id", "value", "success"])
+            for moment, kind, e_id, value, success in replay.actions:
+                writer.writerow(
+                    [moment.isoformat(), kind.lstrip("_"), e_id, value, success]
+                )
+    json.dump(
+        {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "actions": len(replay.actions),
+            "appliances": replay.summary(),
+            "log_messages": replay.sandbox.log.counts,
+        },
+        sys.stdout,
+        indent=2,
+    )
+    print()
+
+
+if __name__ == "__main__":
+    main()